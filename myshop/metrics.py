@@ -0,0 +1,230 @@
+import bisect
+import heapq
+import logging
+import threading
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from rest_framework import serializers
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Замеры одного запроса: SQL, сериализация и самые долгие запросы к базе"""
+
+    def __init__(self, slow_queries):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+        self.slow_queries = slow_queries
+        self.worst = []
+
+    def __call__(self, execute, sql, params, many, context):
+        # execute_wrapper: вызывается на каждый запрос к базе
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.queries += 1
+            self.db_time += elapsed
+            if self.slow_queries:
+                # держим только N самых долгих, без списка всех запросов
+                entry = (elapsed, self.queries, sql)
+                if len(self.worst) < self.slow_queries:
+                    heapq.heappush(self.worst, entry)
+                elif entry > self.worst[0]:
+                    heapq.heapreplace(self.worst, entry)
+
+
+class MetricsRegistry:
+    """
+    Счетчики в памяти процесса по маршруту, действию и методу.
+    Обновляются под одной блокировкой, наружу отдаются в формате Prometheus
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._statuses = {}
+        self._collectors = {}
+
+    def observe(self, labels, status, duration, metrics, size):
+        index = bisect.bisect_left(self.buckets, duration)
+        with self._lock:
+            route = self._routes.get(labels)
+            if route is None:
+                route = self._routes[labels] = {
+                    'buckets': [0] * (len(self.buckets) + 1),
+                    'count': 0, 'duration': 0.0, 'queries': 0, 'db_time': 0.0,
+                    'serializer_time': 0.0, 'bytes': 0,
+                }
+            route['buckets'][index] += 1
+            route['count'] += 1
+            route['duration'] += duration
+            route['queries'] += metrics.queries
+            route['db_time'] += metrics.db_time
+            route['serializer_time'] += metrics.serializer_time
+            route['bytes'] += size
+            key = (*labels, status)
+            self._statuses[key] = self._statuses.get(key, 0) + 1
+
+    def register_collector(self, name, collect):
+        """collect() возвращает словарь числовых показателей, они выводятся как gauge"""
+        self._collectors[name] = collect
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+            self._statuses.clear()
+
+    def render(self):
+        with self._lock:
+            routes = {labels: dict(route, buckets=list(route['buckets'])) for labels, route in self._routes.items()}
+            statuses = dict(self._statuses)
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        name = 'myshop_http_request_duration_seconds'
+        family(name, 'histogram', 'Request latency')
+        for labels, route in routes.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), route['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {route["duration"]}')
+            lines.append(f'{name}_count{_labels(labels)} {route["count"]}')
+
+        family('myshop_http_requests_total', 'counter', 'Requests by status code')
+        for (*labels, status), count in statuses.items():
+            lines.append(f'myshop_http_requests_total{_labels(labels, status=status)} {count}')
+
+        for field, name, help_text in (
+            ('queries', 'myshop_db_queries_total', 'SQL statements executed'),
+            ('db_time', 'myshop_db_query_duration_seconds_total', 'Time spent in SQL'),
+            ('serializer_time', 'myshop_serializer_duration_seconds_total', 'Time spent in serializers'),
+            ('bytes', 'myshop_http_response_bytes_total', 'Response body size'),
+        ):
+            family(name, 'counter', help_text)
+            for labels, route in routes.items():
+                lines.append(f'{name}{_labels(labels)} {route[field]}')
+
+        for collector, collect in self._collectors.items():
+            try:
+                values = collect()
+            except Exception:
+                logger.warning('Сборщик метрик %s упал', collector, exc_info=True)
+                continue
+            for key, value in values.items():
+                name = f'myshop_{collector}_{key}'
+                family(name, 'gauge', f'{collector} {key}')
+                lines.append(f'{name} {float(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, **extra):
+    route, action, method = labels
+    pairs = {'route': route, 'action': action, 'method': method, **extra}
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs.items()) + '}'
+
+
+registry = MetricsRegistry(settings.METRICS_LATENCY_BUCKETS)
+
+
+def _timed_data(prop):
+    # .data вложенных сериализаторов считается только внешним вызовом
+    def data(self):
+        metrics = _current.get()
+        if metrics is None:
+            return prop.fget(self)
+        metrics.serializer_depth += 1
+        started = time.perf_counter()
+        try:
+            return prop.fget(self)
+        finally:
+            metrics.serializer_depth -= 1
+            if not metrics.serializer_depth:
+                metrics.serializer_time += time.perf_counter() - started
+    data.timed = True
+    return property(data)
+
+
+def instrument_serializers():
+    for cls in (serializers.Serializer, serializers.ListSerializer):
+        prop = cls.__dict__['data']
+        if not getattr(prop.fget, 'timed', False):
+            cls.data = _timed_data(prop)
+
+
+def request_labels(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return ('unmatched', '', request.method)
+    actions = getattr(match.func, 'actions', None) or {}
+    action = actions.get(request.method.lower(), request.method.lower())
+    return (match.view_name or match.route, action, request.method)
+
+
+class MetricsMiddleware:
+    """
+    Время ответа, число и время SQL-запросов, время сериализации и размер ответа
+    по каждому маршруту. Медленные запросы пишутся в лог с самыми долгими SQL
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_request = settings.METRICS_SLOW_REQUEST_MS / 1000
+        instrument_serializers()
+
+    def __call__(self, request):
+        metrics = RequestMetrics(settings.METRICS_SLOW_QUERIES)
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        duration = time.perf_counter() - started
+        size = 0 if response.streaming else len(response.content)
+        labels = request_labels(request)
+        registry.observe(labels, response.status_code, duration, metrics, size)
+        if self.slow_request and duration >= self.slow_request:
+            self.log_slow(request, labels, duration, metrics)
+        return response
+
+    def log_slow(self, request, labels, duration, metrics):
+        worst = '\n'.join(
+            f'  {elapsed * 1000:.1f} мс: {sql}' for elapsed, _, sql in sorted(metrics.worst, reverse=True)
+        )
+        logger.warning(
+            'Медленный запрос %s %s (%s.%s): %.0f мс, SQL %d шт. за %.0f мс, сериализация %.0f мс\n%s',
+            request.method, request.get_full_path(), labels[0], labels[1], duration * 1000,
+            metrics.queries, metrics.db_time * 1000, metrics.serializer_time * 1000, worst
+        )
+
+
+def metrics_view(request):
+    """Метрики в текстовом формате Prometheus"""
+    token = settings.METRICS_TOKEN
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+from collections import deque
+
+from django.db import OperationalError
+
+
+class PoolTimeout(OperationalError):
+    """Свободного соединения не дождались за TIMEOUT секунд"""
+
+
+class ConnectionPool:
+    """
+    Пул соединений процесса, общий для всех потоков WSGI и для потока,
+    в котором ASGI выполняет синхронный код Django. Держит не больше
+    max_size соединений; простаивающие сверх min_size закрываются через
+    max_idle секунд, любые — через max_lifetime. Соединение, простоявшее
+    дольше check_interval, перед выдачей проверяется и при сбое пересоздается
+    """
+
+    def __init__(self, connect, min_size=0, max_size=10, timeout=5, max_lifetime=1800,
+                 max_idle=300, check_interval=30, check=None, reset=None):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self.check = check or (lambda connection: True)
+        self.reset = reset or _rollback
+        self._condition = threading.Condition()
+        self._forget()
+
+    def _forget(self):
+        # соединения родителя после fork не закрываются: сокеты у процессов общие
+        self.pid = os.getpid()
+        self._idle = deque()
+        self._in_use = {}
+        self._size = 0
+        self._waiting = 0
+        self._counters = dict.fromkeys(
+            ('checkouts', 'wait_seconds', 'checkout_seconds', 'timeouts', 'reconnects', 'errors'), 0
+        )
+
+    def checkout(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._condition:
+            if self.pid != os.getpid():
+                self._forget()
+            while True:
+                if self._idle:
+                    connection, created, used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    connection = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise PoolTimeout(f'Нет свободного соединения за {self.timeout} с')
+                self._waiting += 1
+                try:
+                    self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+        waited = time.monotonic() - started
+
+        # проверки и подключение — вне блокировки, чтобы не задерживать другие потоки
+        reconnect = False
+        if connection is not None:
+            now = time.monotonic()
+            if now - created >= self.max_lifetime:
+                _close(connection)
+                connection = None
+            elif now - used >= self.check_interval and not self.check(connection):
+                _close(connection)
+                connection = None
+                reconnect = True
+        if connection is None:
+            try:
+                connection = self.connect()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._counters['errors'] += 1
+                    self._condition.notify()
+                raise
+            created = time.monotonic()
+
+        with self._condition:
+            self._in_use[id(connection)] = created
+            self._counters['checkouts'] += 1
+            self._counters['reconnects'] += reconnect
+            self._counters['wait_seconds'] += waited
+            self._counters['checkout_seconds'] += time.monotonic() - started
+        return connection
+
+    def checkin(self, connection):
+        with self._condition:
+            created = self._in_use.pop(id(connection), None)
+        if created is None:
+            # соединение не из этого пула, например выданное до fork
+            _close(connection)
+            return
+        healthy = self.reset(connection)
+        now = time.monotonic()
+        discarded = []
+        with self._condition:
+            if healthy and now - created < self.max_lifetime:
+                self._idle.append((connection, created, now))
+            else:
+                self._size -= 1
+                discarded.append(connection)
+            # самые давно простаивающие — в начале очереди
+            while (self._idle and self._size > self.min_size
+                   and now - self._idle[0][2] >= self.max_idle):
+                discarded.append(self._idle.popleft()[0])
+                self._size -= 1
+            self._condition.notify()
+        for connection in discarded:
+            _close(connection)
+
+    def fill(self):
+        """Открывает соединения до min_size, чтобы первые запросы не ждали подключения"""
+        while True:
+            with self._condition:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                connection = self.connect()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._counters['errors'] += 1
+                return
+            now = time.monotonic()
+            with self._condition:
+                self._idle.append((connection, now, now))
+                self._condition.notify()
+
+    def close(self):
+        """Закрывает простаивающие соединения; выданные закроются при возврате"""
+        with self._condition:
+            idle, self._idle = self._idle, deque()
+            self._size -= len(idle)
+        for connection, created, used in idle:
+            _close(connection)
+
+    def stats(self):
+        with self._condition:
+            return dict(
+                self._counters,
+                size=self._size,
+                idle=len(self._idle),
+                in_use=len(self._in_use),
+                waiting=self._waiting,
+                max_size=self.max_size,
+            )
+
+
+def _rollback(connection):
+    try:
+        connection.rollback()
+    except Exception:
+        return False
+    return True
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, options, connect, **kwargs):
+    """Пул для алиаса базы; options — словарь POOL из DATABASES"""
+    pool = _pools.get(alias)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(alias)
+            if pool is None:
+                pool = _pools[alias] = ConnectionPool(
+                    connect,
+                    min_size=options.get('MIN_SIZE', 0),
+                    max_size=options.get('MAX_SIZE', 10),
+                    timeout=options.get('TIMEOUT', 5),
+                    max_lifetime=options.get('MAX_LIFETIME', 1800),
+                    max_idle=options.get('MAX_IDLE', 300),
+                    check_interval=options.get('CHECK_INTERVAL', 30),
+                    **kwargs
+                )
+                if pool.min_size:
+                    threading.Thread(target=pool.fill, daemon=True).start()
+    return pool
+
+
+def pool_stats():
+    """Показатели всех пулов процесса для /metrics"""
+    values = {}
+    for alias, pool in list(_pools.items()):
+        for key, value in pool.stats().items():
+            values[f'{alias}_{key}'] = value
+    return values
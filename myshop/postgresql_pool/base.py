@@ -0,0 +1,67 @@
+"""
+PostgreSQL с пулом соединений: ENGINE = 'myshop.postgresql_pool'.
+Django закрывает соединение в конце запроса (CONN_MAX_AGE = 0),
+а этот бэкенд вместо закрытия возвращает его в пул процесса
+"""
+from functools import partial
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from django.db.backends.postgresql import base
+
+from myshop.pool import get_pool
+
+
+def connect(conn_params, isolation_level=None):
+    # то же, что DatabaseWrapper.get_new_connection, но без записи в self:
+    # соединение может открываться в другом потоке при заполнении пула
+    connection = psycopg2.connect(**conn_params)
+    if isolation_level is not None and isolation_level != connection.isolation_level:
+        connection.set_session(isolation_level=isolation_level)
+    psycopg2.extras.register_default_jsonb(conn_or_curs=connection, loads=lambda x: x)
+    return connection
+
+
+def is_alive(connection):
+    if connection.closed:
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except psycopg2.Error:
+        return False
+    return True
+
+
+def reset(connection):
+    """Незавершенная транзакция откатывается; сломанное соединение в пул не попадает"""
+    if connection.closed:
+        return False
+    try:
+        if connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            connection.rollback()
+    except psycopg2.Error:
+        return False
+    return connection.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        options = self.settings_dict['OPTIONS']
+        self.pool = get_pool(
+            self.alias,
+            self.settings_dict.get('POOL') or {},
+            partial(connect, conn_params, options.get('isolation_level')),
+            check=is_alive,
+            reset=reset,
+        )
+        connection = self.pool.checkout()
+        self.isolation_level = options.get('isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.pool.checkin(self.connection)
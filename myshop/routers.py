@@ -0,0 +1,211 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+_state = ContextVar('replica_state', default=None)
+
+
+class ReplicaState:
+    """Состояние запроса: можно ли сейчас читать с реплик и была ли запись"""
+
+    def __init__(self):
+        self.enabled = False
+        self.wrote = False
+
+
+class ReplicaLagMonitor:
+    """
+    Отстающая или недоступная реплика исключается из чтения. Отставание
+    проверяется не чаще раза в REPLICA_LAG_CHECK_INTERVAL секунд на процесс
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked = {}
+
+    def healthy(self, alias):
+        now = time.monotonic()
+        checked = self._checked.get(alias)
+        if checked is not None and now - checked[0] < settings.REPLICA_LAG_CHECK_INTERVAL:
+            return checked[1]
+        with self._lock:
+            checked = self._checked.get(alias)
+            if checked is None or now - checked[0] >= settings.REPLICA_LAG_CHECK_INTERVAL:
+                try:
+                    healthy = replica_lag(alias) <= settings.REPLICA_MAX_LAG
+                except DatabaseError:
+                    healthy = False
+                checked = self._checked[alias] = (now, healthy)
+        return checked[1]
+
+    def clear(self):
+        with self._lock:
+            self._checked.clear()
+
+
+def replica_lag(alias):
+    """Отставание реплики в секундах; у SQLite-заглушек реплик его нет"""
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    with connection.cursor() as cursor:
+        # на простаивающем мастере replay_timestamp стареет, хотя догонять нечего
+        cursor.execute(
+            'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+            'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+        )
+        lag, = cursor.fetchone()
+    return float(lag or 0)
+
+
+lag_monitor = ReplicaLagMonitor()
+
+
+def mirrors_primary(alias):
+    """
+    Реплика указывает на ту же базу, что и основная, — так в тестах ее
+    настраивает TEST MIRROR. Читать такую реплику нужно через соединение
+    основной базы, иначе не видно данных из незавершенной транзакции
+    """
+    replica = connections.settings.get(alias)
+    primary = connections.settings[DEFAULT_DB_ALIAS]
+    return replica is not None and all(replica.get(key) == primary.get(key) for key in ('NAME', 'HOST', 'PORT'))
+
+
+def choose_replica():
+    replicas = [
+        alias for alias in settings.DATABASE_REPLICAS
+        if not mirrors_primary(alias) and lag_monitor.healthy(alias)
+    ]
+    return random.choice(replicas) if replicas else None
+
+
+@contextmanager
+def replica_reads():
+    """Разрешает чтение с реплик вне запросов API, например в выгрузках"""
+    state = ReplicaState()
+    state.enabled = True
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """
+    Чтение с основной базы внутри блока, даже если запросу разрешены реплики.
+    Нужно там, где прочитанное надолго сохраняется в общий кэш: с отстающей
+    реплики туда попали бы данные старше только что сброшенной версии
+    """
+    state = _state.get()
+    if state is None:
+        yield
+        return
+    enabled, state.enabled = state.enabled, False
+    try:
+        yield
+    finally:
+        state.enabled = enabled
+
+
+def stream_replica_reads(iterable):
+    """
+    Ленивый поток StreamingHttpResponse читается уже после того, как
+    ReplicaMiddleware сбросил состояние запроса, — реплики разрешаются заново
+    """
+    with replica_reads():
+        yield from iterable
+
+
+class ReplicaRouter:
+    """
+    Чтение с реплик только там, где его явно разрешил ReplicaReadMixin.
+    Запись — всегда на основную базу; после записи в том же запросе
+    чтение тоже идет на основную, чтобы видеть свои изменения
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.enabled or state.wrote:
+            return None
+        return choose_replica()
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # реплики содержат те же данные, что и основная база
+        return True
+
+
+# подписанная кука с id пользователя: видна любому воркеру без общего кэша
+PIN_COOKIE = 'db_primary'
+
+
+def is_pinned(request):
+    """Пользователь недавно что-то записал и пока читает с основной базы"""
+    user = getattr(request, 'user', None)
+    if not (user and user.is_authenticated):
+        return False
+    pinned = request.get_signed_cookie(
+        PIN_COOKIE, default=None, salt=PIN_COOKIE, max_age=settings.REPLICA_STICKY_SECONDS
+    )
+    return pinned == str(user.pk)
+
+
+class ReplicaReadMixin:
+    """
+    Действия из replica_actions читают с реплик, если пользователь
+    не в окне REPLICA_STICKY_SECONDS после своей записи
+    """
+    replica_actions = ('list', 'retrieve')
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        state = _state.get()
+        if (state is not None and settings.DATABASE_REPLICAS
+                and self.action in self.replica_actions and not is_pinned(request)):
+            self._replica_enabled = state.enabled
+            state.enabled = True
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        state = _state.get()
+        if state is not None and hasattr(self, '_replica_enabled'):
+            state.enabled = self._replica_enabled
+            del self._replica_enabled
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class ReplicaMiddleware:
+    """
+    Заводит состояние маршрутизации на запрос; если запрос что-то записал,
+    закрепляет пользователя за основной базой на REPLICA_STICKY_SECONDS
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = ReplicaState()
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        user = getattr(request, 'user', None)
+        if state.wrote and user is not None and user.is_authenticated and settings.DATABASE_REPLICAS:
+            response.set_signed_cookie(
+                PIN_COOKIE, user.pk, salt=PIN_COOKIE, max_age=settings.REPLICA_STICKY_SECONDS,
+                httponly=True, samesite='Lax'
+            )
+        return response
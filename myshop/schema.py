@@ -0,0 +1,106 @@
+import hashlib
+import os
+import threading
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from drf_yasg import openapi
+from drf_yasg.codecs import OpenAPICodecJson
+from drf_yasg.generators import OpenAPISchemaGenerator
+from drf_yasg.renderers import SwaggerUIRenderer
+
+API_INFO = openapi.Info(
+    title="Snippets API",
+    default_version='v1',
+    description="Test description",
+    terms_of_service="https://www.google.com/policies/terms/",
+    contact=openapi.Contact(email="contact@snippets.local"),
+    license=openapi.License(name="BSD License"),
+)
+
+
+def generate_schema():
+    """Строит OpenAPI-схему всех эндпоинтов; это дорого, поэтому результат хранится"""
+    schema = OpenAPISchemaGenerator(API_INFO).get_schema(request=None, public=True)
+    return OpenAPICodecJson(validators=[]).encode(schema)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class SchemaArtifact:
+    """
+    Готовая схема в памяти процесса. Берется из файла OPENAPI_SCHEMA_PATH
+    (его пишет manage.py generate_swagger при деплое) и перечитывается при
+    изменении файла; без файла схема строится один раз при первом запросе
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cached = None
+
+    def get(self):
+        """Возвращает (содержимое, ETag)"""
+        path = settings.OPENAPI_SCHEMA_PATH
+        source = (path, _mtime(path) if path else None)
+        cached = self._cached
+        if cached is not None and cached[0] == source:
+            return cached[1], cached[2]
+        with self._lock:
+            cached = self._cached
+            if cached is None or cached[0] != source:
+                if source[1] is not None:
+                    with open(path, 'rb') as file:
+                        content = file.read()
+                else:
+                    content = generate_schema()
+                etag = f'"{hashlib.sha256(content).hexdigest()}"'
+                cached = self._cached = (source, content, etag)
+        return cached[1], cached[2]
+
+    def clear(self):
+        with self._lock:
+            self._cached = None
+
+
+schema_artifact = SchemaArtifact()
+
+
+def schema_json_view(request):
+    """OpenAPI-схема в JSON из памяти, с ETag"""
+    content, etag = schema_artifact.get()
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(content, content_type='application/openapi+json')
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, no_cache=True)
+    return response
+
+
+def swagger_ui_view(request):
+    """
+    Страница Swagger UI без построения схемы: саму схему браузер загружает
+    из openapi-schema (SWAGGER_SETTINGS['SPEC_URL']). drf_yasg строит схему
+    и для этой страницы, поэтому его view здесь не используется
+    """
+    renderer = SwaggerUIRenderer()
+    context = {'request': request}
+    renderer.set_context(context)
+    context.update(title=API_INFO.title, version=API_INFO._default_version)
+    return HttpResponse(render_to_string(renderer.template, context, request), content_type='text/html; charset=utf-8')
+
+
+def health_view(request):
+    """Дешевый ответ для проверок живости и краулеров: без базы и без схемы"""
+    return JsonResponse({
+        'status': 'ok',
+        'docs': reverse('schema-swagger-ui'),
+        'schema': reverse('openapi-schema'),
+    })
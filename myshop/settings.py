@@ -52,6 +52,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'myshop.metrics.MetricsMiddleware',
+    'myshop.routers.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -92,7 +94,43 @@ DATABASES = {
         'HOST': config('DB_HOST'),
         'PORT': config('DB_PORT'),
         'USER': config('DB_USER'),
-        'PASSWORD': config('DB_PASSWORD')
+        'PASSWORD': config('DB_PASSWORD'),
+        # с ENGINE=myshop.postgresql_pool соединения держит пул, CONN_MAX_AGE оставить 0
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', cast=int, default=0), # секунд живет постоянное соединение без пула
+        'CONN_HEALTH_CHECKS': True, # проверять постоянное соединение перед новым запросом
+        'POOL': {
+            'MIN_SIZE': config('DB_POOL_MIN_SIZE', cast=int, default=2), # соединений открыто всегда
+            'MAX_SIZE': config('DB_POOL_MAX_SIZE', cast=int, default=10), # не больше соединений на процесс
+            'TIMEOUT': config('DB_POOL_TIMEOUT', cast=float, default=5), # секунд ждать свободное соединение
+            'MAX_LIFETIME': 1800, # секунд до пересоздания соединения
+            'MAX_IDLE': 300, # секунд простоя до закрытия соединения сверх MIN_SIZE
+            'CHECK_INTERVAL': 30, # соединение, простоявшее дольше (секунд), проверяется перед выдачей
+        },
+    }
+}
+# реплика для чтения каталога; для проверки локально — вторая база SQLite/PostgreSQL
+if config('DB_REPLICA_NAME', default='') or config('DB_REPLICA_HOST', default=''):
+    DATABASES['replica'] = dict(
+        DATABASES['default'],
+        NAME=config('DB_REPLICA_NAME', default=DATABASES['default']['NAME']),
+        HOST=config('DB_REPLICA_HOST', default=DATABASES['default']['HOST']),
+        PORT=config('DB_REPLICA_PORT', default=DATABASES['default']['PORT']),
+        USER=config('DB_REPLICA_USER', default=DATABASES['default']['USER']),
+        PASSWORD=config('DB_REPLICA_PASSWORD', default=DATABASES['default']['PASSWORD']),
+        # в тестах отдельная база не создается: реплика смотрит в тестовую базу мастера
+        TEST={'MIRROR': 'default'},
+    )
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['myshop.routers.ReplicaRouter']
+REPLICA_STICKY_SECONDS = config('REPLICA_STICKY_SECONDS', cast=int, default=10) # секунд пользователь читает с основной базы после своей записи
+REPLICA_MAX_LAG = config('REPLICA_MAX_LAG', cast=float, default=5) # реплика, отставшая сильнее (секунд), не используется
+REPLICA_LAG_CHECK_INTERVAL = 5 # секунд между проверками отставания реплики
+
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'), # для нескольких процессов нужен общий (Redis, Memcached): с LocMemCache поиск видит чужие изменения только после SEARCH_REBUILD_INTERVAL
+        'LOCATION': config('CACHE_LOCATION', default=''),
     }
 }
 
@@ -136,29 +174,76 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 MEDIA_URL = 'products/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'products')
+MEDIA_SERVE = config('MEDIA_SERVE', default='django') # кто отдает файлы: django (FileResponse), x-accel (nginx) или sendfile (Apache/lighttpd)
+MEDIA_ACCEL_PREFIX = config('MEDIA_ACCEL_PREFIX', default='/protected-media/') # internal location nginx, указывающий на MEDIA_ROOT
+MEDIA_CACHE_SECONDS = 24 * 60 * 60 # кэширование файлов, имя которых не задано хэшем содержимого
+MEDIA_BLOB_GRACE = 60 * 60 # секунд после повторной загрузки файл хранилища по хэшу не удаляется; удаление повторяется по истечении срока
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-EMAIL_BACKENDS = 'django.core.mail.backends.smtp.EmailBackend' # класс отвечающий за отправку писем
+EMAIL_BACKEND = config('EMAIL_BACKEND', default='django.core.mail.backends.smtp.EmailBackend') # класс отвечающий за отправку писем
 EMAIL_HOST_USER = config('EMAIL_HOST_USER') # почта с которой отправляются письма
 EMAIL_PORT = config('EMAIL_PORT', default=587)
 EMAIL_HOST = config('EMAIL_HOST') # какой хост используется для отправки писем
 EMAIL_HOST_PASSWORD = config('EMAIL_PASSWORD') # пароль от почты
 EMAIL_USE_TLS = config('EMAIL_USE_TLS', cast=bool) # вид соединения для отправки писем
+EMAIL_OUTBOX_BATCH_SIZE = 100 # сколько писем отправляется через одно SMTP-соединение
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5 # после стольких ошибок письмо помечается неотправленным
+EMAIL_OUTBOX_RETRY_DELAY = 60 # секунд до первой повторной попытки, дальше задержка удваивается
+EMAIL_OUTBOX_CLAIM_TIMEOUT = 10 * 60 # секунд письма числятся за воркером, потом их может забрать другой
 
 AUTH_USER_MODEL = 'registration.User'
 
+REGISTRATION_TOKEN_MODE = config('REGISTRATION_TOKEN_MODE', default='signed') # signed - подписанные токены, code - коды в базе
+ACTIVATION_TOKEN_MAX_AGE = 60 * 60 * 24 * 3 # секунд действует ссылка активации
+RECOVERY_TOKEN_MAX_AGE = 60 * 60 # секунд действует код восстановления пароля
+
 REST_FRAMEWORK = {
 'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'registration.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 3,
     'SEARCH_PARAM': 'q'
 }
+MAX_PAGE_SIZE = config('MAX_PAGE_SIZE', cast=int, default=100) # максимальный размер страницы через ?page_size=
+
+PRODUCT_CACHE = {
+    'BACKEND': config('PRODUCT_CACHE_BACKEND', default='locmem'), # locmem - только для одного процесса: чужие изменения и задачи Celery видны через TIMEOUT; redis - общий
+    'LOCATION': config('PRODUCT_CACHE_LOCATION', default='redis://127.0.0.1:6379/1'),
+    'TIMEOUT': config('PRODUCT_CACHE_TIMEOUT', cast=int, default=60), # секунд живет ответ; с locmem это и предел устаревания
+    'MAX_ENTRIES': 1000,
+}
+
+PRODUCT_LATEST_COMMENTS = 3 # сколько последних комментариев отдается в карточке товара, остальные - /shop/product/<id>/comments/
+EXPORT_CHUNK_SIZE = 2000 # сколько товаров выгрузка читает с сервера за раз
+PRODUCT_PRICE_FACETS = [10000, 30000, 60000, 100000] # границы интервалов цены в фасетах ?facets=true
+CART = {
+    'BACKEND': config('CART_BACKEND', default='locmem'), # locmem или redis
+    'LOCATION': config('CART_LOCATION', default='redis://127.0.0.1:6379/2'),
+    'TTL': 60 * 60 * 24 * 30, # секунд живет корзина без изменений
+}
+
+ORDER_RESERVATION_TTL = config('ORDER_RESERVATION_TTL', cast=int, default=15 * 60) # секунд товар держится за неоплаченным заказом
+
+ROOT_VIEW = config('ROOT_VIEW', default='health') # что отдает корень сайта: health - короткий ответ о состоянии, swagger - документацию
+OPENAPI_SCHEMA_PATH = config('OPENAPI_SCHEMA_PATH', default='') # файл схемы от manage.py generate_swagger <путь> -o, пусто - строить при первом запросе
+SWAGGER_SETTINGS = {
+    'DEFAULT_INFO': 'myshop.schema.API_INFO',
+    'SPEC_URL': 'openapi-schema',
+}
+
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5) # границы гистограммы времени ответа, секунды
+METRICS_SLOW_REQUEST_MS = config('METRICS_SLOW_REQUEST_MS', cast=int, default=500) # запросы дольше пишутся в лог, 0 - не писать
+METRICS_SLOW_QUERIES = 5 # сколько самых долгих SQL-запросов показывать в логе
+METRICS_TOKEN = config('METRICS_TOKEN', default='') # если задан, /metrics требует заголовок Authorization: Bearer <токен>
+
+SEARCH_MAX_RESULTS = 1000 # сколько найденных товаров ранжируется по параметру ?q=
+SEARCH_FUZZY_THRESHOLD = 0.35 # минимальная похожесть по триграммам для исправления опечаток
+SEARCH_REBUILD_INTERVAL = config('SEARCH_REBUILD_INTERVAL', cast=int, default=60) # секунд между полными перестройками индекса, если CACHE_BACKEND не общий для процессов
 
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=120),
@@ -166,6 +251,53 @@ SIMPLE_JWT = {
     'USER_ID_FIELD': 'username',
     'AUTH_HEADER_TYPES': ('Bearer', 'Token'),
 }
+AUTH_USER_CACHE_TIMEOUT = config('AUTH_USER_CACHE_TIMEOUT', cast=int, default=300) # секунд пользователь живет в общем кэше, 0 - без кэша; нужен общий для процессов CACHE_BACKEND (Redis, Memcached), с LocMemCache кэш не включается
+AUTH_USER_CACHE_LOCAL_TIMEOUT = config('AUTH_USER_CACHE_LOCAL_TIMEOUT', cast=int, default=5) # секунд в памяти процесса
+AUTH_USER_CACHE_LOCAL_ENTRIES = 10000 # сколько пользователей держать в памяти процесса
 
 CELERY_BROKER_URL = 'redis://127.0.0.1:6379/0'
-CELERY_RESULT_BACKEND = 'redis://127.0.0.1:6379/0'
\ No newline at end of file
+CELERY_RESULT_BACKEND = 'redis://127.0.0.1:6379/0'
+CELERY_BEAT_SCHEDULE = {
+    'drain-email-outbox': {
+        'task': 'registration.tasks.drain_outbox',
+        'schedule': 60.0,
+    },
+    'persist-carts': {
+        'task': 'shop.tasks.persist_carts',
+        'schedule': 60.0,
+    },
+    'release-expired-reservations': {
+        'task': 'shop.tasks.release_expired_reservations',
+        'schedule': 30.0,
+    },
+    'refresh-similar-products': {
+        'task': 'shop.tasks.refresh_similar_products',
+        'schedule': 300.0,
+    },
+    'rebuild-similar-products': {
+        'task': 'shop.tasks.refresh_similar_products',
+        'schedule': 24 * 60 * 60.0,
+        'kwargs': {'full': True},
+    },
+    'refresh-category-leaderboards': {
+        'task': 'shop.tasks.refresh_category_leaderboards',
+        'schedule': 60.0,
+    },
+    'rebuild-category-leaderboards': {
+        'task': 'shop.tasks.refresh_category_leaderboards',
+        'schedule': 24 * 60 * 60.0,
+        'kwargs': {'full': True},
+    },
+}
+CELERY_TASK_ALWAYS_EAGER = config('CELERY_TASK_ALWAYS_EAGER', cast=bool, default=False) # выполнять задачи сразу, без воркера
+
+RECOMMENDATIONS_TOP_K = 10 # сколько похожих товаров хранить на товар
+RECOMMENDATION_MIN_RATING = 4 # оценка, с которой товар считается понравившимся покупателю
+RECOMMENDATION_MAX_TAG_PRODUCTS = 1000 # тег, стоящий у большего числа товаров, не учитывается в сходстве
+RECOMMENDATION_WEIGHTS = {'tags': 0.5, 'ratings': 0.3, 'category': 0.2} # вклад общих тегов, общих покупателей и категории
+
+LEADERBOARD_SIZE = 20 # сколько лучших товаров хранить на категорию
+LEADERBOARD_PRIOR_COUNT = config('LEADERBOARD_PRIOR_COUNT', cast=int, default=10) # столько средних по каталогу оценок добавляется каждому товару
+
+IMAGE_VARIANT_WIDTHS = (320, 640, 1024) # ширины уменьшенных копий картинок товаров
+IMAGE_PROCESS_WORKERS = config('IMAGE_PROCESS_WORKERS', cast=int, default=os.cpu_count()) # 0 - обрабатывать в процессе воркера
\ No newline at end of file
@@ -0,0 +1,138 @@
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.views.decorators.http import require_safe
+
+# имя файла в хранилище: <каталог>/<2 символа хэша>/<sha256>.<расширение>
+BLOB_NAME = re.compile(r'(?:^|/)[0-9a-f]{2}/(?P<digest>[0-9a-f]{64})(?:\.\w+)?$')
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Файлы хранятся под sha256 содержимого: одинаковые загрузки занимают
+    место один раз и получают одно имя. Хэш считается при записи
+    во временный файл, без повторного чтения загрузки
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._counters = {'saved': 0, 'deduplicated': 0, 'released': 0}
+
+    def get_available_name(self, name, max_length=None):
+        # имя определяет содержимое, подбирать свободное не нужно
+        return name
+
+    def _save(self, name, content):
+        directory = self.path('.incoming')
+        os.makedirs(directory, exist_ok=True)
+        digest = hashlib.sha256()
+        handle, temporary = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    file.write(chunk)
+            digest = digest.hexdigest()
+            extension = os.path.splitext(name)[1].lower()
+            name = posixpath.join(posixpath.dirname(name), digest[:2], f'{digest}{extension}')
+            path = self.path(name)
+            if os.path.exists(path):
+                # свежее время изменения защищает файл от release во время загрузки
+                os.utime(path)
+                os.remove(temporary)
+                counter = 'deduplicated'
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(temporary, self.file_permissions_mode)
+                os.replace(temporary, path)
+                counter = 'saved'
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        with self._lock:
+            self._counters[counter] += 1
+        return name
+
+    def release(self, name):
+        """
+        Удаляет файл, на который больше никто не ссылается. Файл, который
+        недавно сохраняли повторно, остается: ссылка на него может быть
+        в еще не завершенной транзакции
+        """
+        try:
+            modified = os.stat(self.path(name)).st_mtime
+        except OSError:
+            return False
+        if time.time() - modified < settings.MEDIA_BLOB_GRACE:
+            return False
+        self.delete(name)
+        with self._lock:
+            self._counters['released'] += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+blob_storage = ContentAddressedStorage()
+
+
+def get_blob_storage():
+    return blob_storage
+
+
+@require_safe
+def media_view(request, path):
+    """
+    Отдает загруженные файлы. Файлы хранилища по хэшу неизменны и кэшируются
+    навсегда. По MEDIA_SERVE отправку берет на себя веб-сервер (x-accel для
+    nginx, sendfile для Apache/lighttpd), иначе FileResponse отдает файл
+    через wsgi.file_wrapper, то есть sendfile сервера приложения
+    """
+    if any(part.startswith('.') for part in path.split('/')):
+        # .incoming — недописанные загрузки
+        raise Http404
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except ValueError:
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+
+    match = BLOB_NAME.search(path)
+    etag = f'"{match["digest"]}"' if match else None
+    response = get_conditional_response(request, etag=etag) if etag else None
+    if response is None:
+        mode = settings.MEDIA_SERVE
+        content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        if mode == 'x-accel':
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + path
+        elif mode == 'sendfile':
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = full_path
+        else:
+            response = FileResponse(open(full_path, 'rb'))
+    if etag:
+        response['ETag'] = etag
+        patch_cache_control(response, public=True, max_age=365 * 24 * 60 * 60, immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=settings.MEDIA_CACHE_SECONDS)
+    return response
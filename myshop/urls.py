@@ -15,32 +15,21 @@ Including another URLconf
 """
 from distutils.debug import DEBUG
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.conf import settings
-from django.conf.urls.static import static
-from rest_framework import permissions
-from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
 
-schema_view = get_schema_view(
-   openapi.Info(
-      title="Snippets API",
-      default_version='v1',
-      description="Test description",
-      terms_of_service="https://www.google.com/policies/terms/",
-      contact=openapi.Contact(email="contact@snippets.local"),
-      license=openapi.License(name="BSD License"),
-   ),
-   public=True,
-   permission_classes=[permissions.AllowAny],
-)
+from .metrics import metrics_view
+from .schema import health_view, schema_json_view, swagger_ui_view
+from .storage import media_view
 
 urlpatterns = [
-    path('', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
+    path('', swagger_ui_view if settings.ROOT_VIEW == 'swagger' else health_view, name='root'),
+    path('swagger/', swagger_ui_view, name='schema-swagger-ui'),
+    path('openapi.json', schema_json_view, name='openapi-schema'),
+    path('health/', health_view, name='health'),
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('registration/', include('registration.urls')),
     path('shop/', include('shop.urls')),
+    re_path(rf'^{settings.MEDIA_URL.lstrip("/")}(?P<path>.+)$', media_view, name='media'),
 ]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
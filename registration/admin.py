@@ -1,5 +1,14 @@
 from django.contrib import admin
 from django.contrib.auth import get_user_model
 
+from .models import OutgoingEmail
 
-admin.site.register(get_user_model())
\ No newline at end of file
+
+admin.site.register(get_user_model())
+
+
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ['to', 'subject', 'status', 'attempts', 'next_attempt_at', 'sent_at']
+    list_filter = ['status']
+
+admin.site.register(OutgoingEmail, OutgoingEmailAdmin)
\ No newline at end of file
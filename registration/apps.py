@@ -4,3 +4,15 @@ from django.apps import AppConfig
 class RegistrationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'registration'
+
+    def ready(self):
+        from myshop.metrics import registry
+
+        from . import signals  # noqa: F401
+        from .authentication import principal_cache
+        from .tokens import signed_tokens_enabled
+
+        # опечатка в REGISTRATION_TOKEN_MODE видна при запуске, а не на первой регистрации
+        signed_tokens_enabled()
+
+        registry.register_collector('auth_user_cache', principal_cache.stats)
@@ -0,0 +1,154 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+
+class PrincipalCache:
+    """
+    Кэш пользователей для аутентификации в два уровня: короткий кэш
+    в памяти процесса и общий кэш Django (Redis в продакшене).
+    Ключ включает версию пользователя из общего кэша — при выходе,
+    смене пароля или активности версия заменяется новой случайной,
+    и все процессы сразу перестают видеть старую запись.
+    Работает только с кэшем, общим для процессов: с LocMemCache сброс
+    версии не дошел бы до других воркеров, поэтому кэш не включается
+    """
+
+    def __init__(self):
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(('local_hits', 'shared_hits', 'misses'), 0)
+
+    @property
+    def timeout(self):
+        return settings.AUTH_USER_CACHE_TIMEOUT
+
+    @property
+    def enabled(self):
+        return bool(self.timeout) and not isinstance(caches['default'], (LocMemCache, DummyCache))
+
+    @property
+    def local_timeout(self):
+        return settings.AUTH_USER_CACHE_LOCAL_TIMEOUT
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        hits = stats['local_hits'] + stats['shared_hits']
+        total = hits + stats['misses']
+        stats['hit_ratio'] = hits / total if total else 0.0
+        return stats
+
+    def version(self, username):
+        key = f'auth:version:{username}'
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, uuid.uuid4().hex, None)
+            version = cache.get(key)
+        return version
+
+    def invalidate(self, username):
+        cache.set(f'auth:version:{username}', uuid.uuid4().hex, None)
+        with self._lock:
+            self._local.pop(username, None)
+
+    def get(self, username):
+        """Возвращает пользователя или None, если его нет в базе"""
+        if not self.enabled:
+            return self.load(username)
+        version = self.version(username)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._local.get(username)
+            if entry is not None and entry[0] == version and entry[1] > now:
+                self.counters['local_hits'] += 1
+                return self.build(entry[2])
+        key = f'auth:user:{username}:{version}'
+        values = cache.get(key)
+        if values is not None:
+            self._count('shared_hits')
+        else:
+            self._count('misses')
+            user = self.load(username)
+            if user is None:
+                return None
+            values = tuple(getattr(user, field.attname) for field in self.fields())
+            cache.set(key, values, self.timeout)
+        self._remember(username, version, values, now)
+        return self.build(values)
+
+    def _remember(self, username, version, values, now):
+        if not self.local_timeout:
+            return
+        with self._lock:
+            self._local[username] = (version, now + self.local_timeout, values)
+            self._local.move_to_end(username)
+            while len(self._local) > settings.AUTH_USER_CACHE_LOCAL_ENTRIES:
+                self._local.popitem(last=False)
+
+    def fields(self):
+        return get_user_model()._meta.concrete_fields
+
+    def build(self, values):
+        # каждый запрос получает свой экземпляр — его можно менять и сохранять
+        User = get_user_model()
+        return User.from_db('default', [field.attname for field in self.fields()], values)
+
+    def load(self, username):
+        User = get_user_model()
+        return User.objects.filter(**{api_settings.USER_ID_FIELD: username}).first()
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+            for counter in self.counters:
+                self.counters[counter] = 0
+
+
+principal_cache = PrincipalCache()
+
+
+def invalidate_principal(username):
+    """Сбрасывает кэш сразу и еще раз после коммита, чтобы не закэшировать старые данные"""
+    principal_cache.invalidate(username)
+    transaction.on_commit(lambda: principal_cache.invalidate(username))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication, который берет пользователя из кэша вместо запроса к базе"""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        user = principal_cache.get(user_id)
+        if user is None:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        if getattr(api_settings, 'CHECK_REVOKE_TOKEN', False):
+            from rest_framework_simplejwt.utils import get_md5_hash_password
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(
+                    _("The user's password has been changed."), code='password_changed'
+                )
+        return user
@@ -0,0 +1,121 @@
+import logging
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.template.loader import get_template
+from django.utils import timezone
+
+from .models import OutgoingEmail
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def _compiled_template(name):
+    return get_template(name)
+
+
+def render_template(name, context):
+    """Рендерит шаблон письма, компилируя его один раз на процесс"""
+    return _compiled_template(name).render(context)
+
+
+def enqueue_mail(to, subject, body='', html_body=''):
+    """
+    Сохраняет письмо в очередь и после коммита будит воркер.
+    Если брокер недоступен, письмо отправит периодическая задача
+    """
+    email = OutgoingEmail.objects.create(
+        to=to, subject=subject, body=body, html_body=html_body
+    )
+    transaction.on_commit(_wake_worker)
+    return email
+
+
+def _wake_worker():
+    from .tasks import drain_outbox
+    try:
+        drain_outbox.delay()
+    except Exception:
+        logger.warning('Не удалось поставить отправку писем в очередь', exc_info=True)
+
+
+def _build_message(email, connection):
+    message = EmailMultiAlternatives(
+        subject=email.subject,
+        body=email.body,
+        from_email=settings.EMAIL_HOST_USER,
+        to=[email.to],
+        connection=connection,
+    )
+    if email.html_body:
+        message.attach_alternative(email.html_body, 'text/html')
+    return message
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def claim_outbox_batch(batch_size):
+    """
+    Забирает пачку готовых к отправке писем короткой транзакцией: помечает
+    их отправляемыми и сдвигает next_attempt_at на EMAIL_OUTBOX_CLAIM_TIMEOUT.
+    Письма упавшего воркера по истечении этого срока заберет следующий
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True).filter(
+                status__in=(OutgoingEmail.PENDING, OutgoingEmail.SENDING), next_attempt_at__lte=now
+            ).order_by('next_attempt_at')[:batch_size]
+        )
+        if emails:
+            OutgoingEmail.objects.filter(pk__in=[email.pk for email in emails]).update(
+                status=OutgoingEmail.SENDING,
+                next_attempt_at=now + timedelta(seconds=settings.EMAIL_OUTBOX_CLAIM_TIMEOUT)
+            )
+    return emails
+
+
+def send_outbox_batch(batch_size=None):
+    """
+    Отправляет пачку готовых к отправке писем через одно SMTP-соединение.
+    SMTP работает вне транзакции — строки очереди не заблокированы на время
+    отправки. Возвращает число обработанных писем
+    """
+    emails = claim_outbox_batch(batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE)
+    if not emails:
+        return 0
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except Exception as error:
+        connection = None
+        connection_error = error
+    for email in emails:
+        try:
+            if connection is None:
+                raise connection_error
+            connection.send_messages([_build_message(email, connection)])
+        except Exception as error:
+            email.attempts += 1
+            email.last_error = repr(error)
+            if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+                email.status = OutgoingEmail.FAILED
+            else:
+                email.status = OutgoingEmail.PENDING
+                email.next_attempt_at = timezone.now() + retry_delay(email.attempts)
+        else:
+            email.status = OutgoingEmail.SENT
+            email.sent_at = timezone.now()
+            email.last_error = ''
+    if connection is not None:
+        connection.close()
+    OutgoingEmail.objects.bulk_update(
+        emails, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at']
+    )
+    return len(emails)
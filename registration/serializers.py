@@ -1,9 +1,9 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from django.core.mail import send_mail
-from django.conf import settings
 
+from .outbox import enqueue_mail
 from .tasks import send_activation_code
+from .tokens import activation_token, recovery_token, signed_tokens_enabled
 
 User = get_user_model()
 
@@ -44,8 +44,12 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         user = User.objects.create_user(**validated_data)
-        user.create_activation_code()
-        send_activation_code(user.email, user.activation_code)
+        if signed_tokens_enabled():
+            code = activation_token.make_token(user)
+        else:
+            user.create_activation_code()
+            code = user.activation_code
+        send_activation_code(user.email, code)
         return user
 
 
@@ -88,12 +92,15 @@ class RecoveryPasswordSerializer(serializers.Serializer):
     def send_code(self):
         email = self.validated_data.get('email')
         user = User.objects.get(email=email)
-        user.create_activation_code()
-        send_mail(
+        if signed_tokens_enabled():
+            code = recovery_token.make_token(user)
+        else:
+            user.create_activation_code()
+            code = user.activation_code
+        enqueue_mail(
+            to=email,
             subject='Password recovery',
-            message=f'Your password recovery code {user.activation_code}',
-            from_email=settings.EMAIL_HOST_USER,
-            recipient_list=[email]
+            body=f'Your password recovery code {code}'
             )
 
 class SetRecoveredPasswordSerializer(serializers.Serializer):
@@ -102,17 +109,10 @@ class SetRecoveredPasswordSerializer(serializers.Serializer):
         max_length=255,
         validators=[email_validator]
         )
-    code = serializers.CharField(min_length=1, max_length=8, required=True)
+    code = serializers.CharField(min_length=1, max_length=255, required=True)
     new_password = serializers.CharField(max_length=128, required=True)
     new_pass_confirm = serializers.CharField(max_length=128, required=True)
 
-    def validate_code(self, code):
-        if not User.objects.filter(activation_code=code).exists():
-            raise serializers.ValidationError(
-                'Code is incorrect'
-            )
-        return code
-
     def validate(self, attrs):
         new_password = attrs.get('new_password')
         new_pass_confirm = attrs.get('new_pass_confirm')
@@ -120,11 +120,20 @@ class SetRecoveredPasswordSerializer(serializers.Serializer):
             raise serializers.ValidationError(
                 'Passwords do not match'
             )
+        email, code = attrs.get('email'), attrs.get('code')
+        user = recovery_token.check_token(code)
+        if user is None or user.email != email:
+            # коды, выданные до перехода на подписанные токены
+            user = User.objects.filter(email=email, activation_code=code).first()
+        if user is None:
+            raise serializers.ValidationError(
+                {'code': 'Code is incorrect'}
+            )
+        attrs['user'] = user
         return attrs
 
     def set_new_password(self):
-        email = self.validated_data.get('email')
-        user = User.objects.get(email=email)
+        user = self.validated_data.get('user')
         new_password = self.validated_data.get('new_password')
         user.set_password(new_password)
         user.activation_code = ''
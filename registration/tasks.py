@@ -1,20 +1,18 @@
-from django.core.mail import send_mail
-from django.conf import settings
-from django.template.loader import render_to_string
 from myshop.celery import app
+from .outbox import enqueue_mail, render_template, send_outbox_batch
+
 
 @app.task
 def send_activation_code(email, activation_code):
     activation_link = f'http://localhost:8000/registration/activate/{activation_code}/'
-    html_message = render_to_string(
+    html_message = render_template(
         'code_mail.html',
         {'activation_link': activation_link}
     )
-    send_mail(
-        'Activate your account!',
-        '',
-        settings.EMAIL_HOST_USER,
-        [email],
-        html_message=html_message,
-        fail_silently=False
-    )
\ No newline at end of file
+    enqueue_mail(email, 'Activate your account!', html_body=html_message)
+
+
+@app.task
+def drain_outbox():
+    while send_outbox_batch():
+        pass
@@ -1,3 +1,266 @@
-from django.test import TestCase
+import socketserver
+import tempfile
+import threading
+from datetime import timedelta
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIRequestFactory, APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .authentication import CachedJWTAuthentication, principal_cache
+from .models import OutgoingEmail
+from .outbox import claim_outbox_batch, enqueue_mail, send_outbox_batch
+from .tokens import activation_token, recovery_token, signed_tokens_enabled
+
+User = get_user_model()
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Минимальный SMTP-сервер: принимает письма и складывает их в память"""
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost')
+        in_data, lines = False, []
+        for raw in self.rfile:
+            line = raw.decode().rstrip('\r\n')
+            if in_data:
+                if line == '.':
+                    self.server.messages.append('\n'.join(lines))
+                    in_data, lines = False, []
+                    self.reply('250 OK')
+                else:
+                    lines.append(line)
+                continue
+            command = line[:4].upper()
+            if command == 'RCPT' and 'reject' in line:
+                self.reply('550 No such user')
+            elif command == 'DATA':
+                in_data = True
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.connections = 0
+        self.messages = []
+
+
+class OutboxTest(TestCase):
+    def setUp(self):
+        self.smtp = LocalSMTPServer()
+        threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+        self.addCleanup(self.smtp.server_close)
+        self.addCleanup(self.smtp.shutdown)
+        settings = override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=self.smtp.server_address[1],
+            EMAIL_HOST_PASSWORD='',
+            EMAIL_USE_TLS=False,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_batch_is_sent_over_one_connection(self):
+        for n in range(5):
+            enqueue_mail(f'user{n}@example.com', 'Hello', body='text', html_body='<b>html</b>')
+        self.assertEqual(send_outbox_batch(), 5)
+        self.assertEqual(self.smtp.connections, 1)
+        self.assertEqual(len(self.smtp.messages), 5)
+        self.assertEqual(OutgoingEmail.objects.filter(status=OutgoingEmail.SENT).count(), 5)
+        self.assertEqual(send_outbox_batch(), 0)
+
+    def test_failed_message_is_retried_with_backoff(self):
+        email = enqueue_mail('reject@example.com', 'Hello', body='text')
+        enqueue_mail('ok@example.com', 'Hello', body='text')
+        send_outbox_batch()
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutgoingEmail.PENDING, 1))
+        self.assertGreater(email.next_attempt_at, timezone.now())
+        self.assertEqual(len(self.smtp.messages), 1)
+
+        with self.settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2):
+            OutgoingEmail.objects.filter(pk=email.pk).update(
+                next_attempt_at=timezone.now() - timedelta(seconds=1)
+            )
+            send_outbox_batch()
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutgoingEmail.FAILED, 2))
+
+
+    def test_claimed_messages_wait_for_claim_to_expire(self):
+        enqueue_mail('user@example.com', 'Hello', body='text')
+        self.assertEqual(len(claim_outbox_batch(10)), 1)
+        self.assertEqual(OutgoingEmail.objects.get().status, OutgoingEmail.SENDING)
+        # письмо за другим воркером: второй его не отправляет
+        self.assertEqual(send_outbox_batch(), 0)
+
+        # воркер не отчитался за отведенный срок — письмо забирает следующий
+        OutgoingEmail.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(send_outbox_batch(), 1)
+        self.assertEqual(OutgoingEmail.objects.get().status, OutgoingEmail.SENT)
+        self.assertEqual(len(self.smtp.messages), 1)
+
+
+class RegistrationOutboxTest(APITestCase):
+    def test_registration_enqueues_activation_email(self):
+        response = self.client.post('/registration/register/', {
+            'username': 'newbie',
+            'email': 'newbie@example.com',
+            'password': 'Strong-pass-123',
+            'password_confirm': 'Strong-pass-123',
+        })
+        self.assertEqual(response.status_code, 201)
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.to, 'newbie@example.com')
+        self.assertIn('/registration/activate/', email.html_body)
+
+
+class SignedTokenTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='newbie', email='newbie@example.com', password='Old-pass-123'
+        )
+
+    def test_activation_token_is_single_use(self):
+        token = activation_token.make_token(self.user)
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/registration/activate/{token}/')
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.is_active)
+        self.assertEqual(self.client.get(f'/registration/activate/{token}/').status_code, 404)
+
+    def test_expired_and_forged_tokens_are_rejected(self):
+        token = activation_token.make_token(self.user)
+        with self.settings(ACTIVATION_TOKEN_MAX_AGE=-1):
+            self.assertIsNone(activation_token.check_token(token))
+        self.assertIsNone(activation_token.check_token(token[:-1] + 'x'))
+        self.assertIsNone(recovery_token.check_token(token))
+
+    def test_legacy_activation_code_still_works(self):
+        self.user.create_activation_code()
+        response = self.client.get(f'/registration/activate/{self.user.activation_code}/')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(REGISTRATION_TOKEN_MODE='code')
+    def test_code_mode_stores_recovery_code(self):
+        self.client.post('/registration/recovery-password/', {'email': 'newbie@example.com'})
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.activation_code)
+        self.assertEqual(self.password_reset(self.user.activation_code).status_code, 200)
+
+    def test_unknown_token_mode_is_rejected(self):
+        with self.settings(REGISTRATION_TOKEN_MODE='legacy'), self.assertRaises(ImproperlyConfigured):
+            signed_tokens_enabled()
+
+    def password_reset(self, code, email='newbie@example.com'):
+        return self.client.post('/registration/set-recovered-password/', {
+            'email': email,
+            'code': code,
+            'new_password': 'New-pass-123',
+            'new_pass_confirm': 'New-pass-123',
+        })
+
+    def test_recovery_token_resets_password_once(self):
+        self.client.post('/registration/recovery-password/', {'email': 'newbie@example.com'})
+        body = OutgoingEmail.objects.get().body
+        token = body.rsplit(' ', 1)[1]
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.activation_code, '')
+
+        self.assertEqual(self.password_reset(token).status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('New-pass-123'))
+        self.assertEqual(self.password_reset(token).status_code, 400)
+
+    def test_recovery_code_is_bound_to_email(self):
+        User.objects.create_user(username='other', email='other@example.com', password='x')
+        self.user.create_activation_code()
+        response = self.password_reset(self.user.activation_code, email='other@example.com')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.password_reset(self.user.activation_code).status_code, 200)
+
+
+# кэш пользователей работает только с кэшем, общим для процессов
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': tempfile.mkdtemp(),
+}})
+class CachedJWTAuthenticationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        principal_cache.clear()
+        self.user = User.objects.create_user(
+            username='buyer', email='buyer@example.com', password='Old-pass-123', is_active=True
+        )
+        self.request = APIRequestFactory().get(
+            '/', HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}'
+        )
+
+    def authenticate(self):
+        return CachedJWTAuthentication().authenticate(self.request)[0]
+
+    def test_user_is_loaded_from_database_once(self):
+        with self.assertNumQueries(1):
+            self.authenticate()
+        with self.assertNumQueries(0):
+            user = self.authenticate()
+        self.assertEqual(user, self.user)
+        self.assertIsNot(user, self.authenticate())
+        stats = principal_cache.stats()
+        self.assertEqual((stats['local_hits'], stats['misses']), (2, 1))
+
+    def test_shared_cache_is_used_when_local_entry_is_missing(self):
+        self.authenticate()
+        principal_cache._local.clear()
+        with self.assertNumQueries(0):
+            self.authenticate()
+        self.assertEqual(principal_cache.stats()['shared_hits'], 1)
+
+    def test_per_process_cache_is_not_used(self):
+        with override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }}):
+            self.authenticate()
+            with self.assertNumQueries(1):
+                self.authenticate()
+
+    def test_password_change_and_deactivation_invalidate_cache(self):
+        self.authenticate()
+        self.user.set_password('New-pass-123')
+        self.user.save()
+        self.assertTrue(self.authenticate().check_password('New-pass-123'))
+
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_deleted_account_is_rejected(self):
+        self.authenticate()
+        self.client.delete(
+            '/registration/delete-account/',
+            HTTP_AUTHORIZATION=self.request.META['HTTP_AUTHORIZATION']
+        )
+        self.assertFalse(User.objects.filter(pk='buyer').exists())
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
@@ -0,0 +1,62 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+
+class SignedTokenGenerator:
+    """
+    Подписанный токен с ограниченным сроком жизни: внутри имя пользователя
+    и отпечаток его состояния. Выдача токена ничего не пишет в базу,
+    проверка — одно чтение по первичному ключу. Токен перестает
+    действовать, как только меняется пароль, активность или last_login
+    """
+
+    def __init__(self, salt, max_age_setting):
+        self.salt = salt
+        self.max_age_setting = max_age_setting
+
+    @property
+    def max_age(self):
+        return getattr(settings, self.max_age_setting)
+
+    def fingerprint(self, user):
+        state = f'{user.pk}|{user.password}|{user.is_active}|{user.last_login}'
+        return salted_hmac(self.salt, state).hexdigest()[:20]
+
+    def make_token(self, user):
+        return signing.dumps(
+            {'u': user.pk, 'f': self.fingerprint(user)},
+            salt=self.salt,
+            compress=True
+        )
+
+    def check_token(self, token):
+        """Возвращает пользователя или None, если токен неверный или устарел"""
+        try:
+            payload = signing.loads(token, salt=self.salt, max_age=self.max_age)
+            username, fingerprint = payload['u'], payload['f']
+        except (signing.BadSignature, KeyError, TypeError):
+            return None
+        user = get_user_model().objects.filter(pk=username).first()
+        if user is None or not constant_time_compare(self.fingerprint(user), fingerprint):
+            return None
+        return user
+
+
+activation_token = SignedTokenGenerator('registration.activation', 'ACTIVATION_TOKEN_MAX_AGE')
+recovery_token = SignedTokenGenerator('registration.recovery', 'RECOVERY_TOKEN_MAX_AGE')
+
+
+TOKEN_MODES = ('signed', 'code')
+
+
+def signed_tokens_enabled():
+    """signed — подписанные токены, code — коды, сохраненные у пользователя"""
+    mode = settings.REGISTRATION_TOKEN_MODE
+    if mode not in TOKEN_MODES:
+        raise ImproperlyConfigured(
+            f'REGISTRATION_TOKEN_MODE должен быть одним из {", ".join(TOKEN_MODES)}, а не {mode!r}'
+        )
+    return mode == 'signed'
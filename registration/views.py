@@ -7,6 +7,8 @@ from rest_framework.authtoken.models import Token
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework.permissions import IsAuthenticated
 
+from .authentication import invalidate_principal
+from .tokens import activation_token
 from .serializers import(
     UserRegistrationSerializer,
     PasswordChangeSerializer,
@@ -32,7 +34,10 @@ class RegistrationView(APIView):
 
 class AccountActivationView(APIView):
     def get(self, request, activation_code):
-        user = User.objects.filter(activation_code=activation_code).first()
+        user = activation_token.check_token(activation_code)
+        if user is None and len(activation_code) <= 8:
+            # коды, выданные до перехода на подписанные токены
+            user = User.objects.filter(activation_code=activation_code).first()
         if not user:
             return Response(
                 'Page not found',
@@ -86,6 +91,7 @@ class DeleteAccountView(APIView):
     def delete(self, request: Request):
         username = request.user.username
         User.objects.filter(username=username).delete()
+        invalidate_principal(username)
         return Response(
             'Account deleted succsessfully',
             status=status.HTTP_204_NO_CONTENT
@@ -98,6 +104,7 @@ class LogoutView(APIView):
     def delete(self, request: Request):
         user = request.user
         Token.objects.filter(user=user).delete()
+        invalidate_principal(user.pk)
         return Response(
             'Вы вышли из учетной записи. До свидания!',
             status=status.HTTP_200_OK
@@ -5,7 +5,7 @@ from .models import Category, Product, ProductImage, Tag, Comment
 admin.site.register((Tag, Comment))
 
 class CategoryAdmin(admin.ModelAdmin):
-    list_display = ['name', 'slug']
+    list_display = ['name', 'slug', 'parent']
     prepopulated_fields = {'slug': ('name',)}
 
 admin.site.register(Category, CategoryAdmin)
@@ -23,4 +23,10 @@ class ProductAdmin(admin.ModelAdmin):
     prepopulated_fields = {'slug': ('name',)}
     inlines = [TabularInLineImages]
 
+    def save_model(self, request, obj, form, change):
+        if not change:
+            return super().save_model(request, obj, form, change)
+        # только измененные в форме поля, как и в API
+        obj.save(update_fields=[name for name in form.changed_data if name != 'tag'])
+
 admin.site.register(Product, ProductAdmin)
\ No newline at end of file
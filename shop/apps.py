@@ -4,3 +4,16 @@ from django.apps import AppConfig
 class ShopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shop'
+
+    def ready(self):
+        from myshop.metrics import registry
+        from myshop.pool import pool_stats
+        from myshop.storage import blob_storage
+
+        from . import signals  # noqa: F401
+        from .response_cache import response_cache
+
+        response_cache.warn_if_local()
+        registry.register_collector('product_cache', response_cache.stats)
+        registry.register_collector('db_pool', pool_stats)
+        registry.register_collector('media_blobs', blob_storage.stats)
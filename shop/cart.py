@@ -0,0 +1,447 @@
+import json
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+
+# служебное поле: отличает пустую корзину от отсутствующей в хранилище
+MARKER = '_v'
+
+# Изменение количества одной позиции с ограничением по остатку.
+# KEYS[1] - корзина; ARGV: товар, количество, максимум, прибавлять ли, TTL
+CHANGE_SCRIPT = """
+local quantity = tonumber(ARGV[2])
+if ARGV[4] == '1' then
+    quantity = quantity + tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+end
+local cap = tonumber(ARGV[3])
+if quantity > cap then quantity = cap end
+if quantity <= 0 then
+    quantity = 0
+    redis.call('HDEL', KEYS[1], ARGV[1])
+else
+    redis.call('HSET', KEYS[1], ARGV[1], quantity)
+end
+redis.call('HSET', KEYS[1], '_v', '1')
+if tonumber(ARGV[5]) > 0 then redis.call('EXPIRE', KEYS[1], ARGV[5]) end
+return quantity
+"""
+
+# Перенос позиций из KEYS[1] в KEYS[2] с ограничением по остатку.
+# ARGV: TTL, затем тройки товар, количество, максимум
+MERGE_SCRIPT = """
+for i = 2, #ARGV, 3 do
+    local quantity = tonumber(ARGV[i + 1]) + tonumber(redis.call('HGET', KEYS[2], ARGV[i]) or '0')
+    local cap = tonumber(ARGV[i + 2])
+    if quantity > cap then quantity = cap end
+    if quantity > 0 then redis.call('HSET', KEYS[2], ARGV[i], quantity) end
+end
+redis.call('HSET', KEYS[2], '_v', '1')
+if tonumber(ARGV[1]) > 0 then redis.call('EXPIRE', KEYS[2], ARGV[1]) end
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+# Забирает содержимое корзины, оставляя пустую, но загруженную корзину:
+# иначе items() поднимет из базы старое содержимое. ARGV: TTL
+TAKE_SCRIPT = """
+local values = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], '_v', '1')
+if tonumber(ARGV[1]) > 0 then redis.call('EXPIRE', KEYS[1], ARGV[1]) end
+return values
+"""
+
+
+class LocMemCartStore:
+    """Хранилище корзин в памяти процесса — для тестов и разработки"""
+
+    def __init__(self, **kwargs):
+        self._hashes = {}
+        self._sets = {}
+        self._expires = {}
+        self._lock = threading.RLock()
+
+    def _hash(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires < time.monotonic():
+            self._hashes.pop(key, None)
+            self._expires.pop(key, None)
+        return self._hashes.get(key)
+
+    def _touch(self, key, ttl):
+        if ttl:
+            self._expires[key] = time.monotonic() + ttl
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._hash(key) or {})
+
+    def hmget(self, key, fields):
+        with self._lock:
+            values = self._hash(key) or {}
+            return [values.get(field) for field in fields]
+
+    def hset(self, key, mapping):
+        with self._lock:
+            self._hash(key)
+            self._hashes.setdefault(key, {}).update(mapping)
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            values = self._hash(key) or {}
+            for field in fields:
+                values.pop(field, None)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._hashes.pop(key, None)
+                self._expires.pop(key, None)
+
+    def sadd(self, key, *members):
+        with self._lock:
+            self._sets.setdefault(key, set()).update(members)
+
+    def spop(self, key, count):
+        with self._lock:
+            members = self._sets.get(key, set())
+            return [members.pop() for _ in range(min(count, len(members)))]
+
+    def change(self, key, field, quantity, cap, increment, ttl):
+        with self._lock:
+            values = self._hashes.setdefault(key, self._hash(key) or {})
+            if increment:
+                quantity += int(values.get(field, 0))
+            quantity = max(min(quantity, cap), 0)
+            if quantity:
+                values[field] = str(quantity)
+            else:
+                values.pop(field, None)
+            values[MARKER] = '1'
+            self._touch(key, ttl)
+            return quantity
+
+    def merge(self, source, target, items, ttl):
+        with self._lock:
+            values = self._hashes.setdefault(target, self._hash(target) or {})
+            for field, quantity, cap in items:
+                quantity = min(quantity + int(values.get(field, 0)), cap)
+                if quantity > 0:
+                    values[field] = str(quantity)
+            values[MARKER] = '1'
+            self._touch(target, ttl)
+            self._hashes.pop(source, None)
+
+    def take(self, key, ttl):
+        with self._lock:
+            values = self._hash(key) or {}
+            self._hashes[key] = {MARKER: '1'}
+            self._expires.pop(key, None)
+            self._touch(key, ttl)
+            return values
+
+    def clear(self):
+        with self._lock:
+            self._hashes.clear()
+            self._sets.clear()
+            self._expires.clear()
+
+
+class RedisCartStore:
+    """Корзины в хешах Redis, составные операции — Lua-скриптами"""
+
+    def __init__(self, location, prefix='shop', **kwargs):
+        import redis
+        self.client = redis.Redis.from_url(location, decode_responses=True)
+        self.prefix = prefix
+        self._change = self.client.register_script(CHANGE_SCRIPT)
+        self._merge = self.client.register_script(MERGE_SCRIPT)
+        self._take = self.client.register_script(TAKE_SCRIPT)
+
+    def _key(self, key):
+        return f'{self.prefix}:{key}'
+
+    def hgetall(self, key):
+        return self.client.hgetall(self._key(key))
+
+    def hmget(self, key, fields):
+        return self.client.hmget(self._key(key), fields) if fields else []
+
+    def hset(self, key, mapping):
+        self.client.hset(self._key(key), mapping=mapping)
+
+    def hdel(self, key, *fields):
+        self.client.hdel(self._key(key), *fields)
+
+    def delete(self, *keys):
+        self.client.delete(*[self._key(key) for key in keys])
+
+    def sadd(self, key, *members):
+        self.client.sadd(self._key(key), *members)
+
+    def spop(self, key, count):
+        return self.client.spop(self._key(key), count) or []
+
+    def change(self, key, field, quantity, cap, increment, ttl):
+        return int(self._change(
+            keys=[self._key(key)],
+            args=[field, quantity, cap, int(increment), ttl or 0]
+        ))
+
+    def merge(self, source, target, items, ttl):
+        args = [ttl or 0]
+        for item in items:
+            args.extend(item)
+        self._merge(keys=[self._key(source), self._key(target)], args=args)
+
+    def take(self, key, ttl):
+        values = self._take(keys=[self._key(key)], args=[ttl or 0])
+        return dict(zip(values[::2], values[1::2]))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self._key('cart*')))
+        if keys:
+            self.client.delete(*keys)
+
+
+STORES = {
+    'locmem': LocMemCartStore,
+    'redis': RedisCartStore,
+}
+
+
+class CartError(Exception):
+    pass
+
+
+class CartService:
+    """
+    Корзины: количество товаров в хеше cart:<владелец>, цены и остатки —
+    в общем хеше снимков товаров. Просмотр корзины обходится без запросов
+    к базе; корзины пользователей сбрасываются в базу периодической задачей
+    """
+    SNAPSHOTS_KEY = 'cart:products'
+    DIRTY_KEY = 'cart:dirty'
+
+    def __init__(self, store, ttl=None):
+        self.store = store
+        self.ttl = ttl
+
+    @classmethod
+    def from_settings(cls):
+        options = dict(getattr(settings, 'CART', {}))
+        store_class = STORES[options.pop('BACKEND', 'locmem')]
+        return cls(store_class(location=options.get('LOCATION')), ttl=options.get('TTL'))
+
+    @staticmethod
+    def user_owner(user):
+        return f'user:{user.pk}'
+
+    @staticmethod
+    def anonymous_owner(cart_id):
+        return f'anon:{cart_id}'
+
+    def key(self, owner):
+        return f'cart:{owner}'
+
+    # снимки товаров
+
+    @staticmethod
+    def snapshot(product):
+        return json.dumps({
+            'name': product.name,
+            'slug': product.slug,
+            'price': f'{Decimal(product.price):.2f}',
+            'stock': product.stock,
+            'available': product.available,
+        })
+
+    def store_snapshots(self, products):
+        if products:
+            self.store.hset(self.SNAPSHOTS_KEY, {
+                str(product.pk): self.snapshot(product) for product in products
+            })
+
+    def refresh_snapshots(self, products):
+        """Обновляет снимки только тех товаров, которые уже лежат в корзинах"""
+        cached = self.store.hmget(self.SNAPSHOTS_KEY, [str(product.pk) for product in products])
+        self.store_snapshots([
+            product for product, value in zip(products, cached) if value is not None
+        ])
+
+    def forget_snapshots(self, product_ids):
+        if product_ids:
+            self.store.hdel(self.SNAPSHOTS_KEY, *[str(pk) for pk in product_ids])
+
+    def snapshots(self, product_ids):
+        """Снимки из хранилища; недостающие читаются из базы одним запросом"""
+        from .models import Product
+        product_ids = [str(pk) for pk in product_ids]
+        values = dict(zip(product_ids, self.store.hmget(self.SNAPSHOTS_KEY, product_ids)))
+        missing = [pk for pk, value in values.items() if value is None]
+        if missing:
+            products = list(Product.objects.filter(pk__in=missing).only(
+                'name', 'slug', 'price', 'stock', 'available'
+            ))
+            self.store_snapshots(products)
+            values.update({str(product.pk): self.snapshot(product) for product in products})
+        return {
+            int(pk): json.loads(value)
+            for pk, value in values.items() if value is not None
+        }
+
+    @staticmethod
+    def cap(snapshot):
+        return snapshot['stock'] if snapshot['available'] else 0
+
+    # операции с корзиной
+
+    def items(self, owner):
+        values = self.store.hgetall(self.key(owner))
+        if not values and owner.startswith('user:'):
+            values = self.load(owner)
+        return {int(pk): int(quantity) for pk, quantity in values.items() if pk != MARKER}
+
+    def ensure_loaded(self, owner):
+        if owner.startswith('user:') and self.store.hmget(self.key(owner), [MARKER])[0] is None:
+            self.load(owner)
+
+    def _change(self, owner, product_id, quantity, increment):
+        snapshot = self.snapshots([product_id]).get(int(product_id))
+        if snapshot is None:
+            raise CartError('Товар не найден')
+        if quantity > 0 and not self.cap(snapshot):
+            raise CartError('Товара нет в наличии')
+        self.ensure_loaded(owner)
+        result = self.store.change(
+            self.key(owner), str(product_id), quantity, self.cap(snapshot), increment, self.ttl
+        )
+        self.mark_dirty(owner)
+        return result
+
+    def add(self, owner, product_id, quantity=1):
+        return self._change(owner, product_id, quantity, increment=True)
+
+    def update(self, owner, product_id, quantity):
+        return self._change(owner, product_id, quantity, increment=False)
+
+    def remove(self, owner, product_id):
+        self.ensure_loaded(owner)
+        self.store.hdel(self.key(owner), str(product_id))
+        self.mark_dirty(owner)
+
+    def take(self, owner):
+        """
+        Забирает позиции корзины одной операцией хранилища: повторный запрос
+        оформления получит пустую корзину, а добавленное после — останется
+        """
+        self.ensure_loaded(owner)
+        values = self.store.take(self.key(owner), self.ttl)
+        self.mark_dirty(owner)
+        return {int(pk): int(quantity) for pk, quantity in values.items() if pk != MARKER}
+
+    def restore(self, owner, items):
+        """Возвращает забранные позиции, если заказ не создан, не теряя добавленное за это время"""
+        snapshots = self.snapshots(items)
+        for pk, quantity in items.items():
+            if pk in snapshots:
+                # остаток мог уменьшиться, но свое количество покупатель не теряет
+                cap = max(self.cap(snapshots[pk]), quantity)
+                self.store.change(self.key(owner), str(pk), quantity, cap, True, self.ttl)
+        self.mark_dirty(owner)
+
+    def merge(self, source, target):
+        """Переносит анонимную корзину в корзину пользователя"""
+        items = self.items(source)
+        if not items:
+            return
+        self.ensure_loaded(target)
+        snapshots = self.snapshots(items)
+        self.store.merge(self.key(source), self.key(target), [
+            (str(pk), quantity, self.cap(snapshots[pk]))
+            for pk, quantity in items.items() if pk in snapshots
+        ], self.ttl)
+        self.mark_dirty(target)
+
+    def view(self, owner):
+        items = self.items(owner)
+        snapshots = self.snapshots(items)
+        lines, total_quantity, total_price = [], 0, Decimal('0')
+        for pk, quantity in sorted(items.items()):
+            snapshot = snapshots.get(pk)
+            if snapshot is None:
+                continue
+            price = Decimal(snapshot['price'])
+            subtotal = price * quantity
+            lines.append({
+                'product': pk,
+                'name': snapshot['name'],
+                'slug': snapshot['slug'],
+                'price': snapshot['price'],
+                'quantity': quantity,
+                'subtotal': str(subtotal),
+                'in_stock': snapshot['available'] and snapshot['stock'] >= quantity,
+            })
+            total_quantity += quantity
+            total_price += subtotal
+        return {
+            'items': lines,
+            'total_quantity': total_quantity,
+            'total_price': str(total_price),
+        }
+
+    # сохранение в базу
+
+    def mark_dirty(self, owner):
+        if owner.startswith('user:'):
+            self.store.sadd(self.DIRTY_KEY, owner)
+
+    def load(self, owner):
+        """Поднимает корзину пользователя из базы, если ее нет в хранилище"""
+        from .models import CartItem
+        username = owner.split(':', 1)[1]
+        values = {
+            str(product_id): str(quantity)
+            for product_id, quantity in CartItem.objects.filter(
+                cart__user_id=username
+            ).values_list('product_id', 'quantity')
+        }
+        values[MARKER] = '1'
+        self.store.hset(self.key(owner), values)
+        return values
+
+    def persist(self, owner):
+        from .models import Cart, CartItem, Product
+        username = owner.split(':', 1)[1]
+        items = self.items(owner)
+        existing = set(Product.objects.filter(pk__in=items).values_list('pk', flat=True))
+        with transaction.atomic():
+            cart, _ = Cart.objects.get_or_create(user_id=username)
+            CartItem.objects.filter(cart=cart).exclude(product_id__in=existing).delete()
+            CartItem.objects.bulk_create(
+                [
+                    CartItem(cart=cart, product_id=pk, quantity=quantity)
+                    for pk, quantity in items.items() if pk in existing
+                ],
+                update_conflicts=True,
+                unique_fields=['cart_id', 'product_id'],
+                update_fields=['quantity']
+            )
+            cart.save(update_fields=['updated'])
+
+    def persist_dirty(self, batch_size=100):
+        from .models import User
+        owners = self.store.spop(self.DIRTY_KEY, batch_size)
+        users = set(User.objects.filter(
+            pk__in=[owner.split(':', 1)[1] for owner in owners]
+        ).values_list('pk', flat=True))
+        for owner in owners:
+            if owner.split(':', 1)[1] in users:
+                self.persist(owner)
+        return len(owners)
+
+
+cart_service = CartService.from_settings()
@@ -0,0 +1,198 @@
+from collections import Counter, defaultdict
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q
+from django.utils import timezone
+
+from .models import Category, CategoryClosure, CategoryStats
+
+STATS_FIELDS = ['product_count', 'available_count', 'min_price', 'max_price', 'updated']
+
+
+def insert_category_node(category):
+    """Новая категория: ссылка на себя и по ссылке от каждого предка родителя"""
+    links = [CategoryClosure(ancestor_id=category.pk, descendant_id=category.pk, depth=0)]
+    if category.parent_id is not None:
+        links += [
+            CategoryClosure(ancestor_id=ancestor_id, descendant_id=category.pk, depth=depth + 1)
+            for ancestor_id, depth in CategoryClosure.objects.filter(
+                descendant_id=category.parent_id
+            ).values_list('ancestor_id', 'depth')
+        ]
+    CategoryClosure.objects.bulk_create(links)
+    # товаров в новой категории еще нет, у предков ничего не меняется
+    CategoryStats.objects.bulk_create([CategoryStats(category_id=category.pk)], ignore_conflicts=True)
+
+
+@transaction.atomic
+def move_category_subtree(category):
+    """
+    Переносит поддерево под новый category.parent_id фиксированным числом
+    запросов: удаляются ссылки от старых предков ко всему поддереву
+    и добавляется их произведение с предками нового родителя
+    """
+    subtree = list(CategoryClosure.objects.filter(
+        ancestor_id=category.pk
+    ).values_list('descendant_id', 'depth'))
+    subtree_ids = [descendant_id for descendant_id, _ in subtree]
+    if category.parent_id in subtree_ids:
+        raise ValidationError('Нельзя перенести категорию в ее собственную подкатегорию')
+    CategoryClosure.objects.filter(descendant_id__in=subtree_ids).exclude(
+        ancestor_id__in=subtree_ids
+    ).delete()
+    if category.parent_id is None:
+        return
+    ancestors = CategoryClosure.objects.filter(
+        descendant_id=category.parent_id
+    ).values_list('ancestor_id', 'depth')
+    CategoryClosure.objects.bulk_create([
+        CategoryClosure(
+            ancestor_id=ancestor_id,
+            descendant_id=descendant_id,
+            depth=ancestor_depth + descendant_depth + 1
+        )
+        for ancestor_id, ancestor_depth in ancestors
+        for descendant_id, descendant_depth in subtree
+    ])
+
+
+def rebuild_category_closure():
+    """Строит таблицу замыканий заново по полю parent"""
+    parents = dict(Category.objects.values_list('pk', 'parent_id'))
+    links = []
+    for category_id in parents:
+        ancestor_id, depth, seen = category_id, 0, set()
+        while ancestor_id is not None and ancestor_id not in seen:
+            seen.add(ancestor_id)
+            links.append(CategoryClosure(ancestor_id=ancestor_id, descendant_id=category_id, depth=depth))
+            ancestor_id, depth = parents.get(ancestor_id), depth + 1
+    with transaction.atomic():
+        CategoryClosure.objects.all().delete()
+        CategoryClosure.objects.bulk_create(links, batch_size=1000)
+    return len(links)
+
+
+def build_tree(categories):
+    """Собирает вложенные словари из плоского списка категорий"""
+    nodes = {
+        category.pk: {'name': category.name, 'slug': category.slug, 'children': []}
+        for category in categories
+    }
+    roots = []
+    for category in categories:
+        parent = nodes.get(category.parent_id)
+        (parent['children'] if parent else roots).append(nodes[category.pk])
+    return roots
+
+
+def category_aggregates(category_ids=None):
+    """Счетчики и цены по всему поддереву каждой категории"""
+    links = CategoryClosure.objects.all()
+    if category_ids is not None:
+        links = links.filter(ancestor_id__in=category_ids)
+    products = 'descendant__products'
+    rows = links.values('ancestor_id').annotate(
+        product_count=Count(products),
+        available_count=Count(products, filter=Q(**{f'{products}__available': True})),
+        min_price=Min(f'{products}__price'),
+        max_price=Max(f'{products}__price'),
+    ).order_by()
+    return {row.pop('ancestor_id'): row for row in rows}
+
+
+def refresh_category_stats(category_ids=None):
+    """
+    Пересчитывает статистику категорий и всех их предков одним GROUP BY
+    по таблице замыканий и записывает ее одним INSERT ... ON CONFLICT.
+    Без аргументов — все категории
+    """
+    if category_ids is not None:
+        category_ids = {category_id for category_id in category_ids if category_id}
+        if not category_ids:
+            return 0
+        category_ids |= set(CategoryClosure.objects.filter(
+            descendant_id__in=category_ids
+        ).values_list('ancestor_id', flat=True))
+    aggregates = category_aggregates(category_ids)
+    categories = Category.objects.all()
+    if category_ids is not None:
+        categories = categories.filter(pk__in=category_ids)
+    empty = {'product_count': 0, 'available_count': 0, 'min_price': None, 'max_price': None}
+    now = timezone.now()
+    stats = [
+        CategoryStats(category_id=name, updated=now, **aggregates.get(name, empty))
+        for name in categories.values_list('pk', flat=True)
+    ]
+    CategoryStats.objects.bulk_create(
+        stats,
+        update_conflicts=True,
+        unique_fields=['category_id'],
+        update_fields=STATS_FIELDS
+    )
+    return len(stats)
+
+
+def adjust_category_stats(changes):
+    """
+    Сдвигает статистику категорий и их предков после изменения товаров,
+    не пересчитывая поддерево. changes — пары (было, стало), где каждое
+    значение (категория, в наличии, цена) или None для созданного
+    и удаленного товара. Счетчики меняются через F(), граница цены
+    расширяется сразу, а пересчитывается, только если ушедшая цена на ней стояла
+    """
+    changes = [(old, new) for old, new in changes if old != new]
+    if not changes:
+        return
+    ancestors = defaultdict(set)
+    for ancestor_id, descendant_id in CategoryClosure.objects.filter(
+        descendant_id__in={values[0] for change in changes for values in change if values}
+    ).values_list('ancestor_id', 'descendant_id'):
+        ancestors[descendant_id].add(ancestor_id)
+
+    products, available = Counter(), Counter()
+    for change in changes:
+        for values, sign in zip(change, (-1, 1)):
+            if values:
+                for ancestor_id in ancestors[values[0]]:
+                    products[ancestor_id] += sign
+                    available[ancestor_id] += sign * values[1]
+    groups = defaultdict(list)
+    for ancestor_id in products:
+        delta = (products[ancestor_id], available[ancestor_id])
+        if delta != (0, 0):
+            groups[delta].append(ancestor_id)
+    now = timezone.now()
+    for (product_delta, available_delta), category_ids in groups.items():
+        CategoryStats.objects.filter(category_id__in=category_ids).update(
+            product_count=F('product_count') + product_delta,
+            available_count=F('available_count') + available_delta,
+            updated=now
+        )
+
+    recompute = set()
+    for old, new in changes:
+        # у общих предков с той же ценой набор цен не изменился
+        same = set()
+        if old and new and old[2] == new[2]:
+            same = ancestors[old[0]] & ancestors[new[0]]
+        if old and ancestors[old[0]] - same:
+            recompute.update(CategoryStats.objects.filter(
+                Q(min_price__gte=old[2]) | Q(max_price__lte=old[2]),
+                category_id__in=ancestors[old[0]] - same
+            ).values_list('category_id', flat=True))
+        extended = ancestors[new[0]] - same - recompute if new else set()
+        if extended:
+            stats = CategoryStats.objects.filter(category_id__in=extended)
+            stats.filter(Q(min_price__isnull=True) | Q(min_price__gt=new[2])).update(min_price=new[2])
+            stats.filter(Q(max_price__isnull=True) | Q(max_price__lt=new[2])).update(max_price=new[2])
+    if recompute:
+        aggregates = category_aggregates(recompute)
+        CategoryStats.objects.bulk_update([
+            CategoryStats(
+                category_id=category_id,
+                min_price=aggregates.get(category_id, {}).get('min_price'),
+                max_price=aggregates.get(category_id, {}).get('max_price'),
+            )
+            for category_id in recompute
+        ], ['min_price', 'max_price'])
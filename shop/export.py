@@ -0,0 +1,132 @@
+import csv
+import json
+import zlib
+from datetime import datetime, time
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import Product, ProductImage, Tag
+
+# колонки совместимы с import_products
+EXPORT_FIELDS = (
+    'id', 'user', 'name', 'slug', 'category', 'description', 'price', 'stock', 'available',
+    'image', 'images', 'tags', 'rating', 'rating_count', 'comment_count', 'updated',
+)
+EXPORT_FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+BUFFER_SIZE = 64 * 1024
+
+
+def parse_since(value):
+    """Дата или дата со временем в ISO 8601; без часового пояса — текущий"""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'Неверная дата: {value}')
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def export_queryset(since=None, using=None):
+    """
+    Весь каталог по возрастанию id. Теги и картинки подгружаются
+    одним запросом на каждую пачку iterator(chunk_size=...)
+    """
+    queryset = Product.objects.only(
+        'id', 'user', 'name', 'slug', 'category', 'description', 'price', 'stock',
+        'available', 'image', 'rating_avg', 'rating_count', 'comment_count', 'updated'
+    ).prefetch_related(
+        Prefetch('tag', queryset=Tag.objects.only('name')),
+        Prefetch('product_images', queryset=ProductImage.objects.only('id', 'image', 'product')),
+    ).order_by('pk')
+    if since is not None:
+        queryset = queryset.filter(updated__gte=since)
+    return queryset.using(using)
+
+
+def export_rows(since=None, url=None, chunk_size=None, using=None):
+    """Строки каталога словарями; в памяти держится одна пачка товаров"""
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    url = url or default_storage.url
+    for product in export_queryset(since, using).iterator(chunk_size=chunk_size):
+        yield {
+            'id': product.pk,
+            'user': product.user_id,
+            'name': product.name,
+            'slug': product.slug,
+            'category': product.category_id,
+            'description': product.description,
+            'price': product.price,
+            'stock': product.stock,
+            'available': product.available,
+            'image': url(product.image.name) if product.image else '',
+            'images': [url(image.image.name) for image in product.product_images.all()],
+            'tags': [tag.name for tag in product.tag.all()],
+            'rating': round(product.rating_avg, 1),
+            'rating_count': product.rating_count,
+            'comment_count': product.comment_count,
+            'updated': product.updated,
+        }
+
+
+class _Echo:
+    """Файлоподобный объект для csv.writer: возвращает строку вместо записи"""
+
+    def write(self, value):
+        return value
+
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False, cls=DjangoJSONEncoder) + '\n'
+
+
+def csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        row = dict(row, images=','.join(row['images']), tags=','.join(row['tags']))
+        row['updated'] = row['updated'].isoformat()
+        yield writer.writerow([row[field] for field in EXPORT_FIELDS])
+
+
+def encode_chunks(lines, size=BUFFER_SIZE):
+    """Склеивает строки в куски около size байт, чтобы не отдавать их по одной"""
+    buffer, length = [], 0
+    for line in lines:
+        data = line.encode('utf-8')
+        buffer.append(data)
+        length += len(data)
+        if length >= size:
+            yield b''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def gzip_chunks(chunks):
+    """Сжимает поток на лету, не собирая его целиком"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_catalog(file_format, since=None, compress=False, url=None, chunk_size=None, using=None):
+    """Каталог в формате jsonl или csv потоком байтовых кусков"""
+    rows = export_rows(since, url=url, chunk_size=chunk_size, using=using)
+    lines = csv_lines(rows) if file_format == 'csv' else jsonl_lines(rows)
+    chunks = encode_chunks(lines)
+    return gzip_chunks(chunks) if compress else chunks
@@ -0,0 +1,120 @@
+from django.conf import settings
+from django.db.models import Count, Q
+from django_filters import rest_framework as rest_filter
+
+from .models import CategoryClosure, Product
+
+
+class CharInFilter(rest_filter.BaseInFilter, rest_filter.CharFilter):
+    pass
+
+
+class ProductFilter(rest_filter.FilterSet):
+    """
+    Фильтры каталога. Категория включает свои подкатегории.
+    Списки значений передаются через запятую:
+    ?category=fridges,tv&tags=beko,no-frost&tags_mode=and
+    """
+    price_min = rest_filter.NumberFilter(field_name='price', lookup_expr='gte')
+    price_max = rest_filter.NumberFilter(field_name='price', lookup_expr='lte')
+    category = CharInFilter(method='filter_category')
+    tags = CharInFilter(method='filter_tags')
+    tags_mode = rest_filter.ChoiceFilter(
+        choices=(('or', 'Любой из тегов'), ('and', 'Все теги')),
+        method='filter_noop'
+    )
+    available = rest_filter.BooleanFilter()
+    in_stock = rest_filter.BooleanFilter(method='filter_in_stock')
+
+    class Meta:
+        model = Product
+        fields = ['slug', 'price_min', 'price_max', 'category', 'tags', 'tags_mode', 'available', 'in_stock']
+
+    def filter_noop(self, queryset, name, value):
+        # режим учитывается в filter_tags
+        return queryset
+
+    def filter_category(self, queryset, name, value):
+        # категория вместе со всеми подкатегориями
+        return queryset.filter(category_id__in=CategoryClosure.objects.filter(
+            ancestor__slug__in=value
+        ).values('descendant_id'))
+
+    def filter_tags(self, queryset, name, value):
+        names = [tag for tag in value if tag]
+        if not names:
+            return queryset
+        # через подзапрос к промежуточной таблице, чтобы не размножать строки JOIN-ом
+        links = Product.tag.through.objects.filter(tag_id__in=names).values('product_id')
+        if self.form.cleaned_data.get('tags_mode') == 'and':
+            links = links.annotate(
+                matched=Count('tag_id', distinct=True)
+            ).filter(matched=len(set(names))).values('product_id')
+        return queryset.filter(pk__in=links)
+
+    def filter_in_stock(self, queryset, name, value):
+        return queryset.filter(stock__gt=0) if value else queryset.filter(stock=0)
+
+
+def price_buckets():
+    """Границы из PRODUCT_PRICE_FACETS превращаются в интервалы [min, max)"""
+    bounds = [None, *settings.PRODUCT_PRICE_FACETS, None]
+    return list(zip(bounds, bounds[1:]))
+
+
+def product_facets(queryset):
+    """
+    Счетчики фасетов для текущей выборки: одним агрегирующим запросом
+    для доступности, наличия и цен и по одному GROUP BY для категорий и тегов
+    """
+    queryset = queryset.order_by().prefetch_related(None)
+    buckets = price_buckets()
+    aggregates = {
+        'total': Count('pk'),
+        'available': Count('pk', filter=Q(available=True)),
+        'in_stock': Count('pk', filter=Q(stock__gt=0)),
+    }
+    for number, (low, high) in enumerate(buckets):
+        condition = Q()
+        if low is not None:
+            condition &= Q(price__gte=low)
+        if high is not None:
+            condition &= Q(price__lt=high)
+        aggregates[f'price_{number}'] = Count('pk', filter=condition)
+    counts = queryset.aggregate(**aggregates)
+    total = counts['total']
+
+    categories = queryset.values('category_id', 'category__slug').annotate(
+        count=Count('pk')
+    ).order_by('-count', 'category_id')
+    tags = Product.tag.through.objects.filter(
+        product_id__in=queryset.values('pk')
+    ).values('tag_id').annotate(count=Count('product_id')).order_by('-count', 'tag_id')
+
+    return {
+        'total': total,
+        'category': [
+            {'value': item['category__slug'], 'name': item['category_id'], 'count': item['count']}
+            for item in categories
+        ],
+        'tags': [{'value': item['tag_id'], 'count': item['count']} for item in tags],
+        'available': {'true': counts['available'], 'false': total - counts['available']},
+        'in_stock': {'true': counts['in_stock'], 'false': total - counts['in_stock']},
+        'price': [
+            {'min': low, 'max': high, 'count': counts[f'price_{number}']}
+            for number, (low, high) in enumerate(buckets)
+        ],
+    }
+
+
+class FacetedListMixin:
+    """При ?facets=true добавляет в ответ списка счетчики фасетов"""
+    facets_query_param = 'facets'
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        value = request.query_params.get(self.facets_query_param, '')
+        if value.lower() in ('1', 'true', 'yes') and isinstance(response.data, dict):
+            queryset = self.filter_queryset(self.get_queryset())
+            response.data['facets'] = product_facets(queryset)
+        return response
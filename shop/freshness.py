@@ -0,0 +1,98 @@
+import hashlib
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Count, F, Max, Sum
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from myshop.routers import primary_reads
+
+from .models import Product
+from .response_cache import response_cache
+
+
+def version_values():
+    """
+    Поля, которые нужно добавить в массовый UPDATE товаров, меняющий их
+    представление в API: post_save не вызывается, и updated сам не обновится
+    """
+    return {'version': F('version') + 1, 'updated': timezone.now()}
+
+
+def touch_products(product_ids, **values):
+    """
+    Отмечает изменение связанных данных товаров (картинки, теги, комментарии)
+    одним UPDATE; values — дополнительные поля того же UPDATE
+    """
+    Product.objects.filter(pk__in=list(product_ids)).update(**version_values(), **values)
+
+
+class ConditionalResponseMixin:
+    """
+    ETag и Last-Modified для list и retrieve. Свежесть берется одним
+    агрегирующим запросом по счетчику version и полю updated, поэтому
+    If-None-Match и If-Modified-Since отвечают 304 без сериализации.
+    Удаление товара видно только по ETag: Last-Modified списка от него не меняется
+    """
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(super().retrieve, request, *args, **kwargs)
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return handler(request, *args, **kwargs)
+        etag, last_modified = self.get_freshness(request, kwargs.get(self.lookup_url_kwarg or self.lookup_field))
+        if etag is None:
+            return handler(request, *args, **kwargs)
+        response = get_conditional_response(request._request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def get_freshness(self, request, pk=None):
+        """
+        Возвращает (ETag, время изменения в секундах). Значение кэшируется
+        под версией товара или списка из response_cache, поэтому повторная
+        проверка не ходит в базу, пока товары не изменились
+        """
+        action = f'freshness:{self.action}:{request.accepted_renderer.format}'
+        key = response_cache.key(request, action, pk)
+        return response_cache.remember(key, lambda: self.fresh_freshness(request, pk))
+
+    def fresh_freshness(self, request, pk=None):
+        # ETag кэшируется под версией так же, как ответ, поэтому считается по основной базе
+        with primary_reads():
+            return self.compute_freshness(request, pk)
+
+    def compute_freshness(self, request, pk=None):
+        # сумма версий меняется при любом изменении товаров выборки, количество — при удалении
+        queryset = self.filter_queryset(self.get_queryset())
+        if pk is not None:
+            try:
+                queryset = queryset.filter(pk=pk)
+            except (TypeError, ValueError, ValidationError):
+                return None, None
+        freshness = queryset.prefetch_related(None).aggregate(
+            count=Count('pk'), version=Sum('version'), modified=Max('updated')
+        )
+        if pk is not None and not freshness['count']:
+            return None, None
+        modified = freshness['modified']
+        digest = hashlib.sha1(json.dumps([
+            request.path,
+            sorted(request.query_params.lists()),
+            request.accepted_renderer.format,
+            freshness['count'],
+            freshness['version'],
+            modified.isoformat() if modified else None,
+        ]).encode()).hexdigest()
+        return f'"{digest}"', int(modified.timestamp()) if modified else None
@@ -0,0 +1,93 @@
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+# формат варианта -> (формат Pillow, расширение, параметры сохранения)
+FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def render_variants(data, widths, formats=('webp', 'jpeg')):
+    """
+    Уменьшает картинку до каждой ширины из widths (без увеличения)
+    и кодирует в каждом формате. Работает с байтами, чтобы выполняться
+    в отдельном процессе
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        source = ImageOps.exif_transpose(source)
+        original = source.size
+        targets = sorted({min(width, original[0]) for width in widths})
+        variants = []
+        for width in targets:
+            height = max(1, round(original[1] * width / original[0]))
+            resized = source if width == original[0] else source.resize(
+                (width, height), Image.LANCZOS
+            )
+            for variant_format in formats:
+                pillow_format, extension, options = FORMATS[variant_format]
+                image = resized
+                if pillow_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                buffer = io.BytesIO()
+                image.save(buffer, pillow_format, **options)
+                variants.append({
+                    'width': width,
+                    'height': height,
+                    'format': variant_format,
+                    'extension': extension,
+                    'content': buffer.getvalue(),
+                })
+    return {'width': original[0], 'height': original[1]}, variants
+
+
+def get_pool():
+    """
+    Пул процессов для работы Pillow. Из демонического процесса
+    дочерние создавать нельзя — тогда возвращается None и картинки
+    обрабатываются в текущем процессе
+    """
+    global _pool
+    workers = getattr(settings, 'IMAGE_PROCESS_WORKERS', os.cpu_count())
+    if not workers or multiprocessing.current_process().daemon:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers)
+        return _pool
+
+
+def variant_name(source_name, width, extension):
+    stem = os.path.splitext(os.path.basename(source_name))[0]
+    return f'variants/{stem}_{width}w.{extension}'
+
+
+def variants_representation(variants, url):
+    """Собирает из сохраненных вариантов списки URL для srcset"""
+    if not variants:
+        return None
+    items = [
+        dict(variant, url=url(variant['name']))
+        for variant in variants.get('items', [])
+    ]
+    srcset = {}
+    for item in items:
+        srcset.setdefault(item['format'], []).append(f'{item["url"]} {item["width"]}w')
+    return {
+        'width': variants.get('width'),
+        'height': variants.get('height'),
+        'srcset': {fmt: ', '.join(entries) for fmt, entries in srcset.items()},
+        'items': [
+            {key: item[key] for key in ('url', 'width', 'height', 'format')}
+            for item in items
+        ],
+    }
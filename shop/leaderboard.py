@@ -0,0 +1,104 @@
+import heapq
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from .models import CategoryClosure, CategoryLeaderboard, LeaderboardQueue, Product, Rating
+
+
+def mark_categories(category_ids):
+    """Ставит категории в очередь на пересчет топа; предков пересчет найдет сам"""
+    now = timezone.now()
+    LeaderboardQueue.objects.bulk_create(
+        [LeaderboardQueue(category_id=pk, marked_at=now) for pk in set(category_ids) if pk],
+        update_conflicts=True,
+        unique_fields=['category_id'],
+        update_fields=['marked_at'],
+    )
+
+
+def bayesian_score(rating_sum, rating_count, mean, prior):
+    """
+    Средняя оценка, к которой добавлено prior оценок, равных средней по
+    каталогу: у товара с одной пятеркой она близка к средней, а с ростом
+    числа оценок приближается к его собственной средней
+    """
+    return (prior * mean + rating_sum) / (prior + rating_count)
+
+
+def rating_totals(category_ids=None, from_ratings=False):
+    """
+    [(товар, категория, сумма оценок, число оценок)] по оцененным товарам.
+    from_ratings — считать заново по таблице Rating, а не по агрегатам товаров
+    """
+    if from_ratings:
+        rows = Rating.objects.filter(rating__isnull=False).values_list(
+            'product', 'product__category'
+        ).annotate(Sum('rating'), Count('id')).order_by()
+        if category_ids is not None:
+            rows = rows.filter(product__category_id__in=category_ids)
+        return list(rows)
+    rows = Product.objects.filter(rating_count__gt=0)
+    if category_ids is not None:
+        rows = rows.filter(category_id__in=category_ids)
+    return list(rows.values_list('pk', 'category_id', 'rating_sum', 'rating_count'))
+
+
+def catalog_mean():
+    totals = Product.objects.aggregate(total=Sum('rating_sum'), count=Sum('rating_count'))
+    return totals['total'] / totals['count'] if totals['count'] else 0.0
+
+
+def refresh_leaderboards(full=False):
+    """
+    Пересчитывает топы категорий, в которых что-то изменилось, и их предков.
+    full — все категории заново по таблице Rating. Возвращает число категорий
+    """
+    started = timezone.now()
+    queue = LeaderboardQueue.objects.filter(marked_at__lte=started)
+    closure = CategoryClosure.objects.all()
+    if not full:
+        dirty = set(queue.values_list('category_id', flat=True))
+        if not dirty:
+            return 0
+        ancestors = set(CategoryClosure.objects.filter(
+            descendant_id__in=dirty
+        ).values_list('ancestor_id', flat=True))
+        closure = closure.filter(ancestor_id__in=ancestors)
+    # категория товара -> категории, в чей топ он попадает
+    boards = defaultdict(list)
+    for descendant, ancestor in closure.values_list('descendant_id', 'ancestor_id'):
+        boards[descendant].append(ancestor)
+
+    totals = rating_totals(None if full else list(boards), from_ratings=full)
+    if full:
+        count = sum(row[3] for row in totals)
+        mean = sum(row[2] for row in totals) / count if count else 0.0
+    else:
+        mean = catalog_mean()
+    prior = settings.LEADERBOARD_PRIOR_COUNT
+    candidates = defaultdict(list)
+    for product_id, category_id, rating_sum, rating_count in totals:
+        score = bayesian_score(rating_sum, rating_count, mean, prior)
+        for ancestor in boards.get(category_id, ()):
+            candidates[ancestor].append((score, rating_count, -product_id))
+
+    size = settings.LEADERBOARD_SIZE
+    rows = [
+        CategoryLeaderboard(category_id=category_id, product_id=-product_id, rank=rank, score=round(score, 4))
+        for category_id, items in candidates.items()
+        for rank, (score, rating_count, product_id) in enumerate(heapq.nlargest(size, items))
+    ]
+    categories = {ancestor for ancestors in boards.values() for ancestor in ancestors}
+    with transaction.atomic():
+        stale = CategoryLeaderboard.objects.all()
+        if not full:
+            stale = stale.filter(category_id__in=categories)
+        stale.delete()
+        CategoryLeaderboard.objects.bulk_create(rows, batch_size=1000)
+    # отметки, сделанные во время пересчета, остаются до следующего запуска
+    queue.delete()
+    return len(categories)
@@ -0,0 +1,109 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from django.db.models import Sum
+
+from shop.models import Category, Order, OrderItem, Product
+from shop.orders import OutOfStock, create_order
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Нагружает оформление заказа одного товара из многих потоков и проверяет, что нет перепродажи'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--orders', type=int, default=500, help='Сколько всего попыток оформить заказ')
+        parser.add_argument('--stock', type=int, default=100)
+        parser.add_argument('--quantity', type=int, default=1, help='Штук товара в одном заказе')
+        parser.add_argument('--retries', type=int, default=20, help='Повторы при блокировке базы')
+        parser.add_argument('--keep', action='store_true', help='Не удалять тестовые данные')
+
+    def handle(self, *args, **options):
+        suffix = uuid.uuid4().hex[:8]
+        buyer = User.objects.create_user(
+            username=f'benchmark-{suffix}', email=f'benchmark-{suffix}@example.com',
+            password=uuid.uuid4().hex, is_active=True
+        )
+        category = Category.objects.create(name=f'Benchmark {suffix}', slug=f'benchmark-{suffix}')
+        product = Product.objects.create(
+            user=buyer, category=category, name=f'Benchmark {suffix}',
+            slug=f'benchmark-{suffix}', price=1, stock=options['stock']
+        )
+        try:
+            result = self.run_benchmark(buyer, product, options)
+            self.verify(product, options['stock'], result)
+        finally:
+            if not options['keep']:
+                Order.objects.filter(user=buyer).delete()
+                category.delete()
+                buyer.delete()
+
+    def run_benchmark(self, buyer, product, options):
+        counters = dict.fromkeys(('accepted', 'rejected', 'errors', 'retries'), 0)
+        lock = threading.Lock()
+        attempts = iter(range(options['orders']))
+        attempts_lock = threading.Lock()
+
+        def count(name, value=1):
+            with lock:
+                counters[name] += value
+
+        def worker():
+            try:
+                while True:
+                    with attempts_lock:
+                        if next(attempts, None) is None:
+                            return
+                    for retry in range(options['retries'] + 1):
+                        try:
+                            create_order(buyer, {product.pk: options['quantity']})
+                            count('accepted')
+                        except OutOfStock:
+                            count('rejected')
+                        except OperationalError:
+                            # SQLite и другие базы без строчных блокировок отвечают "database is locked"
+                            if retry == options['retries']:
+                                count('errors')
+                                break
+                            count('retries')
+                            time.sleep(0.001 * (retry + 1))
+                            continue
+                        break
+            finally:
+                connection.close()
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+            futures = [pool.submit(worker) for _ in range(options['threads'])]
+        for future in futures:
+            future.result()
+        counters['elapsed'] = time.monotonic() - started
+        return counters
+
+    def verify(self, product, initial_stock, result):
+        product.refresh_from_db()
+        ordered = OrderItem.objects.filter(product=product).aggregate(total=Sum('quantity'))['total'] or 0
+        elapsed = result['elapsed']
+        self.stdout.write(
+            f'Продано {ordered} из {initial_stock}, заказов {result["accepted"]}, отказов {result["rejected"]}, '
+            f'ошибок {result["errors"]}, повторов {result["retries"]}\n'
+            f'Остаток {product.stock}, доступен: {product.available}\n'
+            f'{elapsed:.2f} с, {(result["accepted"] + result["rejected"]) / max(elapsed, 1e-6):.0f} попыток/с'
+        )
+        oversold = ordered - initial_stock
+        if oversold > 0:
+            raise CommandError(f'Перепродано {oversold} шт.')
+        if product.stock != initial_stock - ordered:
+            raise CommandError(
+                f'Остаток {product.stock} не сходится с заказами: {initial_stock} - {ordered}'
+            )
+        if product.stock == 0 and product.available:
+            raise CommandError('Товар закончился, но остался доступным')
+        self.stdout.write(self.style.SUCCESS('Перепродажи нет'))
@@ -0,0 +1,50 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router
+
+from myshop.routers import replica_reads
+from shop.export import EXPORT_FORMATS, export_catalog, parse_since
+from shop.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Потоково выгружает каталог в JSONL или CSV, при необходимости сжимая gzip'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл для выгрузки, - для вывода в stdout')
+        parser.add_argument('--format', choices=list(EXPORT_FORMATS))
+        parser.add_argument('--since', help='Только товары, измененные с этой даты (ISO 8601)')
+        parser.add_argument('--gzip', action='store_true', help='Сжимать gzip, по умолчанию для *.gz')
+        parser.add_argument('--chunk-size', type=int, help='Сколько товаров читать с сервера за раз')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        name = path[:-3] if path.endswith('.gz') else path
+        file_format = options['format'] or ('csv' if name.endswith('.csv') else 'jsonl')
+        compress = options['gzip'] or path.endswith('.gz')
+        since = None
+        if options['since']:
+            try:
+                since = parse_since(options['since'])
+            except ValueError as error:
+                raise CommandError(str(error))
+        with replica_reads():
+            using = router.db_for_read(Product)
+        chunks = export_catalog(file_format, since, compress, chunk_size=options['chunk_size'], using=using)
+
+        if path == '-':
+            if compress:
+                raise CommandError('Сжатую выгрузку нужно писать в файл')
+            for chunk in chunks:
+                self.stdout.write(chunk.decode('utf-8'), ending='')
+            return
+
+        size = 0
+        temporary = f'{path}.tmp'
+        with open(temporary, 'wb') as file:
+            for chunk in chunks:
+                file.write(chunk)
+                size += len(chunk)
+        os.replace(temporary, path)
+        self.stdout.write(self.style.SUCCESS(f'Выгружено в {path}: {size} байт'))
@@ -0,0 +1,243 @@
+import csv
+import json
+import os
+import time
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from slugify import slugify
+
+from shop.categories import refresh_category_stats
+from shop.models import Category, CategoryClosure, Product, Tag
+from shop.response_cache import response_cache
+from shop.search import product_search
+
+User = get_user_model()
+
+PRODUCT_FIELDS = ('name', 'description', 'price', 'stock', 'available', 'image')
+
+
+def read_rows(path, file_format):
+    """Построчно читает файл, не загружая его в память целиком"""
+    with open(path, newline='', encoding='utf-8') as file:
+        if file_format == 'csv':
+            for number, row in enumerate(csv.DictReader(file), start=1):
+                yield number, row
+        else:
+            for number, line in enumerate(file, start=1):
+                if line.strip():
+                    yield number, line
+
+
+def parse_tags(value):
+    if isinstance(value, list):
+        names = value
+    else:
+        names = (value or '').replace(';', ',').split(',')
+    return [name.strip() for name in names if name and name.strip()]
+
+
+class Command(BaseCommand):
+    help = 'Потоково импортирует товары из CSV или JSONL пакетами'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'])
+        parser.add_argument('--seller', help='Продавец для строк без колонки user')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--checkpoint', help='Файл с позицией для продолжения импорта')
+        parser.add_argument('--errors', help='Куда писать строки с ошибками (JSONL)')
+        parser.add_argument('--restart', action='store_true', help='Начать заново, игнорируя checkpoint')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'Файл {path} не найден')
+        file_format = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        self.seller = options['seller']
+        if self.seller and not User.objects.filter(pk=self.seller).exists():
+            raise CommandError(f'Продавец {self.seller} не найден')
+        self.checkpoint_path = options['checkpoint'] or f'{path}.checkpoint'
+        errors_path = options['errors'] or f'{path}.errors.jsonl'
+        self.fields = {name: Product._meta.get_field(name) for name in PRODUCT_FIELDS}
+        self.slug_field = Product._meta.get_field('slug')
+
+        state = {'line': 0, 'imported': 0, 'errors': 0}
+        resume = not options['restart'] and os.path.exists(self.checkpoint_path)
+        if resume:
+            with open(self.checkpoint_path) as file:
+                state = json.load(file)
+            if state.get('completed'):
+                self.stdout.write(self.style.WARNING(
+                    f'Импорт уже завершен: импортировано {state["imported"]}, ошибок {state["errors"]} '
+                    f'(см. {errors_path}). Чтобы загрузить файл заново, запустите с --restart'
+                ))
+                return
+            self.stdout.write(f'Продолжаем со строки {state["line"] + 1}')
+
+        rows = (
+            (number, row) for number, row in read_rows(path, file_format)
+            if number > state['line']
+        )
+        started = time.monotonic()
+        imported_before = state['imported']
+        with open(errors_path, 'a' if resume else 'w', encoding='utf-8') as self.errors_file:
+            while True:
+                batch = list(islice(rows, options['batch_size']))
+                if not batch:
+                    break
+                state['imported'] += self.import_batch(batch, file_format, state)
+                state['line'] = batch[-1][0]
+                self.save_checkpoint(state)
+                imported = state['imported'] - imported_before
+                self.stdout.write(
+                    f'Строка {state["line"]}: импортировано {state["imported"]}, '
+                    f'ошибок {state["errors"]}, '
+                    f'{imported / max(time.monotonic() - started, 1e-6):.0f} товаров/с'
+                )
+
+        # без ошибок checkpoint не нужен: повторный запуск загрузит файл заново;
+        # с ошибками оставляем отметку о завершении, чтобы не задублировать товары
+        if state['errors']:
+            state['completed'] = True
+            self.save_checkpoint(state)
+        elif os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        # bulk_create не отправляет сигналы, поэтому сбрасываем индекс и кэш списков
+        product_search.invalidate_all()
+        response_cache.invalidate([])
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово: импортировано {state["imported"]}, ошибок {state["errors"]}, '
+            f'{time.monotonic() - started:.1f} с'
+        ))
+
+    def save_checkpoint(self, state):
+        temporary = f'{self.checkpoint_path}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(state, file)
+        os.replace(temporary, self.checkpoint_path)
+
+    def report_error(self, number, row, error, state):
+        state['errors'] += 1
+        self.errors_file.write(json.dumps(
+            {'line': number, 'error': error, 'row': row}, ensure_ascii=False, default=str
+        ) + '\n')
+
+    def parse_row(self, row, file_format):
+        if file_format == 'jsonl':
+            row = json.loads(row)
+            if not isinstance(row, dict):
+                raise ValueError('Строка должна быть JSON-объектом')
+        values = {}
+        for name, field in self.fields.items():
+            value = row.get(name)
+            if name == 'available' and isinstance(value, str) and value.strip():
+                value = value.strip().lower() in ('1', 't', 'true', 'yes', 'y', 'да')
+            if value in (None, ''):
+                if field.has_default() or field.blank:
+                    continue
+            values[name] = field.clean(value, None)
+        slug = str(row.get('slug') or '').strip()
+        if slug:
+            slug = self.slug_field.clean(slug, None)
+        else:
+            # транслитерация удлиняет название: обрезаем по длине поля
+            slug = slugify(values['name'], max_length=self.slug_field.max_length)
+            if not slug:
+                raise ValueError('Не удалось построить slug из названия')
+        category = str(row.get('category') or '').strip()
+        if not category:
+            raise ValueError('Не указана категория')
+        Category._meta.get_field('name').clean(category, None)
+        tags = parse_tags(row.get('tags'))
+        for tag in tags:
+            Tag._meta.get_field('name').run_validators(tag)
+        user = row.get('user') or self.seller
+        if not user:
+            raise ValueError('Не указан продавец (колонка user или --seller)')
+        return {
+            'values': values,
+            'slug': slug,
+            'category': category,
+            'user': user,
+            'tags': tags,
+        }
+
+    def import_batch(self, batch, file_format, state):
+        parsed = []
+        for number, row in batch:
+            try:
+                parsed.append((number, row, self.parse_row(row, file_format)))
+            except (ValueError, ValidationError) as error:
+                message = '; '.join(error.messages) if isinstance(error, ValidationError) else str(error)
+                self.report_error(number, row, message, state)
+
+        users = set(User.objects.filter(
+            pk__in={item['user'] for _, _, item in parsed}
+        ).values_list('pk', flat=True))
+        valid = []
+        for number, row, item in parsed:
+            if item['user'] in users:
+                valid.append(item)
+            else:
+                self.report_error(number, row, f'Продавец {item["user"]} не найден', state)
+        if not valid:
+            return 0
+
+        with transaction.atomic():
+            self.create_categories({item['category'] for item in valid})
+            tag_names = {name for item in valid for name in item['tags']}
+            Tag.objects.bulk_create(
+                [Tag(name=name, slug=slugify(name, max_length=Tag._meta.get_field('slug').max_length))
+                 for name in tag_names],
+                ignore_conflicts=True
+            )
+            products = Product.objects.bulk_create([
+                Product(
+                    user_id=item['user'],
+                    category_id=item['category'],
+                    slug=item['slug'],
+                    **item['values']
+                )
+                for item in valid
+            ])
+            Product.tag.through.objects.bulk_create([
+                Product.tag.through(product_id=product.pk, tag_id=name)
+                for product, item in zip(products, valid)
+                for name in item['tags']
+            ], ignore_conflicts=True)
+            # bulk_create не отправляет сигналы — статистику категорий обновляем сами
+            refresh_category_stats({item['category'] for item in valid})
+        return len(products)
+
+    def create_categories(self, names):
+        missing = names - set(
+            Category.objects.filter(name__in=names).values_list('name', flat=True)
+        )
+        if not missing:
+            return
+        # запас под суффикс -N, чтобы уникальный slug тоже уложился в поле
+        max_length = Category._meta.get_field('slug').max_length - 6
+        slugs = {name: slugify(name, max_length=max_length) or 'category' for name in missing}
+        taken = set(Category.objects.filter(
+            slug__in=set(slugs.values())
+        ).values_list('slug', flat=True))
+        categories = []
+        for name, slug in sorted(slugs.items()):
+            unique, suffix = slug, 2
+            while unique in taken:
+                unique, suffix = f'{slug}-{suffix}', suffix + 1
+                if Category.objects.filter(slug=unique).exists():
+                    taken.add(unique)
+            taken.add(unique)
+            categories.append(Category(name=name, slug=unique))
+        Category.objects.bulk_create(categories, ignore_conflicts=True)
+        # новые категории корневые: в таблице замыканий только ссылка на себя
+        CategoryClosure.objects.bulk_create([
+            CategoryClosure(ancestor_id=category.pk, descendant_id=category.pk, depth=0)
+            for category in categories
+        ], ignore_conflicts=True)
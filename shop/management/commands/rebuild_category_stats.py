@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from shop.categories import rebuild_category_closure, refresh_category_stats
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает количество товаров и границы цен всех категорий'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--closure', action='store_true',
+            help='Сначала перестроить таблицу замыканий дерева по полю parent'
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['closure']:
+                links = rebuild_category_closure()
+                self.stdout.write(f'Ссылок в таблице замыканий: {links}')
+            refreshed = refresh_category_stats()
+        self.stdout.write(self.style.SUCCESS(f'Обновлено категорий: {refreshed}'))
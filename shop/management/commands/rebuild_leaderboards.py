@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.leaderboard import refresh_leaderboards
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает топы категорий по таблице Rating'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--changed', action='store_true', help='Только категории, в которых изменились оценки')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        count = refresh_leaderboards(full=not options['changed'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересчитано категорий: {count} за {time.monotonic() - started:.2f} с'
+        ))
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+
+from shop.models import Product, Rating
+
+SCORES = [score for score, _ in Rating.RAITING_CHOICES]
+AGGREGATE_FIELDS = [
+    'rating_sum', 'rating_count', 'rating_avg',
+    *[f'rating_{score}' for score in SCORES]
+]
+
+
+def rating_aggregates():
+    rows = Rating.objects.filter(rating__isnull=False).values('product').annotate(
+        rating_sum=Sum('rating'),
+        rating_count=Count('id'),
+        **{
+            f'rating_{score}': Count('id', filter=Q(rating=score))
+            for score in SCORES
+        }
+    ).order_by()
+    aggregates = {}
+    for row in rows:
+        product_id = row.pop('product')
+        row['rating_avg'] = row['rating_sum'] / row['rating_count']
+        aggregates[product_id] = row
+    return aggregates
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает агрегаты рейтинга товаров по таблице Rating'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        empty = dict.fromkeys(AGGREGATE_FIELDS, 0)
+        with transaction.atomic():
+            aggregates = rating_aggregates()
+            products = Product.objects.select_for_update().only(*AGGREGATE_FIELDS)
+            checked, changed = 0, []
+            for product in products.iterator(chunk_size=batch_size):
+                checked += 1
+                expected = aggregates.get(product.pk, empty)
+                if any(getattr(product, f) != v for f, v in expected.items()):
+                    for field, value in expected.items():
+                        setattr(product, field, value)
+                    changed.append(product)
+            Product.objects.bulk_update(changed, AGGREGATE_FIELDS, batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(
+            f'Проверено товаров: {checked}, исправлено: {len(changed)}'
+        ))
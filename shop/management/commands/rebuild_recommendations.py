@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.recommendations import refresh_recommendations
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает похожие товары: все или только из очереди изменений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--changed', action='store_true', help='Только товары, у которых изменились теги, оценки или категория')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        count = refresh_recommendations(full=not options['changed'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересчитано товаров: {count} за {time.monotonic() - started:.2f} с'
+        ))
@@ -0,0 +1,16 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.search import product_search
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает поисковый индекс товаров с нуля'
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        count = product_search.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'Проиндексировано товаров: {count} за {time.monotonic() - started:.2f} с'
+        ))
@@ -0,0 +1,48 @@
+# Generated by Django 4.1.3 on 2026-10-18 20:22
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Q
+import django.db.models.deletion
+
+
+def fill_category_stats(apps, schema_editor):
+    Category = apps.get_model('shop', 'Category')
+    CategoryStats = apps.get_model('shop', 'CategoryStats')
+    Product = apps.get_model('shop', 'Product')
+    rows = Product.objects.values('category_id').annotate(
+        product_count=Count('pk'),
+        available_count=Count('pk', filter=Q(available=True)),
+        min_price=Min('price'),
+        max_price=Max('price'),
+    ).order_by()
+    aggregates = {row.pop('category_id'): row for row in rows}
+    CategoryStats.objects.bulk_create([
+        CategoryStats(category_id=name, **aggregates.get(name, {}))
+        for name in Category.objects.values_list('pk', flat=True)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_catalog_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryStats',
+            fields=[
+                ('category', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='shop.category')),
+                ('product_count', models.PositiveIntegerField(default=0)),
+                ('available_count', models.PositiveIntegerField(default=0)),
+                ('min_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('max_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Статистика категории',
+                'verbose_name_plural': 'Статистика категорий',
+            },
+        ),
+        migrations.RunPython(fill_category_stats, migrations.RunPython.noop),
+    ]
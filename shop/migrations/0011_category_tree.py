@@ -0,0 +1,47 @@
+# Generated by Django 4.1.3 on 2026-10-18 20:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_category_closure(apps, schema_editor):
+    # до этой миграции все категории были корневыми
+    Category = apps.get_model('shop', 'Category')
+    CategoryClosure = apps.get_model('shop', 'CategoryClosure')
+    CategoryClosure.objects.bulk_create([
+        CategoryClosure(ancestor_id=name, descendant_id=name, depth=0)
+        for name in Category.objects.values_list('pk', flat=True)
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_category_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='shop.category', verbose_name='Родительская категория'),
+        ),
+        migrations.CreateModel(
+            name='CategoryClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='shop.category')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='shop.category')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='categoryclosure',
+            index=models.Index(fields=['descendant', 'depth'], name='shop_catego_descend_a4a766_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='categoryclosure',
+            unique_together={('ancestor', 'descendant')},
+        ),
+        migrations.RunPython(fill_category_closure, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.1.3 on 2026-10-18 20:33
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_comment_count(apps, schema_editor):
+    Comment = apps.get_model('shop', 'Comment')
+    Product = apps.get_model('shop', 'Product')
+    counts = Comment.objects.filter(product_id=OuterRef('pk')).order_by().values(
+        'product_id'
+    ).annotate(count=Count('pk')).values('count')
+    Product.objects.update(comment_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0013_orders'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_comment_count, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['product', 'created_at', 'id'], name='shop_commen_product_950955_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1.3 on 2026-10-18 20:47
+
+from django.db import migrations, models
+import myshop.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0015_product_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='productimage',
+            name='image',
+            field=models.ImageField(db_index=True, storage=myshop.storage.get_blob_storage, upload_to='product_images/carousel'),
+        ),
+    ]
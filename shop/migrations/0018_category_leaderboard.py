@@ -0,0 +1,38 @@
+# Generated by Django 4.1.3 on 2026-10-18 20:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0017_similar_products'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardQueue',
+            fields=[
+                ('category_id', models.CharField(max_length=200, primary_key=True, serialize=False)),
+                ('marked_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CategoryLeaderboard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField()),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leaderboard', to='shop.category')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='shop.product')),
+            ],
+            options={
+                'ordering': ('category', 'rank'),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='categoryleaderboard',
+            constraint=models.UniqueConstraint(fields=('category', 'rank'), name='category_leaderboard_rank'),
+        ),
+    ]
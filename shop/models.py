@@ -1,8 +1,11 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 
 from slugify import slugify
+
+from myshop.storage import get_blob_storage
 from .utils import get_time
 
 User = get_user_model()
@@ -11,6 +14,14 @@ User = get_user_model()
 class Category(models.Model):
     name = models.CharField(max_length=200, db_index=True, primary_key=True)
     slug = models.SlugField(max_length=200, db_index=True, unique=True)
+    parent = models.ForeignKey(
+        'self',
+        verbose_name='Родительская категория',
+        on_delete=models.CASCADE,
+        related_name='children',
+        null=True,
+        blank=True
+    )
     class Meta:
         ordering = ('name',)
         verbose_name = 'Категория'
@@ -19,6 +30,84 @@ class Category(models.Model):
     def __str__(self) -> str:
         return self.name
 
+    def ancestors(self, include_self=True):
+        """Цепочка от корня до категории одним запросом по таблице замыканий"""
+        queryset = Category.objects.filter(descendant_links__descendant=self)
+        if not include_self:
+            queryset = queryset.exclude(pk=self.pk)
+        return queryset.order_by('-descendant_links__depth')
+
+    def descendants(self, include_self=True):
+        queryset = Category.objects.filter(ancestor_links__ancestor=self)
+        if not include_self:
+            queryset = queryset.exclude(pk=self.pk)
+        return queryset
+
+
+class CategoryClosure(models.Model):
+    """
+    Таблица замыканий дерева категорий: строка на каждую пару
+    предок — потомок (включая саму категорию с depth=0).
+    Поддерживается shop.categories
+    """
+    ancestor = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveSmallIntegerField()
+
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+        indexes = [models.Index(fields=['descendant', 'depth'])]
+
+
+class CategoryStats(models.Model):
+    """Счетчики и границы цен категории, поддерживаются shop.categories"""
+    category = models.OneToOneField(
+        Category,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='stats'
+    )
+    product_count = models.PositiveIntegerField(default=0)
+    available_count = models.PositiveIntegerField(default=0)
+    min_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    max_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Статистика категории'
+        verbose_name_plural = 'Статистика категорий'
+
+
+class ProductQuerySet(models.QuerySet):
+    def in_category(self, category):
+        """Товары категории и всех ее подкатегорий"""
+        return self.filter(category_id__in=CategoryClosure.objects.filter(
+            ancestor=category
+        ).values('descendant_id'))
+
+    def for_serializer(self):
+        """
+        Загружает товар со всем, что нужно ProductSerializer,
+        за фиксированное число запросов независимо от размера страницы
+        """
+        product_fields = [
+            field.name for field in self.model._meta.concrete_fields
+        ]
+        return self.select_related('user', 'category').only(
+            *product_fields, 'user__username', 'category__name'
+        ).prefetch_related(
+            models.Prefetch(
+                'product_images',
+                queryset=ProductImage.objects.only('id', 'image', 'variants', 'product')
+            ),
+            models.Prefetch(
+                'comments',
+                queryset=Comment.objects.latest_per_product(settings.PRODUCT_LATEST_COMMENTS),
+                to_attr='latest_comments'
+            ),
+            models.Prefetch('tag', queryset=Tag.objects.only('name')),
+        )
+
 
 class Product(models.Model):
     user = models.ForeignKey(
@@ -31,6 +120,8 @@ class Product(models.Model):
     name = models.CharField(max_length=200, db_index=True)
     slug = models.SlugField(max_length=200, db_index=True)
     image = models.ImageField(upload_to='products/%Y/%m/$d', blank=True)
+    # уменьшенные копии image, заполняются shop.tasks.process_product_images
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     description = models.TextField(blank=True)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField()
@@ -42,7 +133,28 @@ class Product(models.Model):
         related_name='products',
         blank=True
     )
-           
+    # агрегаты рейтинга, поддерживаются shop.ratings
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False, db_index=True)
+    rating_avg = models.FloatField(default=0, editable=False, db_index=True)
+    rating_1 = models.PositiveIntegerField(default=0, editable=False)
+    rating_2 = models.PositiveIntegerField(default=0, editable=False)
+    rating_3 = models.PositiveIntegerField(default=0, editable=False)
+    rating_4 = models.PositiveIntegerField(default=0, editable=False)
+    rating_5 = models.PositiveIntegerField(default=0, editable=False)
+    # поддерживается сигналами комментариев
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+    # растет при любом изменении товара и связанных с ним данных, см. shop.freshness
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = ProductQuerySet.as_manager()
+
+    # меняются только F()-выражениями и условными UPDATE: обычное сохранение
+    # вернуло бы в базу значения, загруженные до чужого изменения
+    SERVER_FIELDS = (
+        'rating_sum', 'rating_count', 'rating_avg', 'rating_1', 'rating_2', 'rating_3',
+        'rating_4', 'rating_5', 'comment_count', 'version', 'image_variants',
+    )
 
     def __str__(self) -> str:
         return self.name
@@ -50,19 +162,50 @@ class Product(models.Model):
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.title)
-        super().save(*args, **kwargs)
+        updating = not self._state.adding and not kwargs.get('force_insert')
+        if updating:
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = [
+                    field.name for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name not in self.SERVER_FIELDS
+                ]
+            kwargs['update_fields'] = {*update_fields, 'version', 'updated'}
+            self.version = models.F('version') + 1
+        # сигналы блокируют прежнюю строку, чтобы сдвинуть статистику категорий по ней
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+        if updating:
+            # новая версия подгрузится из базы при первом обращении
+            del self.version
         
     class Meta:
         verbose_name = 'Товар'
         verbose_name_plural = 'Товары'
         ordering = ('name',)
         index_together = (('id', 'slug'))
+        # под фильтры каталога и курсорную пагинацию (поле сортировки, id)
+        indexes = [
+            models.Index(fields=['category', 'created', 'id']),
+            models.Index(fields=['category', 'price', 'id']),
+            models.Index(fields=['available', 'created', 'id']),
+            models.Index(fields=['price', 'id']),
+        ]
 
     def get_absolute_url(self):
         return reverse('post-detail', kwargs={'pk': self.pk})
 
+    @property
+    def rating_histogram(self):
+        return {
+            score: getattr(self, f'rating_{score}')
+            for score, _ in Rating.RAITING_CHOICES
+        }
+
 class ProductImage(models.Model):
-    image = models.ImageField(upload_to='product_images/carousel')
+    # одинаковые фото хранятся один раз, файл удаляется с последней ссылкой на него
+    image = models.ImageField(upload_to='product_images/carousel', storage=get_blob_storage, db_index=True)
+    variants = models.JSONField(default=dict, blank=True, editable=False)
     product = models.ForeignKey(
         to=Product,
         on_delete=models.CASCADE,
@@ -88,6 +231,26 @@ class Tag(models.Model):
         super().save(*args, **kwargs)
 
 
+class CommentQuerySet(models.QuerySet):
+    def for_serializer(self):
+        """Автор комментария приходит JOIN-ом, а не отдельным запросом на строку"""
+        return self.select_related('user').only(
+            'id', 'text', 'created_at', 'product', 'user__username'
+        )
+
+    def latest_per_product(self, count):
+        """
+        Последние count комментариев каждого товара: коррелированный подзапрос
+        с LIMIT по индексу (product, created_at, id) для каждой строки
+        """
+        latest = Comment.objects.filter(
+            product_id=models.OuterRef('product_id')
+        ).order_by('-created_at', '-id').values('id')[:count]
+        return self.filter(pk__in=models.Subquery(latest)).for_serializer().order_by(
+            '-created_at', '-id'
+        )
+
+
 class Comment(models.Model):
     user = models.ForeignKey(
         to=User,
@@ -101,10 +264,14 @@ class Comment(models.Model):
     )
     text = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = CommentQuerySet.as_manager()
     
     class Meta:
         verbose_name = 'Комментарий'
         verbose_name_plural = 'Комментарии'
+        # лента комментариев товара по ключу (created_at, id)
+        indexes = [models.Index(fields=['product', 'created_at', 'id'])]
 
     def __str__(self):
         return f'Comment from {self.user.username} to {self.product.name}'
@@ -143,4 +310,144 @@ class Rating(models.Model):
         verbose_name = 'Рейтинг'
 
     def __str__(self):
-        return str(self.rating)
\ No newline at end of file
+        return str(self.rating)
+
+class Cart(models.Model):
+    """Сохраненная копия корзины пользователя, рабочее состояние — в shop.cart"""
+    user = models.OneToOneField(
+        to=User,
+        on_delete=models.CASCADE,
+        related_name='cart'
+    )
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Корзина'
+        verbose_name_plural = 'Корзины'
+
+    def __str__(self):
+        return f'Cart of {self.user_id}'
+
+
+class CartItem(models.Model):
+    cart = models.ForeignKey(
+        to=Cart,
+        on_delete=models.CASCADE,
+        related_name='items'
+    )
+    product = models.ForeignKey(
+        to=Product,
+        on_delete=models.CASCADE,
+        related_name='cart_items'
+    )
+    quantity = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('cart', 'product')
+
+
+class Order(models.Model):
+    RESERVED = 'reserved'
+    PAID = 'paid'
+    CANCELLED = 'cancelled'
+    EXPIRED = 'expired'
+    STATUS_CHOICES = (
+        (RESERVED, 'Товар зарезервирован'),
+        (PAID, 'Оплачен'),
+        (CANCELLED, 'Отменен'),
+        (EXPIRED, 'Резерв истек'),
+    )
+
+    user = models.ForeignKey(
+        to=User,
+        on_delete=models.CASCADE,
+        related_name='orders'
+    )
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=RESERVED)
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    reserved_until = models.DateTimeField()
+
+    class Meta:
+        verbose_name = 'Заказ'
+        verbose_name_plural = 'Заказы'
+        ordering = ('-created_at',)
+        indexes = [models.Index(fields=['status', 'reserved_until'])]
+
+    def __str__(self):
+        return f'Order #{self.pk} of {self.user_id}'
+
+
+class OrderItem(models.Model):
+    order = models.ForeignKey(
+        to=Order,
+        on_delete=models.CASCADE,
+        related_name='items'
+    )
+    # название и цена копируются, чтобы заказ пережил изменение или удаление товара
+    product = models.ForeignKey(
+        to=Product,
+        on_delete=models.SET_NULL,
+        related_name='order_items',
+        null=True
+    )
+    name = models.CharField(max_length=200)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    quantity = models.PositiveIntegerField()
+
+
+class SimilarProduct(models.Model):
+    """Готовый топ похожих товаров, строится shop.recommendations"""
+    product = models.ForeignKey(
+        to=Product,
+        on_delete=models.CASCADE,
+        related_name='similar_products'
+    )
+    similar = models.ForeignKey(
+        to=Product,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        ordering = ('product', 'rank')
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'rank'], name='similar_product_rank'),
+        ]
+
+
+class SimilarProductQueue(models.Model):
+    """Товары, у которых изменились теги, оценки или категория"""
+    # без внешнего ключа: отметка может пережить удаленный товар
+    product_id = models.BigIntegerField(primary_key=True)
+    marked_at = models.DateTimeField()
+
+
+class CategoryLeaderboard(models.Model):
+    """Лучшие товары категории и подкатегорий по байесовской оценке, строится shop.leaderboard"""
+    category = models.ForeignKey(
+        to=Category,
+        on_delete=models.CASCADE,
+        related_name='leaderboard'
+    )
+    product = models.ForeignKey(
+        to=Product,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        ordering = ('category', 'rank')
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'rank'], name='category_leaderboard_rank'),
+        ]
+
+
+class LeaderboardQueue(models.Model):
+    """Категории, в которых изменились оценки или состав товаров"""
+    category_id = models.CharField(max_length=200, primary_key=True)
+    marked_at = models.DateTimeField()
@@ -0,0 +1,142 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from .freshness import version_values
+from .models import Order, OrderItem, Product
+from .signals import products_updated
+
+
+class OutOfStock(Exception):
+    def __init__(self, product_ids):
+        self.product_ids = product_ids
+        super().__init__(f'Недостаточно товара: {", ".join(map(str, product_ids))}')
+
+
+def _quantity_case(quantities):
+    return Case(
+        *[When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()],
+        output_field=IntegerField()
+    )
+
+
+def reserve_stock(quantities):
+    """
+    Списывает остатки всех позиций заказа одним условным UPDATE:
+    stock = stock - n WHERE stock >= n. Если хоть одной позиции не хватило,
+    изменений нет и выбрасывается OutOfStock. available сбрасывается,
+    когда остаток доходит до нуля
+    """
+    if not quantities:
+        return
+    quantity = _quantity_case(quantities)
+    try:
+        # исключение откатывает позиции, которые UPDATE все же списал
+        with transaction.atomic():
+            # available идет первым: в MySQL SET вычисляется слева направо
+            updated = Product.objects.filter(
+                pk__in=quantities, available=True, stock__gte=quantity
+            ).update(
+                available=Case(When(stock=quantity, then=Value(False)), default=F('available')),
+                stock=F('stock') - quantity,
+                **version_values()
+            )
+            if updated != len(quantities):
+                raise OutOfStock([])
+            sold_out = list(Product.objects.filter(
+                pk__in=quantities, stock=0
+            ).values_list('pk', flat=True))
+    except OutOfStock:
+        available = dict(Product.objects.filter(
+            pk__in=quantities, available=True
+        ).values_list('pk', 'stock'))
+        raise OutOfStock(sorted(
+            pk for pk, needed in quantities.items() if available.get(pk, 0) < needed
+        ))
+    products_updated.send(sender=Product, product_ids=list(quantities), availability_changed=sold_out)
+
+
+def release_stock(quantities):
+    """Возвращает остатки; товар, закончившийся из-за резерва, снова доступен"""
+    quantities = {pk: n for pk, n in quantities.items() if pk is not None}
+    if not quantities:
+        return
+    quantity = _quantity_case(quantities)
+    restocked = list(Product.objects.filter(
+        pk__in=quantities, stock=0, available=False
+    ).values_list('pk', flat=True))
+    Product.objects.filter(pk__in=quantities).update(
+        available=Case(When(stock=0, then=Value(True)), default=F('available')),
+        stock=F('stock') + quantity,
+        **version_values()
+    )
+    products_updated.send(sender=Product, product_ids=list(quantities), availability_changed=restocked)
+
+
+def create_order(user, quantities):
+    """Резервирует товар и создает заказ в одной транзакции"""
+    quantities = {int(pk): n for pk, n in quantities.items() if n > 0}
+    if not quantities:
+        raise ValueError('Заказ пуст')
+    with transaction.atomic():
+        reserve_stock(quantities)
+        products = Product.objects.filter(pk__in=quantities).only('name', 'price')
+        order = Order.objects.create(
+            user=user,
+            reserved_until=timezone.now() + timedelta(seconds=settings.ORDER_RESERVATION_TTL),
+        )
+        items = OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product=product,
+                name=product.name,
+                price=product.price,
+                quantity=quantities[product.pk]
+            )
+            for product in products
+        ])
+        order.total = sum(item.price * item.quantity for item in items)
+        order.save(update_fields=['total'])
+    return order
+
+
+def _finish_order(order, status, release):
+    """
+    Переводит заказ из резерва в другой статус условным UPDATE —
+    из параллельных оплаты, отмены и истечения срабатывает только одно
+    """
+    with transaction.atomic():
+        changed = Order.objects.filter(pk=order.pk, status=Order.RESERVED)
+        if status == Order.PAID:
+            changed = changed.filter(reserved_until__gt=timezone.now())
+        if not changed.update(status=status):
+            return False
+        if release:
+            release_stock(dict(order.items.values_list('product_id', 'quantity')))
+    order.status = status
+    return True
+
+
+def pay_order(order):
+    return _finish_order(order, Order.PAID, release=False)
+
+
+def cancel_order(order):
+    return _finish_order(order, Order.CANCELLED, release=True)
+
+
+def release_expired_orders(batch_size=100):
+    """Снимает просроченные резервы, возвращает число освобожденных заказов"""
+    released = 0
+    while True:
+        with transaction.atomic():
+            orders = list(Order.objects.select_for_update(skip_locked=True).filter(
+                status=Order.RESERVED, reserved_until__lte=timezone.now()
+            ).order_by('reserved_until')[:batch_size])
+            for order in orders:
+                released += _finish_order(order, Order.EXPIRED, release=True)
+        if len(orders) < batch_size:
+            return released
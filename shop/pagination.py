@@ -0,0 +1,186 @@
+import base64
+import binascii
+import json
+from collections import OrderedDict
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def _positive_int(value, default, cutoff):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    if value <= 0:
+        return default
+    return min(value, cutoff)
+
+
+def _encode_value(value):
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+class KeysetPagination(BasePagination):
+    """
+    Постраничный вывод по ключу (значение поля сортировки, id) без COUNT и OFFSET.
+    Поле сортировки берется из order_by запроса (OrderingFilter),
+    иначе используется ordering по умолчанию
+    """
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'MAX_PAGE_SIZE', 100)
+    cursor_query_param = 'cursor'
+    ordering = '-created'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.ordering_key = self.get_ordering(queryset)
+        self.field = self.ordering_key.lstrip('-')
+        self.descending = self.ordering_key.startswith('-')
+        self.model_field = self.get_model_field(queryset)
+
+        cursor = self.decode_cursor(request)
+        reverse = bool(cursor and cursor['r'])
+        descending = self.descending != reverse
+        prefix = '-' if descending else ''
+        queryset = queryset.order_by(f'{prefix}{self.field}', f'{prefix}pk')
+        if cursor:
+            lookup = 'lt' if descending else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{self.field}__{lookup}': cursor['v']})
+                | Q(**{self.field: cursor['v'], f'pk__{lookup}': cursor['i']})
+            )
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        return _positive_int(
+            request.query_params.get(self.page_size_query_param),
+            default=self.page_size,
+            cutoff=self.max_page_size
+        )
+
+    def get_ordering(self, queryset):
+        order_by = queryset.query.order_by
+        if order_by and isinstance(order_by[0], str) and order_by[0].lstrip('-') != 'pk':
+            return order_by[0]
+        return self.ordering
+
+    def get_model_field(self, queryset):
+        if self.field in queryset.query.annotations:
+            return None
+        try:
+            return queryset.model._meta.get_field(self.field)
+        except FieldDoesNotExist:
+            return None
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def encode_cursor(self, obj, reverse):
+        payload = {
+            'o': self.ordering_key,
+            'v': _encode_value(getattr(obj, self.field)),
+            'i': obj.pk,
+            'r': int(reverse),
+        }
+        cursor = base64.urlsafe_b64encode(
+            json.dumps(payload, separators=(',', ':')).encode()
+        ).decode()
+        url = remove_query_param(self.base_url, 'page')
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            if cursor['o'] != self.ordering_key:
+                raise ValueError('Cursor belongs to another ordering')
+            if self.model_field is not None:
+                cursor['v'] = self.model_field.to_python(cursor['v'])
+            cursor['i'] = int(cursor['i'])
+        except (binascii.Error, UnicodeDecodeError, ValueError, TypeError,
+                KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+
+class CommentPagination(KeysetPagination):
+    """Лента комментариев товара, новые первыми"""
+    ordering = '-created_at'
+
+
+class LegacyPageNumberPagination(PageNumberPagination):
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'MAX_PAGE_SIZE', 100)
+
+
+class SwitchablePaginationMixin:
+    """
+    По умолчанию отдает курсорную пагинацию, а старым клиентам —
+    постраничную при ?pagination=page или ?page=N
+    """
+    legacy_pagination_class = LegacyPageNumberPagination
+    pagination_mode_query_param = 'pagination'
+
+    @property
+    def paginator(self):
+        request = getattr(self, 'request', None)
+        if not hasattr(self, '_paginator') and request is not None:
+            params = request.query_params
+            legacy = self.legacy_pagination_class
+            if (params.get(self.pagination_mode_query_param) == 'page'
+                    or legacy.page_query_param in params):
+                self._paginator = legacy()
+        return super().paginator
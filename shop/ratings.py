@@ -0,0 +1,52 @@
+from django.db.models import Case, ExpressionWrapper, F, FloatField, Value, When
+from django.db.models.functions import Cast
+
+from .freshness import version_values
+from .models import Product
+
+
+def _update_aggregates(product_id, sum_delta, count_delta, histogram_delta):
+    # Все выражения вычисляются в одном UPDATE по старым значениям строки,
+    # поэтому параллельные оценки не затирают друг друга
+    new_sum = F('rating_sum') + sum_delta
+    new_count = F('rating_count') + count_delta
+    values = {
+        'rating_sum': new_sum,
+        'rating_count': new_count,
+        'rating_avg': Case(
+            When(rating_count=-count_delta, then=Value(0.0)),
+            default=ExpressionWrapper(
+                Cast(new_sum, FloatField()) / new_count,
+                output_field=FloatField()
+            ),
+            output_field=FloatField()
+        ),
+    }
+    for score, delta in histogram_delta.items():
+        field = f'rating_{score}'
+        values[field] = F(field) + delta
+    Product.objects.filter(pk=product_id).update(**values, **version_values())
+
+
+def rating_added(product_id, score):
+    if score is None:
+        return
+    _update_aggregates(product_id, score, 1, {score: 1})
+
+
+def rating_removed(product_id, score):
+    if score is None:
+        return
+    _update_aggregates(product_id, -score, -1, {score: -1})
+
+
+def rating_changed(product_id, old_score, new_score):
+    if old_score == new_score:
+        return
+    if old_score is None:
+        return rating_added(product_id, new_score)
+    if new_score is None:
+        return rating_removed(product_id, old_score)
+    _update_aggregates(
+        product_id, new_score - old_score, 0, {old_score: -1, new_score: 1}
+    )
@@ -0,0 +1,174 @@
+import heapq
+import math
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .models import Product, Rating, SimilarProduct, SimilarProductQueue
+
+
+def mark_stale(product_ids):
+    """Ставит товары в очередь на пересчет похожих; повторная отметка обновляет время"""
+    now = timezone.now()
+    SimilarProductQueue.objects.bulk_create(
+        [SimilarProductQueue(product_id=pk, marked_at=now) for pk in set(product_ids)],
+        update_conflicts=True,
+        unique_fields=['product_id'],
+        update_fields=['marked_at'],
+    )
+
+
+class SimilarityMatrix:
+    """
+    Разреженная матрица сходства товаров. Держит обратные индексы
+    тег -> товары и покупатель -> понравившиеся товары, поэтому строка
+    матрицы считается только по товарам с общим тегом или покупателем.
+    Сходство — взвешенная сумма коэффициента Жаккара по тегам, косинуса
+    по понравившимся покупателям и совпадения категории
+    """
+
+    def __init__(self, products, tags, likes, weights=None):
+        # products: (id, категория, в наличии, средняя оценка); tags: (товар, тег); likes: (пользователь, товар)
+        self.weights = weights or settings.RECOMMENDATION_WEIGHTS
+        self.categories = {}
+        self.available = set()
+        ranked = defaultdict(list)
+        for pk, category, available, rating in products:
+            self.categories[pk] = category
+            if available:
+                self.available.add(pk)
+                ranked[category].append((-rating, pk))
+        # запасные кандидаты для товаров без тегов и оценок: лучшие в категории
+        self.by_category = {category: [pk for _, pk in sorted(items)] for category, items in ranked.items()}
+
+        self.tags, self.tag_products = defaultdict(set), defaultdict(list)
+        for pk, tag in tags:
+            self.tags[pk].add(tag)
+            self.tag_products[tag].append(pk)
+        self.likers, self.liked = defaultdict(set), defaultdict(list)
+        for user, pk in likes:
+            self.likers[pk].add(user)
+            self.liked[user].append(pk)
+
+    @classmethod
+    def load(cls, product_ids=None):
+        """
+        Вся матрица или только окрестность product_ids: товары с общим тегом
+        или покупателем и лучшие товары их категорий — этого достаточно,
+        чтобы посчитать строки product_ids. Теги, стоящие больше чем у
+        RECOMMENDATION_MAX_TAG_PRODUCTS товаров, не учитываются: строка с таким
+        тегом сравнивалась бы со всем каталогом
+        """
+        popular = Product.tag.through.objects.values('tag_id').annotate(
+            products=Count('product_id')
+        ).filter(products__gt=settings.RECOMMENDATION_MAX_TAG_PRODUCTS).values('tag_id')
+        tags = Product.tag.through.objects.exclude(tag_id__in=popular)
+        likes = Rating.objects.filter(rating__gte=settings.RECOMMENDATION_MIN_RATING)
+        products = Product.objects.all()
+        if product_ids is not None:
+            product_ids = list(product_ids)
+            neighbours = (
+                Q(pk__in=product_ids)
+                | Q(pk__in=tags.filter(
+                    tag_id__in=tags.filter(product_id__in=product_ids).values('tag_id')
+                ).values('product_id'))
+                | Q(pk__in=likes.filter(
+                    user_id__in=likes.filter(product_id__in=product_ids).values('user_id')
+                ).values('product_id'))
+            )
+            categories = Product.objects.filter(pk__in=product_ids).values_list('category_id', flat=True)
+            best = []
+            for category in set(categories):
+                best.extend(Product.objects.filter(category_id=category, available=True).order_by(
+                    '-rating_avg', 'pk'
+                ).values_list('pk', flat=True)[:settings.RECOMMENDATIONS_TOP_K + 1])
+            products = products.filter(neighbours | Q(pk__in=best))
+            tags = tags.filter(product_id__in=products.values('pk'))
+            likes = likes.filter(product_id__in=products.values('pk'))
+        return cls(
+            products.values_list('pk', 'category_id', 'available', 'rating_avg'),
+            tags.values_list('product_id', 'tag_id'),
+            likes.values_list('user_id', 'product_id'),
+        )
+
+    def scores(self, pk):
+        """Ненулевые сходства товара с остальными товарами в наличии"""
+        tags, likers = self.tags.get(pk, ()), self.likers.get(pk, ())
+        shared_tags = Counter(other for tag in tags for other in self.tag_products[tag])
+        shared_likers = Counter(other for user in likers for other in self.liked[user])
+        category = self.categories.get(pk)
+        weights = self.weights
+        scores = {}
+        for other in shared_tags.keys() | shared_likers.keys():
+            if other == pk or other not in self.available:
+                continue
+            score = 0.0
+            common = shared_tags[other]
+            if common:
+                score += weights['tags'] * common / (len(tags) + len(self.tags[other]) - common)
+            common = shared_likers[other]
+            if common:
+                score += weights['ratings'] * common / math.sqrt(len(likers) * len(self.likers[other]))
+            if self.categories[other] == category:
+                score += weights['category']
+            scores[other] = score
+        return scores
+
+    def top(self, pk, count):
+        """count самых похожих товаров: [(id, сходство)]"""
+        scores = self.scores(pk)
+        if len(scores) < count:
+            for other in self.by_category.get(self.categories.get(pk), ())[:count + 1]:
+                if other != pk:
+                    scores.setdefault(other, self.weights['category'])
+        return heapq.nlargest(count, scores.items(), key=lambda item: (item[1], -item[0]))
+
+
+def refresh_recommendations(full=False, batch_size=500):
+    """
+    Пересчитывает похожие товары: все (full) или только затронутые
+    отмеченными изменениями. Кроме самих отмеченных товаров пересчитываются
+    те, в чьем топе они стоят, и те, в чей топ они теперь проходят.
+    Возвращает число пересчитанных товаров
+    """
+    started = timezone.now()
+    queue = SimilarProductQueue.objects.filter(marked_at__lte=started)
+    dirty = set(queue.values_list('product_id', flat=True))
+    if not dirty and not full:
+        return 0
+    count = settings.RECOMMENDATIONS_TOP_K
+
+    if full:
+        matrix = SimilarityMatrix.load()
+        affected = set(matrix.categories)
+    else:
+        # окрестность отмеченных товаров, затем — окрестность всех затронутых
+        matrix = SimilarityMatrix.load(dirty)
+        changed = dirty & matrix.categories.keys()
+        affected = set(changed)
+        affected.update(SimilarProduct.objects.filter(
+            similar_id__in=dirty
+        ).values_list('product_id', flat=True))
+        # худший из сохраненных соседей; у кого соседей меньше count, проходит любой
+        last = dict(SimilarProduct.objects.filter(rank=count - 1).values_list('product_id', 'score'))
+        for pk in changed:
+            affected.update(other for other, score in matrix.scores(pk).items() if score > last.get(other, -1))
+        matrix = SimilarityMatrix.load(affected)
+
+    affected = sorted(affected & matrix.categories.keys())
+    for start in range(0, len(affected), batch_size):
+        batch = affected[start:start + batch_size]
+        rows = [
+            SimilarProduct(product_id=pk, similar_id=other, rank=rank, score=round(score, 4))
+            for pk in batch
+            for rank, (other, score) in enumerate(matrix.top(pk, count))
+        ]
+        with transaction.atomic():
+            SimilarProduct.objects.filter(product_id__in=batch).delete()
+            SimilarProduct.objects.bulk_create(rows)
+    # отметки, сделанные во время пересчета, остаются до следующего запуска
+    queue.delete()
+    return len(affected)
@@ -0,0 +1,280 @@
+import hashlib
+import json
+import logging
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from myshop.routers import primary_reads
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+
+class LocMemBackend:
+    """LRU-кэш в памяти процесса с TTL на каждую запись"""
+    shared = False
+
+    def __init__(self, max_entries=1000, **kwargs):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        expires = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            self._data[key] = (pickle.dumps(value), expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[1] is None or entry[1] >= time.monotonic()):
+                return False
+        self.set(key, value, timeout)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisBackend:
+    """
+    Кэш в Redis. Вытеснение по LRU настраивается на сервере:
+    maxmemory-policy allkeys-lru
+    """
+    shared = True
+
+    def __init__(self, location, prefix='shop', **kwargs):
+        import redis
+        self.client = redis.Redis.from_url(location)
+        self.prefix = prefix
+
+    def _key(self, key):
+        return f'{self.prefix}:{key}'
+
+    def get(self, key):
+        value = self.client.get(self._key(key))
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        self.client.set(self._key(key), pickle.dumps(value), ex=timeout or None)
+
+    def add(self, key, value, timeout=None):
+        return bool(self.client.set(self._key(key), pickle.dumps(value), ex=timeout or None, nx=True))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self._key('*')))
+        if keys:
+            self.client.delete(*keys)
+
+
+BACKENDS = {
+    'locmem': LocMemBackend,
+    'redis': RedisBackend,
+}
+
+
+class SingleFlight:
+    """Одновременные вызовы с одним ключом ждут результат первого"""
+
+    class Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """Возвращает (результат, был ли вызов объединен с чужим)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+
+class ResponseCache:
+    """
+    Кэш ответов list/retrieve товаров. Ключ включает версию товара
+    (или версию списка) — при изменении версия заменяется новой случайной,
+    и старые записи больше не читаются, а доживают до TTL или вытеснения
+    """
+    LOCK_POLL_INTERVAL = 0.05
+
+    def __init__(self, backend, timeout=60, lock_timeout=5):
+        self.backend = backend
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self.single_flight = SingleFlight()
+        self._stats_lock = threading.Lock()
+        self.counters = dict.fromkeys(('hits', 'misses', 'coalesced'), 0)
+
+    @classmethod
+    def from_settings(cls):
+        options = dict(getattr(settings, 'PRODUCT_CACHE', {}))
+        backend_class = BACKENDS[options.pop('BACKEND', 'locmem')]
+        backend = backend_class(
+            location=options.get('LOCATION'),
+            max_entries=options.get('MAX_ENTRIES', 1000)
+        )
+        return cls(backend, timeout=options.get('TIMEOUT', 60))
+
+    def warn_if_local(self):
+        """
+        Сброс версий в кэше процесса не доходит до других процессов и до задач
+        Celery в воркерах: их изменения видны только по истечении TIMEOUT
+        """
+        if self.backend.shared or getattr(settings, 'CELERY_TASK_ALWAYS_EAGER', False):
+            return False
+        logger.warning(
+            'PRODUCT_CACHE в памяти процесса: изменения из других процессов и задач Celery '
+            'будут видны в ответах с задержкой до %s с, для нескольких процессов нужен redis',
+            self.timeout
+        )
+        return True
+
+    def _count(self, counter):
+        with self._stats_lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self.counters)
+        total = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / total if total else 0.0
+        return stats
+
+    def version(self, scope):
+        key = f'version:{scope}'
+        version = self.backend.get(key)
+        if version is None:
+            self.backend.add(key, uuid.uuid4().hex)
+            version = self.backend.get(key)
+        return version
+
+    def invalidate(self, product_ids):
+        for product_id in product_ids:
+            self.backend.set(f'version:product:{product_id}', uuid.uuid4().hex)
+        self.backend.set('version:list', uuid.uuid4().hex)
+
+    def key(self, request, action, pk=None):
+        scope = 'list' if pk is None else f'product:{pk}'
+        params = sorted(request.query_params.lists())
+        digest = hashlib.sha1(
+            json.dumps([request.path, params]).encode()
+        ).hexdigest()
+        return f'response:{action}:{self.version(scope)}:{digest}'
+
+    def get_or_compute(self, key, compute):
+        """Возвращает (данные, попадание в кэш)"""
+        cached = self.backend.get(key)
+        if cached is not None:
+            self._count('hits')
+            return cached, True
+        self._count('misses')
+        value, coalesced = self.single_flight.do(key, lambda: self._fill(key, compute))
+        if coalesced:
+            self._count('coalesced')
+        return value, False
+
+    def remember(self, key, compute):
+        """Для дешевых значений: без счетчиков и объединения промахов"""
+        value = self.backend.get(key)
+        if value is None:
+            value = compute()
+            self.backend.set(key, value, self.timeout)
+        return value
+
+    def _fill(self, key, compute):
+        # между процессами промахи объединяет короткая блокировка в бэкенде
+        lock_key = f'lock:{key}'
+        locked = self.backend.add(lock_key, 1, self.lock_timeout)
+        if not locked:
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(self.LOCK_POLL_INTERVAL)
+                cached = self.backend.get(key)
+                if cached is not None:
+                    return cached
+        try:
+            value = compute()
+            self.backend.set(key, value, self.timeout)
+        finally:
+            if locked:
+                self.backend.delete(lock_key)
+        return value
+
+    def clear(self):
+        self.backend.clear()
+
+
+response_cache = ResponseCache.from_settings()
+
+
+class CachedResponseMixin:
+    """Кэширует list и retrieve для анонимных GET-запросов"""
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if request.method != 'GET' or request.user.is_authenticated:
+            return handler(request, *args, **kwargs)
+
+        def compute():
+            # в кэш под новой версией не должна попасть строка с отстающей реплики
+            with primary_reads():
+                response = handler(request, *args, **kwargs)
+            return response.status_code, response.data
+
+        pk = kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        key = response_cache.key(request, self.action, pk)
+        (status_code, data), hit = response_cache.get_or_compute(key, compute)
+        return Response(data, status=status_code, headers={'X-Cache': 'HIT' if hit else 'MISS'})
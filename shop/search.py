@@ -0,0 +1,377 @@
+import math
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Case, IntegerField, Prefetch, Value, When
+from rest_framework.filters import BaseFilterBackend
+from rest_framework.settings import api_settings
+
+from .models import Product, Tag
+
+TOKEN_RE = re.compile(r'\w+')
+CYRILLIC_RE = re.compile(r'^[а-я]+$')
+LATIN_RE = re.compile(r'^[a-z]+$')
+
+# имя поля документа -> вес при подсчете частоты терма
+FIELD_WEIGHTS = {
+    'name': 3.0,
+    'tags': 2.0,
+    'category': 2.0,
+    'seller': 1.0,
+    'description': 1.0,
+}
+
+
+class RussianStemmer:
+    """Стеммер Портера для русского языка"""
+    VOWELS = re.compile(r'^(.*?[аеиоуыэюя])(.*)$')
+    PERFECTIVE_GERUND = re.compile(r'((ив|ивши|ившись|ыв|ывши|ывшись)|((?<=[ая])(в|вши|вшись)))$')
+    REFLEXIVE = re.compile(r'(с[яь])$')
+    ADJECTIVE = re.compile(
+        r'(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$'
+    )
+    PARTICIPLE = re.compile(r'((ивш|ывш|ующ)|((?<=[ая])(ем|нн|вш|ющ|щ)))$')
+    VERB = re.compile(
+        r'((ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|ыть|ишь|ую|ю)'
+        r'|((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)))$'
+    )
+    NOUN = re.compile(
+        r'(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|ью|ю|ия|ья|я)$'
+    )
+    DERIVATIONAL = re.compile(r'.*[^аеиоуыэюя]+[аеиоуыэюя].*ость?$')
+    DERIVATIONAL_SUFFIX = re.compile(r'ость?$')
+    SUPERLATIVE = re.compile(r'(ейше|ейш)$')
+
+    def stem(self, word):
+        match = self.VOWELS.match(word)
+        if match is None:
+            return word
+        prefix, rv = match.groups()
+        temp = self.PERFECTIVE_GERUND.sub('', rv, 1)
+        if temp == rv:
+            rv = self.REFLEXIVE.sub('', rv, 1)
+            temp = self.ADJECTIVE.sub('', rv, 1)
+            if temp != rv:
+                rv = self.PARTICIPLE.sub('', temp, 1)
+            else:
+                temp = self.VERB.sub('', rv, 1)
+                rv = self.NOUN.sub('', rv, 1) if temp == rv else temp
+        else:
+            rv = temp
+        rv = re.sub(r'и$', '', rv, 1)
+        if self.DERIVATIONAL.match(rv):
+            rv = self.DERIVATIONAL_SUFFIX.sub('', rv, 1)
+        temp = re.sub(r'ь$', '', rv, 1)
+        if temp == rv:
+            rv = self.SUPERLATIVE.sub('', rv, 1)
+            rv = re.sub(r'нн$', 'н', rv, 1)
+        else:
+            rv = temp
+        return prefix + rv
+
+
+class EnglishStemmer:
+    """Облегченный стеммер: снимает окончания множественного числа и глаголов"""
+    SUFFIXES = (
+        ('sses', 'ss'), ('ies', 'y'), ('ied', 'y'), ('ing', ''),
+        ('ed', ''), ('ly', ''), ('s', ''),
+    )
+    MIN_STEM = 3
+
+    def stem(self, word):
+        for suffix, replacement in self.SUFFIXES:
+            if word.endswith(suffix) and len(word) - len(suffix) >= self.MIN_STEM:
+                if suffix == 's' and word.endswith(('ss', 'us', 'is')):
+                    break
+                word = word[:-len(suffix)] + replacement
+                break
+        if word.endswith('e') and len(word) > self.MIN_STEM + 1:
+            word = word[:-1]
+        return word
+
+
+russian_stemmer = RussianStemmer()
+english_stemmer = EnglishStemmer()
+
+
+def tokenize(text):
+    terms = []
+    for token in TOKEN_RE.findall(text.lower().replace('ё', 'е')):
+        if CYRILLIC_RE.match(token):
+            token = russian_stemmer.stem(token)
+        elif LATIN_RE.match(token):
+            token = english_stemmer.stem(token)
+        if token:
+            terms.append(token)
+    return terms
+
+
+def trigrams(term):
+    padded = f'  {term} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """
+    Обратный индекс с ранжированием BM25 и нечетким поиском по триграммам.
+    Потокобезопасен, все изменения идут под одной блокировкой
+    """
+
+    def __init__(self, k1=1.2, b=0.75, fuzzy_threshold=0.35, fuzzy_expansions=3):
+        self.k1 = k1
+        self.b = b
+        self.fuzzy_threshold = fuzzy_threshold
+        self.fuzzy_expansions = fuzzy_expansions
+        self._lock = threading.RLock()
+        self.postings = defaultdict(dict)  # терм -> {id документа: вес}
+        self.documents = {}  # id документа -> {терм: вес}
+        self.lengths = {}
+        self.total_length = 0.0
+        self.trigram_terms = defaultdict(set)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, doc_id, fields):
+        frequencies = defaultdict(float)
+        for field, text in fields.items():
+            weight = FIELD_WEIGHTS.get(field, 1.0)
+            for term in tokenize(text or ''):
+                frequencies[term] += weight
+        with self._lock:
+            self._remove(doc_id)
+            for term, frequency in frequencies.items():
+                if term not in self.postings:
+                    for trigram in trigrams(term):
+                        self.trigram_terms[trigram].add(term)
+                self.postings[term][doc_id] = frequency
+            self.documents[doc_id] = dict(frequencies)
+            self.lengths[doc_id] = sum(frequencies.values())
+            self.total_length += self.lengths[doc_id]
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        terms = self.documents.pop(doc_id, None)
+        if terms is None:
+            return
+        self.total_length -= self.lengths.pop(doc_id)
+        for term in terms:
+            postings = self.postings[term]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[term]
+                for trigram in trigrams(term):
+                    self.trigram_terms[trigram].discard(term)
+                    if not self.trigram_terms[trigram]:
+                        del self.trigram_terms[trigram]
+
+    def clear(self):
+        with self._lock:
+            self.postings.clear()
+            self.documents.clear()
+            self.lengths.clear()
+            self.trigram_terms.clear()
+            self.total_length = 0.0
+
+    def expand(self, term):
+        """Возвращает термы словаря, близкие к term, с коэффициентом похожести"""
+        if term in self.postings:
+            return [(term, 1.0)]
+        query_trigrams = trigrams(term)
+        shared = defaultdict(int)
+        for trigram in query_trigrams:
+            for candidate in self.trigram_terms.get(trigram, ()):
+                shared[candidate] += 1
+        similar = []
+        for candidate, count in shared.items():
+            similarity = count / (len(query_trigrams) + len(trigrams(candidate)) - count)
+            if similarity >= self.fuzzy_threshold:
+                similar.append((candidate, similarity))
+        similar.sort(key=lambda item: item[1], reverse=True)
+        return similar[:self.fuzzy_expansions]
+
+    def search(self, query, limit=None):
+        with self._lock:
+            total = len(self.documents)
+            if not total:
+                return []
+            average_length = self.total_length / total or 1.0
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                for candidate, similarity in self.expand(term):
+                    postings = self.postings[candidate]
+                    idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for doc_id, frequency in postings.items():
+                        norm = 1 - self.b + self.b * self.lengths[doc_id] / average_length
+                        scores[doc_id] += similarity * idf * (
+                            frequency * (self.k1 + 1) / (frequency + self.k1 * norm)
+                        )
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit] if limit else ranked
+
+
+def product_document(product):
+    return {
+        'name': product.name,
+        'description': product.description,
+        'tags': ' '.join(tag.name for tag in product.tag.all()),
+        'category': product.category_id,
+        'seller': product.user_id,
+    }
+
+
+def indexed_products():
+    return Product.objects.only(
+        'id', 'name', 'description', 'category', 'user'
+    ).prefetch_related(Prefetch('tag', queryset=Tag.objects.only('name')))
+
+
+class ProductSearch:
+    """
+    Индекс товаров в памяти процесса. Изменения, сделанные другими процессами,
+    подтягиваются через общий кэш: журнал id измененных товаров и метка
+    поколения, которую меняет полная перестройка.
+    С LocMemCache журнал виден только своему процессу: свои изменения
+    применяются сразу, а чужие — полной перестройкой раз в SEARCH_REBUILD_INTERVAL
+    """
+    GENERATION_KEY = 'search:generation'
+    SEQUENCE_KEY = 'search:sequence'
+    CHANGE_KEY = 'search:change:{}'
+    CHANGE_TIMEOUT = 60 * 60
+    MAX_REPLAY = 1000
+    CHUNK_SIZE = 2000
+
+    def __init__(self):
+        self.index = SearchIndex(
+            fuzzy_threshold=getattr(settings, 'SEARCH_FUZZY_THRESHOLD', 0.35)
+        )
+        self.generation = None
+        self.sequence = 0
+        self.built_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return not isinstance(caches['default'], (LocMemCache, DummyCache))
+
+    def expired(self):
+        if self.built_at is None:
+            return True
+        interval = getattr(settings, 'SEARCH_REBUILD_INTERVAL', 60)
+        return not self.shared and time.monotonic() - self.built_at >= interval
+
+    def search(self, query, limit=None):
+        self.sync()
+        return self.index.search(query, limit)
+
+    def current_generation(self):
+        cache.add(self.GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+        return cache.get(self.GENERATION_KEY)
+
+    def sync(self):
+        with self._lock:
+            generation = self.current_generation()
+            sequence = cache.get(self.SEQUENCE_KEY, 0)
+            # сброс кэша меняет поколение, поэтому журнал не перепутается
+            if generation != self.generation or sequence < self.sequence or self.expired():
+                self._build(generation, sequence)
+            elif sequence > self.sequence:
+                keys = [self.CHANGE_KEY.format(n) for n in range(self.sequence + 1, sequence + 1)]
+                if len(keys) > self.MAX_REPLAY:
+                    return self._build(generation, sequence)
+                changed = cache.get_many(keys)
+                if len(changed) != len(keys):
+                    return self._build(generation, sequence)
+                self.reindex(set(changed.values()))
+                self.sequence = sequence
+
+    def _build(self, generation, sequence):
+        self.index.clear()
+        for product in indexed_products().iterator(chunk_size=self.CHUNK_SIZE):
+            self.index.add(product.pk, product_document(product))
+        self.generation = generation
+        self.sequence = sequence
+        self.built_at = time.monotonic()
+
+    def reindex(self, product_ids):
+        found = set()
+        for product in indexed_products().filter(pk__in=product_ids):
+            self.index.add(product.pk, product_document(product))
+            found.add(product.pk)
+        for product_id in set(product_ids) - found:
+            self.index.remove(product_id)
+
+    def notify(self, product_ids):
+        """Отмечает товары измененными для всех процессов"""
+        if not product_ids:
+            return
+        if not self.shared:
+            # журнал в LocMemCache никто, кроме этого процесса, не прочитает
+            with self._lock:
+                if self.built_at is not None:
+                    self.reindex(product_ids)
+            return
+        cache.add(self.SEQUENCE_KEY, 0, timeout=None)
+        for product_id in product_ids:
+            sequence = cache.incr(self.SEQUENCE_KEY)
+            cache.set(self.CHANGE_KEY.format(sequence), product_id, self.CHANGE_TIMEOUT)
+
+    def invalidate_all(self):
+        """Все процессы перестроят индекс при следующем поиске"""
+        generation = uuid.uuid4().hex
+        cache.set(self.GENERATION_KEY, generation, timeout=None)
+        return generation
+
+    def rebuild(self):
+        generation = self.invalidate_all()
+        with self._lock:
+            self._build(generation, cache.get(self.SEQUENCE_KEY, 0))
+        return len(self.index)
+
+
+product_search = ProductSearch()
+
+
+class ProductSearchFilter(BaseFilterBackend):
+    """
+    Фильтр по параметру SEARCH_PARAM: оставляет найденные товары
+    и сортирует их по релевантности через аннотацию search_rank
+    """
+    search_param = api_settings.SEARCH_PARAM
+    search_title = 'Search'
+    search_description = 'Полнотекстовый поиск по названию, описанию, тегам и категории.'
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '').strip()
+        if not query:
+            return queryset
+        hits = product_search.search(
+            query, limit=getattr(settings, 'SEARCH_MAX_RESULTS', 1000)
+        )
+        if not hits:
+            return queryset.none()
+        ids = [product_id for product_id, _ in hits]
+        rank = Case(
+            *[When(pk=product_id, then=Value(n)) for n, product_id in enumerate(ids)],
+            output_field=IntegerField()
+        )
+        return queryset.filter(pk__in=ids).annotate(search_rank=rank).order_by('search_rank')
+
+    def get_schema_operation_parameters(self, view):
+        return [{
+            'name': self.search_param,
+            'required': False,
+            'in': 'query',
+            'description': self.search_description,
+            'schema': {'type': 'string'},
+        }]
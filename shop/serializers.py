@@ -2,30 +2,105 @@ from dataclasses import fields
 from email.policy import default
 from requests import request
 from rest_framework import serializers
-from django.db.models import Avg
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
 from .models import(
     Category,
     Product,
     ProductImage,
     Tag,
     Comment,
-    Rating
+    Rating,
+    Order,
+    OrderItem
 )
+from .images import variants_representation
+from .ratings import rating_added, rating_changed
+from .signals import schedule_image_processing
+
+
+class ImageVariantsField(serializers.ReadOnlyField):
+    def to_representation(self, value):
+        request = self.context.get('request')
+
+        def url(name):
+            url = default_storage.url(name)
+            return request.build_absolute_uri(url) if request else url
+
+        return variants_representation(value, url)
 
 class CategoryListSerializer(serializers.ModelSerializer):   
+    parent = serializers.SlugRelatedField(
+        slug_field='slug',
+        queryset=Category.objects.all(),
+        allow_null=True,
+        required=False
+    )
+
+    class Meta:
+        model = Category
+        fields = ('name', 'slug', 'parent')
+
+    def validate_parent(self, parent):
+        if parent is not None and self.instance is not None and (
+            self.instance.descendants().filter(pk=parent.pk).exists()
+        ):
+            raise serializers.ValidationError(
+                'Нельзя перенести категорию в ее собственную подкатегорию'
+            )
+        return parent
+
+
+class CategorySerializer(serializers.ModelSerializer):
+    parent = serializers.SlugRelatedField(slug_field='slug', read_only=True)
+    product_count = serializers.IntegerField(source='stats.product_count', read_only=True)
+    available_count = serializers.IntegerField(source='stats.available_count', read_only=True)
+    min_price = serializers.DecimalField(
+        source='stats.min_price', max_digits=10, decimal_places=2, read_only=True
+    )
+    max_price = serializers.DecimalField(
+        source='stats.max_price', max_digits=10, decimal_places=2, read_only=True
+    )
+
     class Meta:
         model = Category
-        fields = ('name', 'slug')
+        fields = ('name', 'slug', 'parent', 'product_count', 'available_count', 'min_price', 'max_price')
 
 
 class ProductListSerializer(serializers.ModelSerializer):
+    image_variants = ImageVariantsField()
+
     class Meta:
         model = Product
-        fields = ('user', 'name', 'image', 'slug')
+        fields = ('user', 'name', 'image', 'image_variants', 'slug')
+
+
+class SimilarProductSerializer(ProductListSerializer):
+    rating = serializers.SerializerMethodField()
+    similarity = serializers.FloatField(read_only=True)
+
+    class Meta(ProductListSerializer.Meta):
+        fields = ('id', 'name', 'slug', 'price', 'image', 'image_variants', 'rating', 'similarity')
+
+    def get_rating(self, instance):
+        return round(instance.rating_avg, 1)
+
+
+class TopProductSerializer(ProductListSerializer):
+    rating = serializers.SerializerMethodField()
+    score = serializers.FloatField(read_only=True)
+
+    class Meta(ProductListSerializer.Meta):
+        fields = ('id', 'name', 'slug', 'price', 'image', 'image_variants', 'rating', 'rating_count', 'score')
+
+    def get_rating(self, instance):
+        return round(instance.rating_avg, 1)
 
 
 class ProductSerializer(serializers.ModelSerializer):
     user = serializers.ReadOnlyField(source='user.username')    
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Product
@@ -34,20 +109,42 @@ class ProductSerializer(serializers.ModelSerializer):
     def to_representation(self, instance):
         representation = super().to_representation(instance)
         representation['comments'] = CommentSerializer(
-            instance.comments.all(), many=True).data
+            self.latest_comments(instance), many=True).data
         representation['carousel'] = ProductImageSerializer(
             instance.product_images.all(), many=True).data
-        # rating = instance.ratings.aggregate(Avg('rating'))['rating__avg']
-        # if rating:
-        #     representation['rating'] = round(rating, 1)
-        # else:
-        #     representation['rating'] = 0.0
+        for score in instance.rating_histogram:
+            representation.pop(f'rating_{score}', None)
+        representation['rating'] = round(instance.rating_avg, 1)
+        representation['rating_histogram'] = instance.rating_histogram
         return representation
 
+    def update(self, instance, validated_data):
+        # пишутся только присланные поля: остатки, списанные заказами
+        # после загрузки товара, не перезаписываются
+        tags = validated_data.pop('tag', None)
+        for name, value in validated_data.items():
+            setattr(instance, name, value)
+        with transaction.atomic():
+            instance.save(update_fields=list(validated_data))
+            if tags is not None:
+                instance.tag.set(tags)
+        return instance
+
+    def latest_comments(self, instance):
+        # for_serializer() подгружает их заранее для всей страницы
+        comments = getattr(instance, 'latest_comments', None)
+        if comments is None:
+            comments = instance.comments.for_serializer().order_by(
+                '-created_at', '-id'
+            )[:settings.PRODUCT_LATEST_COMMENTS]
+        return comments
+
 class ProductImageSerializer(serializers.ModelSerializer):
+    variants = ImageVariantsField()
+
     class Meta:
         model = ProductImage
-        fields = 'image',
+        fields = ('image', 'variants')
 
 
 class ProductCreateSerializer(serializers.ModelSerializer):
@@ -68,12 +165,16 @@ class ProductCreateSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         carousel_images = validated_data.pop('carousel_img')
         tag = validated_data.pop('tag')
-        product = Product.objects.create(**validated_data)
-        product.tag.set(tag)
-        images = []
-        for image in carousel_images:
-            images.append(ProductImage(product=product, image=image))
-        ProductImage.objects.bulk_create(images)
+        with transaction.atomic():
+            product = Product.objects.create(**validated_data)
+            product.tag.set(tag)
+            images = []
+            for image in carousel_images:
+                images.append(ProductImage(product=product, image=image))
+            ProductImage.objects.bulk_create(images)
+            # bulk_create не вызывает post_save, поэтому карусель ставится в обработку здесь
+            if images:
+                schedule_image_processing(product.pk)
         return product
 
 
@@ -106,9 +207,21 @@ class RatingSerializer(serializers.ModelSerializer):
             )
         return attrs
 
+    @transaction.atomic
+    def create(self, validated_data):
+        rating = super().create(validated_data)
+        rating_added(rating.product_id, rating.rating)
+        return rating
+
+    @transaction.atomic
     def update(self, instance, validated_data):
+        old_rating = Rating.objects.select_for_update().values_list(
+            'rating', flat=True
+        ).get(pk=instance.pk)
         instance.rating = validated_data.get('rating')
-        return super().update(instance, validated_data)
+        instance = super().update(instance, validated_data)
+        rating_changed(instance.product_id, old_rating, instance.rating)
+        return instance
 
 
 class TagSerializer(serializers.ModelSerializer):
@@ -127,3 +240,31 @@ class TagSerializer(serializers.ModelSerializer):
 
 #     def __call__(self, serializer_field):
 #         return serializer_field.context['post']
+
+
+class CartItemSerializer(serializers.Serializer):
+    product = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1, default=1)
+
+
+class CartQuantitySerializer(serializers.Serializer):
+    quantity = serializers.IntegerField(min_value=0)
+
+
+class CheckoutSerializer(serializers.Serializer):
+    # без items оформляется текущая корзина
+    items = CartItemSerializer(many=True, required=False)
+
+
+class OrderItemSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = OrderItem
+        fields = ('product', 'name', 'price', 'quantity')
+
+
+class OrderSerializer(serializers.ModelSerializer):
+    items = OrderItemSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = Order
+        fields = ('id', 'status', 'total', 'created_at', 'reserved_until', 'items')
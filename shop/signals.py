@@ -0,0 +1,309 @@
+import logging
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import Signal, receiver
+
+from .cart import cart_service
+from .categories import (
+    adjust_category_stats, insert_category_node, move_category_subtree, refresh_category_stats
+)
+from .freshness import touch_products
+from .models import Category, CategoryClosure, Comment, Product, ProductImage, Rating, SimilarProduct, Tag
+from .leaderboard import mark_categories
+from .ratings import rating_removed
+from .recommendations import mark_stale
+from .response_cache import response_cache
+from .search import product_search
+from .tasks import process_product_images, release_carousel_image
+
+logger = logging.getLogger(__name__)
+
+
+# Отправляется после массовых UPDATE товаров (резерв остатков и т.п.),
+# которые не вызывают post_save. Аргументы: product_ids и availability_changed —
+# товары, у которых при этом переключилось available
+products_updated = Signal()
+
+
+@receiver(post_delete, sender=Rating)
+def remove_rating_from_aggregates(sender, instance, **kwargs):
+    rating_removed(instance.product_id, instance.rating)
+
+
+def invalidate_products(product_ids):
+    product_ids = list(product_ids)
+    transaction.on_commit(lambda: response_cache.invalidate(product_ids))
+
+
+def reindex_products(product_ids, touch=False):
+    product_ids = list(product_ids)
+    transaction.on_commit(lambda: product_search.notify(product_ids))
+    if touch:
+        touch_products(product_ids)
+    invalidate_products(product_ids)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def reindex_product(sender, instance, **kwargs):
+    reindex_products([instance.pk])
+
+
+# версию товара при изменении оценки повышает shop.ratings
+@receiver(post_save, sender=Rating)
+@receiver(post_delete, sender=Rating)
+def invalidate_product_relation(sender, instance, **kwargs):
+    invalidate_products([instance.product_id])
+    mark_stale([instance.product_id])
+    # в set_rating товар уже загружен сериализатором
+    if Rating.product.is_cached(instance):
+        mark_categories([instance.product.category_id])
+    else:
+        mark_categories(Product.objects.filter(pk=instance.product_id).values_list('category_id', flat=True))
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def touch_product_images(sender, instance, **kwargs):
+    touch_products([instance.product_id])
+    invalidate_products([instance.product_id])
+
+
+@receiver(post_save, sender=Comment)
+def count_added_comment(sender, instance, created, **kwargs):
+    values = {'comment_count': F('comment_count') + 1} if created else {}
+    touch_products([instance.product_id], **values)
+    invalidate_products([instance.product_id])
+
+
+@receiver(post_delete, sender=Comment)
+def count_removed_comment(sender, instance, **kwargs):
+    touch_products([instance.product_id], comment_count=Greatest(F('comment_count') - 1, 0))
+    invalidate_products([instance.product_id])
+
+
+@receiver(m2m_changed, sender=Product.tag.through)
+def reindex_product_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        instance._product_ids = list(instance.products.values_list('pk', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        product_ids = [instance.pk]
+    elif action == 'post_clear':
+        product_ids = getattr(instance, '_product_ids', [])
+    else:
+        product_ids = pk_set
+    reindex_products(product_ids, touch=True)
+    mark_stale(product_ids)
+
+
+@receiver(post_save, sender=Tag)
+def reindex_tag_products(sender, instance, created, **kwargs):
+    if not created:
+        reindex_products(instance.products.values_list('pk', flat=True), touch=True)
+
+
+@receiver(pre_delete, sender=Tag)
+def remember_tag_products(sender, instance, **kwargs):
+    instance._product_ids = list(instance.products.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+def reindex_deleted_tag_products(sender, instance, **kwargs):
+    reindex_products(getattr(instance, '_product_ids', []), touch=True)
+    mark_stale(getattr(instance, '_product_ids', []))
+
+
+def schedule_image_processing(product_id):
+    transaction.on_commit(lambda: process_product_images.delay(product_id))
+
+
+@receiver(post_save, sender=Product)
+def process_new_product_image(sender, instance, **kwargs):
+    if instance.image and instance.image_variants.get('source') != instance.image.name:
+        schedule_image_processing(instance.pk)
+
+
+@receiver(post_save, sender=ProductImage)
+def process_new_carousel_image(sender, instance, **kwargs):
+    if instance.image and instance.variants.get('source') != instance.image.name:
+        schedule_image_processing(instance.product_id)
+
+
+@receiver(post_delete, sender=ProductImage)
+def release_deleted_carousel_image(sender, instance, **kwargs):
+    if instance.image:
+        name, variants = instance.image.name, instance.variants
+        transaction.on_commit(lambda: release_carousel_image(name, variants))
+
+
+def schedule_category_stats(category_ids):
+    category_ids = set(category_ids)
+    transaction.on_commit(lambda: refresh_category_stats(category_ids))
+
+
+# поля товара, от которых зависит статистика категорий
+STATS_FIELDS = ('category_id', 'available', 'price')
+
+
+def product_stats_values(instance):
+    price = Product._meta.get_field('price').to_python(instance.price)
+    return instance.category_id, instance.available, price
+
+
+def saved_stats_fields(update_fields):
+    if update_fields is None:
+        return set(STATS_FIELDS)
+    return {Product._meta.get_field(name).attname for name in update_fields} & set(STATS_FIELDS)
+
+
+def locked_stats_values(pk):
+    # строка, какой она будет перезаписана, а не какой ее когда-то загрузил экземпляр;
+    # блокировка держится до конца транзакции сохранения (Product.save) или удаления
+    return Product.objects.select_for_update().filter(pk=pk).values_list(*STATS_FIELDS).first()
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_category(sender, instance, raw=False, update_fields=None, **kwargs):
+    instance._old_stats_values = None
+    if instance.pk is not None and not raw and saved_stats_fields(update_fields):
+        instance._old_stats_values = locked_stats_values(instance.pk)
+    # при переносе товара нужно обновить и старую категорию
+    instance._old_category_id = instance._old_stats_values[0] if instance._old_stats_values else None
+
+
+@receiver(post_save, sender=Product)
+def update_category_stats(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw:
+        schedule_category_stats([instance.category_id])
+        return
+    saved = saved_stats_fields(update_fields)
+    old = instance._old_stats_values
+    if not saved or (old is None and not created):
+        return
+    new = product_stats_values(instance)
+    if old is not None:
+        new = tuple(
+            value if name in saved else previous
+            for name, value, previous in zip(STATS_FIELDS, new, old)
+        )
+    adjust_category_stats([(old, new)])
+
+
+@receiver(pre_delete, sender=Product)
+def remember_deleted_product_stats(sender, instance, **kwargs):
+    # удаление идет в транзакции, поэтому строку можно заблокировать до конца
+    instance._old_stats_values = locked_stats_values(instance.pk)
+
+
+@receiver(post_delete, sender=Product)
+def update_deleted_product_category_stats(sender, instance, **kwargs):
+    old = getattr(instance, '_old_stats_values', None)
+    if old is not None:
+        adjust_category_stats([(old, None)])
+
+
+@receiver(post_save, sender=Product)
+def mark_similar_products(sender, instance, created, raw=False, **kwargs):
+    old_category_id = getattr(instance, '_old_category_id', None)
+    if not raw and (created or old_category_id not in (None, instance.category_id)):
+        mark_stale([instance.pk])
+
+
+@receiver(post_save, sender=Product)
+def mark_moved_product_leaderboards(sender, instance, raw=False, **kwargs):
+    old_category_id = getattr(instance, '_old_category_id', None)
+    if not raw and instance.rating_count and old_category_id not in (None, instance.category_id):
+        mark_categories([old_category_id, instance.category_id])
+
+
+@receiver(pre_delete, sender=Product)
+def mark_products_listing_deleted(sender, instance, **kwargs):
+    # строки с удаляемым товаром уйдут каскадом, и эти топы станут короче
+    mark_stale(SimilarProduct.objects.filter(similar=instance).values_list('product_id', flat=True))
+
+
+def category_ancestor_ids(category_id):
+    return list(CategoryClosure.objects.filter(
+        descendant_id=category_id
+    ).values_list('ancestor_id', flat=True))
+
+
+@receiver(pre_save, sender=Category)
+def check_category_parent(sender, instance, raw=False, **kwargs):
+    instance._parent_changed, instance._old_ancestor_ids = False, []
+    if raw:
+        return
+    old = Category.objects.filter(pk=instance.pk).values_list('parent_id').first()
+    if old is None or old[0] == instance.parent_id:
+        return
+    if instance.parent_id is not None and CategoryClosure.objects.filter(
+        ancestor_id=instance.pk, descendant_id=instance.parent_id
+    ).exists():
+        raise ValidationError('Нельзя перенести категорию в ее собственную подкатегорию')
+    instance._parent_changed = True
+    instance._old_ancestor_ids = category_ancestor_ids(instance.pk)
+
+
+@receiver(post_save, sender=Category)
+def update_category_tree(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        insert_category_node(instance)
+    elif instance._parent_changed:
+        move_category_subtree(instance)
+        schedule_category_stats([instance.pk, *instance._old_ancestor_ids])
+
+
+@receiver(pre_delete, sender=Category)
+def remember_category_ancestors(sender, instance, **kwargs):
+    instance._old_ancestor_ids = category_ancestor_ids(instance.pk)
+
+
+@receiver(post_delete, sender=Category)
+def update_deleted_category_ancestors(sender, instance, **kwargs):
+    schedule_category_stats(instance._old_ancestor_ids)
+
+
+@receiver(post_save, sender=Product)
+def update_cart_snapshot(sender, instance, **kwargs):
+    transaction.on_commit(lambda: cart_service.refresh_snapshots([instance]))
+
+
+@receiver(post_delete, sender=Product)
+def forget_cart_snapshot(sender, instance, **kwargs):
+    product_id = instance.pk
+    transaction.on_commit(lambda: cart_service.forget_snapshots([product_id]))
+
+
+@receiver(products_updated)
+def refresh_updated_products(sender, product_ids, availability_changed=(), **kwargs):
+    product_ids = list(product_ids)
+    if availability_changed:
+        # остальные поля статистики массовые UPDATE остатков не трогают
+        adjust_category_stats([
+            ((category_id, not available, price), (category_id, available, price))
+            for category_id, available, price in Product.objects.filter(
+                pk__in=availability_changed
+            ).values_list('category_id', 'available', 'price')
+        ])
+
+    def refresh():
+        # транзакция уже зафиксирована: сбой обновления не должен ломать заказ,
+        # снимки корзин догонят следующие изменения
+        try:
+            products = list(Product.objects.filter(pk__in=product_ids).only(
+                'category', 'name', 'slug', 'price', 'stock', 'available'
+            ))
+            cart_service.refresh_snapshots(products)
+        except Exception:
+            logger.warning('Не удалось обновить товары %s', product_ids, exc_info=True)
+
+    invalidate_products(product_ids)
+    transaction.on_commit(refresh)
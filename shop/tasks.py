@@ -0,0 +1,143 @@
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from myshop.celery import app
+from .cart import cart_service
+from .freshness import touch_products
+from .images import get_pool, render_variants, variant_name
+from .models import Product, ProductImage
+from .response_cache import response_cache
+
+logger = get_task_logger(__name__)
+
+
+def _save_variants(model, pk, field, source, original, variants):
+    # варианты картинок карусели лежат в том же хранилище по хэшу, что и сами картинки
+    storage = model._meta.get_field('image').storage
+    items = []
+    for variant in variants:
+        name = storage.save(
+            variant_name(source, variant['width'], variant['extension']),
+            ContentFile(variant['content'])
+        )
+        items.append({
+            'name': name,
+            'width': variant['width'],
+            'height': variant['height'],
+            'format': variant['format'],
+        })
+    # если картинку успели заменить, варианты старой уже не нужны
+    model.objects.filter(pk=pk, image=source).update(**{
+        field: dict(original, source=source, items=items)
+    })
+
+
+@app.task
+def process_product_images(product_id):
+    """Готовит уменьшенные копии и WebP для картинки товара и карусели"""
+    product = Product.objects.filter(pk=product_id).only('id', 'image', 'image_variants').first()
+    if product is None:
+        return
+    jobs, reused = [], False
+    if product.image and product.image_variants.get('source') != product.image.name:
+        jobs.append((Product, product.pk, 'image_variants', product.image.name))
+    for image in ProductImage.objects.filter(product_id=product_id).only('id', 'image', 'variants'):
+        if image.variants.get('source') == image.image.name:
+            continue
+        # тот же файл уже загружали к другому товару — его варианты готовы
+        ready = ProductImage.objects.filter(
+            image=image.image.name, variants__source=image.image.name
+        ).values_list('variants', flat=True).first()
+        if ready:
+            ProductImage.objects.filter(pk=image.pk, image=image.image.name).update(variants=ready)
+            reused = True
+        else:
+            jobs.append((ProductImage, image.pk, 'variants', image.image.name))
+    if not jobs:
+        if reused:
+            touch_products([product_id])
+            response_cache.invalidate([product_id])
+        return
+
+    widths = settings.IMAGE_VARIANT_WIDTHS
+    pool = get_pool()
+    pending = []
+    for job in jobs:
+        try:
+            with job[0]._meta.get_field('image').storage.open(job[3]) as file:
+                data = file.read()
+        except OSError:
+            logger.warning('Не удалось прочитать %s', job[3])
+            continue
+        if pool is None:
+            pending.append((job, None, data))
+        else:
+            pending.append((job, pool.submit(render_variants, data, widths), None))
+
+    for job, future, data in pending:
+        try:
+            original, variants = future.result() if future else render_variants(data, widths)
+        except OSError:
+            logger.warning('Не удалось обработать %s', job[3])
+            continue
+        _save_variants(*job, original, variants)
+    touch_products([product_id])
+    response_cache.invalidate([product_id])
+
+
+@app.task
+def release_carousel_image(name, variants):
+    """
+    Удаляет файл карусели и его варианты, если на них больше не ссылается
+    ни одна картинка. Файлы, которые хранилище не отдало из-за MEDIA_BLOB_GRACE,
+    проверяются повторно, когда этот срок истечет
+    """
+    if ProductImage.objects.filter(image=name).exists():
+        return
+    storage = ProductImage._meta.get_field('image').storage
+    if storage.exists(name) and not storage.release(name):
+        pending = variants
+    else:
+        pending = dict(variants, items=[
+            item for item in variants.get('items', [])
+            if not storage.release(item['name']) and storage.exists(item['name'])
+        ])
+        if not pending['items']:
+            return
+    # без воркера задача выполнилась бы сразу и снова попала в срок
+    if not app.conf.task_always_eager:
+        release_carousel_image.apply_async((name, pending), countdown=settings.MEDIA_BLOB_GRACE)
+
+
+@app.task
+def persist_carts(batch_size=100):
+    """Сбрасывает в базу измененные корзины пользователей"""
+    total = 0
+    while True:
+        persisted = cart_service.persist_dirty(batch_size)
+        total += persisted
+        if persisted < batch_size:
+            return total
+
+
+@app.task
+def release_expired_reservations():
+    """Возвращает на склад товар из неоплаченных вовремя заказов"""
+    # orders импортирует signals, а signals — этот модуль
+    from .orders import release_expired_orders
+    return release_expired_orders()
+
+
+@app.task
+def refresh_similar_products(full=False):
+    """Пересчитывает похожие товары для товаров из очереди изменений"""
+    from .recommendations import refresh_recommendations
+    return refresh_recommendations(full=full)
+
+
+@app.task
+def refresh_category_leaderboards(full=False):
+    """Пересчитывает топы категорий, в которых изменились оценки"""
+    from .leaderboard import refresh_leaderboards
+    return refresh_leaderboards(full=full)
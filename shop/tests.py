@@ -1,3 +1,1394 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import OperationalError, connections
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework.test import APIClient, APITestCase
+
+from myshop.metrics import registry
+from myshop.pool import ConnectionPool, PoolTimeout, _pools
+from myshop.routers import ReplicaRouter, lag_monitor, mirrors_primary, replica_reads
+from myshop.schema import generate_schema, schema_artifact
+
+from .cart import cart_service
+from .categories import refresh_category_stats
+from .models import (
+    CartItem, Category, CategoryClosure, CategoryLeaderboard, CategoryStats, LeaderboardQueue, Order, Product,
+    ProductImage, SimilarProduct, SimilarProductQueue, Tag, Comment, Rating
+)
+from .orders import OutOfStock, create_order, release_expired_orders
+from .leaderboard import bayesian_score, refresh_leaderboards
+from .pagination import KeysetPagination
+from .recommendations import SimilarityMatrix, refresh_recommendations
+from .response_cache import LocMemBackend, ResponseCache, SingleFlight, response_cache
+from .search import ProductSearch, SearchIndex, tokenize
+from .tasks import persist_carts, process_product_images, release_carousel_image
+from .views import ProductViewSet
+
+User = get_user_model()
+
+
+class ShopTestMixin:
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(
+            username='seller', email='seller@example.com', password='pass12345'
+        )
+        cls.buyer = User.objects.create_user(
+            username='buyer', email='buyer@example.com', password='pass12345'
+        )
+        cls.category = Category.objects.create(name='Холодильники', slug='fridges')
+        cls.tags = [
+            Tag.objects.create(name='beko'),
+            Tag.objects.create(name='no-frost'),
+        ]
+
+    def setUp(self):
+        cache.clear()
+        response_cache.clear()
+
+    def create_products(self, count, **extra):
+        products = []
+        for i in range(count):
+            product = Product.objects.create(
+                user=self.seller,
+                category=self.category,
+                name=f'Холодильник {i}',
+                slug=f'fridge-{i}',
+                price=1000 + i,
+                stock=10,
+                **extra
+            )
+            product.tag.set(self.tags)
+            ProductImage.objects.bulk_create([
+                ProductImage(product=product, image=f'product_images/carousel/{i}-{n}.jpg')
+                for n in range(2)
+            ])
+            for user in (self.seller, self.buyer):
+                Comment.objects.create(product=product, user=user, text='Отличный товар')
+            products.append(product)
+        return products
+
+
+class ProductQueryCountTest(ShopTestMixin, APITestCase):
+    # версия для ETag + товары + картинки + комментарии с авторами + теги
+    LIST_QUERIES = 5
+    # версия для ETag + товар + картинки + комментарии с авторами + теги
+    RETRIEVE_QUERIES = 5
+
+    def test_list_query_count_does_not_depend_on_page_size(self):
+        self.create_products(12)
+        for page_size in (1, 3, 12):
+            with self.assertNumQueries(self.LIST_QUERIES):
+                response = self.client.get('/shop/product/', {'page_size': page_size})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data['results']), page_size)
+            for item in response.data['results']:
+                self.assertEqual(len(item['comments']), 2)
+                self.assertEqual(len(item['carousel']), 2)
+                self.assertEqual(item['user'], 'seller')
+
+    def test_retrieve_query_count(self):
+        product, = self.create_products(1)
+        with self.assertNumQueries(self.RETRIEVE_QUERIES):
+            response = self.client.get(f'/shop/product/{product.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {comment['user'] for comment in response.data['comments']},
+            {'seller', 'buyer'}
+        )
+        self.assertEqual(sorted(response.data['tag']), ['beko', 'no-frost'])
+
+    def test_legacy_list_adds_only_count_query(self):
+        self.create_products(5)
+        with self.assertNumQueries(self.LIST_QUERIES + 1):
+            response = self.client.get('/shop/product/', {'page': 2})
+        self.assertEqual(response.data['count'], 5)
+        self.assertEqual(len(response.data['results']), 2)
+
+
+class CommentFeedTest(ShopTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.product, self.other = self.create_products(2)
+        for i in range(5):
+            Comment.objects.create(product=self.product, user=self.buyer, text=f'Комментарий {i}')
+        self.expected = list(self.product.comments.order_by('-created_at', '-id').values_list('pk', flat=True))
+
+    def test_product_payload_has_count_and_latest_comments(self):
+        response = self.client.get(f'/shop/product/{self.product.pk}/')
+        self.assertEqual(response.data['comment_count'], 7)
+        self.assertEqual(
+            [comment['id'] for comment in response.data['comments']],
+            self.expected[:settings.PRODUCT_LATEST_COMMENTS]
+        )
+        items = {item['id']: item for item in self.client.get('/shop/product/').data['results']}
+        self.assertEqual(len(items[self.product.pk]['comments']), settings.PRODUCT_LATEST_COMMENTS)
+        self.assertEqual(len(items[self.other.pk]['comments']), 2)
+
+        Comment.objects.filter(pk=self.expected[0]).delete()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.comment_count, 6)
+
+    def test_comment_feed_walks_all_pages(self):
+        url = f'/shop/product/{self.product.pk}/comments/'
+        ids = []
+        # товар + страница комментариев с авторами
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'page_size': 2})
+        while True:
+            ids += [comment['id'] for comment in response.data['results']]
+            self.assertTrue(all(comment['user'] for comment in response.data['results']))
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(ids, self.expected)
+        self.assertEqual(self.client.get('/shop/product/0/comments/').status_code, 404)
+
+
+class ConditionalGetTest(ShopTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.product, self.other = self.create_products(2)
+        self.url = f'/shop/product/{self.product.pk}/'
+
+    def assertNotModified(self, url, **headers):
+        # свежесть уже в кэше: ни запросов, ни сериализации
+        with self.assertNumQueries(0):
+            response = self.client.get(url, **headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def assertModified(self, url, etag):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        return response['ETag']
+
+    def test_retrieve_and_list_return_304(self):
+        response = self.client.get(self.url)
+        self.assertIn('Last-Modified', response)
+        self.assertNotModified(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertNotModified(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+
+        etag = self.client.get('/shop/product/', {'page_size': 1})['ETag']
+        self.assertNotModified('/shop/product/?page_size=1', HTTP_IF_NONE_MATCH=etag)
+        self.assertNotEqual(self.client.get('/shop/product/', {'page_size': 2})['ETag'], etag)
+        self.assertEqual(self.client.get('/shop/product/0/', HTTP_IF_NONE_MATCH='*').status_code, 404)
+
+    def test_related_changes_change_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        list_etag = self.client.get('/shop/product/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(product=self.product, user=self.buyer, text='Новый')
+        etag = self.assertModified(self.url, etag)
+        list_etag = self.assertModified('/shop/product/', list_etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.tag.remove(self.tags[0])
+        etag = self.assertModified(self.url, etag)
+
+        self.client.force_authenticate(self.buyer)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'{self.url}set-rating/', {'rating': 5})
+        etag = self.assertModified(self.url, etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other.delete()
+        self.assertModified('/shop/product/', list_etag)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class KeysetPaginationTest(ShopTestMixin, APITestCase):
+    def collect(self, params, link='next'):
+        ids, response = [], self.client.get('/shop/product/', params)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            ids += [item['id'] for item in response.data['results']]
+            if not response.data[link]:
+                return ids, response
+            response = self.client.get(response.data[link])
+
+    def test_walks_all_pages_in_created_order(self):
+        products = self.create_products(7)
+        # одинаковое значение created проверяет сравнение по id
+        Product.objects.filter(pk__in=[p.pk for p in products[2:5]]).update(
+            created=products[2].created
+        )
+        expected = list(Product.objects.order_by('-created', '-pk').values_list('pk', flat=True))
+        ids, last = self.collect({'page_size': 2})
+        self.assertEqual(ids, expected)
+        self.assertNotIn('count', last.data)
+
+        back = self.client.get(last.data['previous'])
+        self.assertEqual([item['id'] for item in back.data['results']], expected[4:6])
+
+    def test_other_orderings_and_page_size_limit(self):
+        self.create_products(5)
+        ids, _ = self.collect({'page_size': 2, 'ordering': 'created'})
+        self.assertEqual(ids, sorted(ids))
+        with mock.patch.object(KeysetPagination, 'max_page_size', 4):
+            response = self.client.get('/shop/product/', {'page_size': 10 ** 6})
+        self.assertEqual(len(response.data['results']), 4)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/shop/product/', {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+
+class ProductFilterTest(ShopTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.products = self.create_products(4)
+        tv = Category.objects.create(name='Телевизоры', slug='tv')
+        Product.objects.filter(pk=self.products[0].pk).update(category=tv, price=50000)
+        Product.objects.filter(pk=self.products[1].pk).update(stock=0, available=False)
+        self.products[2].tag.set([self.tags[0]])
+
+    def names(self, **params):
+        response = self.client.get('/shop/product/', dict(params, ordering='price'))
+        self.assertEqual(response.status_code, 200)
+        return [item['name'] for item in response.data['results']]
+
+    def test_filters(self):
+        self.assertEqual(self.names(price_min=1001, price_max=1003), ['Холодильник 1', 'Холодильник 2', 'Холодильник 3'])
+        self.assertEqual(self.names(category='tv'), ['Холодильник 0'])
+        self.assertEqual(len(self.names(category='tv,fridges', page_size=10)), 4)
+        self.assertEqual(self.names(in_stock='false'), ['Холодильник 1'])
+        self.assertNotIn('Холодильник 1', self.names(available='true'))
+        self.assertEqual(len(self.names(tags='no-frost', page_size=10)), 3)
+        self.assertEqual(len(self.names(tags='beko,no-frost', page_size=10)), 4)
+        self.assertEqual(
+            self.names(tags='beko,no-frost', tags_mode='and', page_size=10),
+            ['Холодильник 1', 'Холодильник 3', 'Холодильник 0']
+        )
+
+    def test_facets_for_current_result_set(self):
+        with self.assertNumQueries(ProductQueryCountTest.LIST_QUERIES + 3):
+            response = self.client.get('/shop/product/', {'facets': 'true', 'price_max': 2000})
+        facets = response.data['facets']
+        self.assertEqual(facets['total'], 3)
+        self.assertEqual(facets['category'], [{'value': 'fridges', 'name': 'Холодильники', 'count': 3}])
+        self.assertEqual(facets['tags'], [{'value': 'beko', 'count': 3}, {'value': 'no-frost', 'count': 2}])
+        self.assertEqual(facets['in_stock'], {'true': 2, 'false': 1})
+        self.assertEqual(facets['price'][0]['count'], 3)
+        self.assertNotIn('facets', self.client.get('/shop/product/').data)
+
+
+class CategoryApiTest(ShopTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products = self.create_products(3)
+
+    def test_list_reads_materialized_stats(self):
+        Category.objects.create(name='Телевизоры', slug='tv')
+        call_command('rebuild_category_stats', stdout=io.StringIO())
+        with self.assertNumQueries(2):
+            response = self.client.get('/shop/category/')
+        tv, fridges = response.data['results']
+        self.assertEqual(
+            (fridges['product_count'], fridges['available_count'], fridges['min_price'], fridges['max_price']),
+            (3, 3, '1000.00', '1002.00')
+        )
+        self.assertEqual((tv['product_count'], tv['min_price']), (0, None))
+
+    def test_stats_follow_product_changes(self):
+        tv = Category.objects.create(name='Телевизоры', slug='tv')
+        product = self.products[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            product.category = tv
+            product.available = False
+            product.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[2].delete()
+        fridges = self.client.get('/shop/category/fridges/').data
+        self.assertEqual((fridges['product_count'], fridges['min_price']), (1, '1001.00'))
+        tv = self.client.get('/shop/category/tv/').data
+        self.assertEqual((tv['product_count'], tv['available_count']), (1, 0))
+
+    def test_category_products(self):
+        Category.objects.create(name='Телевизоры', slug='tv')
+        response = self.client.get('/shop/category/fridges/products/', {'page_size': 10})
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertEqual(self.client.get('/shop/category/tv/products/').data['results'], [])
+        self.assertEqual(self.client.get('/shop/category/missing/products/').status_code, 404)
+
+
+class CategoryTreeTest(ShopTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.appliances = Category.objects.create(name='Бытовая техника', slug='appliances')
+        self.kitchen = Category.objects.create(name='Для кухни', slug='kitchen', parent=self.appliances)
+        self.category.parent = self.kitchen
+        self.category.save()
+        self.side_by_side = Category.objects.create(name='Side-by-side', slug='side-by-side', parent=self.category)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products = self.create_products(3)
+            self.products[0].category = self.side_by_side
+            self.products[0].save()
+
+    def test_breadcrumbs_and_tree_are_single_queries(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/shop/category/side-by-side/breadcrumbs/')
+        self.assertEqual(
+            [item['slug'] for item in response.data],
+            ['appliances', 'kitchen', 'fridges', 'side-by-side']
+        )
+        with self.assertNumQueries(1):
+            tree = self.client.get('/shop/category/tree/').data
+        self.assertEqual(tree[0]['slug'], 'appliances')
+        self.assertEqual(tree[0]['children'][0]['children'][0]['children'][0]['slug'], 'side-by-side')
+        subtree = self.client.get('/shop/category/tree/', {'root': 'fridges'}).data
+        self.assertEqual([node['slug'] for node in subtree], ['fridges'])
+
+    def test_subtree_products_and_stats(self):
+        self.assertEqual(Product.objects.in_category(self.appliances).count(), 3)
+        self.assertEqual(Product.objects.in_category(self.side_by_side).count(), 1)
+        response = self.client.get('/shop/category/kitchen/products/', {'page_size': 10})
+        self.assertEqual(len(response.data['results']), 3)
+        response = self.client.get('/shop/product/', {'category': 'side-by-side'})
+        self.assertEqual([item['id'] for item in response.data['results']], [self.products[0].pk])
+        self.assertEqual(self.client.get('/shop/category/appliances/').data['product_count'], 3)
+
+    def test_move_subtree(self):
+        tv = Category.objects.create(name='Телевизоры', slug='tv')
+        with self.captureOnCommitCallbacks(execute=True):
+            # проверка цикла, UPDATE и перенос замыканий — не зависит от размера поддерева
+            with self.assertNumQueries(10):
+                self.category.parent = tv
+                self.category.save()
+        self.assertEqual(
+            [category.slug for category in self.side_by_side.ancestors()],
+            ['tv', 'fridges', 'side-by-side']
+        )
+        self.assertEqual(Product.objects.in_category(self.appliances).count(), 0)
+        self.assertEqual(self.client.get('/shop/category/kitchen/').data['product_count'], 0)
+        self.assertEqual(self.client.get('/shop/category/tv/').data['product_count'], 3)
+
+        with self.assertRaises(ValidationError):
+            self.category.parent = self.side_by_side
+            self.category.save()
+
+    def stats(self):
+        return sorted(CategoryStats.objects.values_list(
+            'category_id', 'product_count', 'available_count', 'min_price', 'max_price'
+        ))
+
+    def test_stats_are_adjusted_without_recount(self):
+        product = Product.objects.get(pk=self.products[1].pk)
+        with mock.patch('shop.categories.category_aggregates') as aggregates:
+            product.stock = 3
+            product.save()
+            product.price = 500
+            product.save()
+            create_order(self.buyer, {self.products[2].pk: 10})
+        aggregates.assert_not_called()
+        # граничная цена ушла: границу ищем заново
+        product.price = 1001
+        product.category = self.side_by_side
+        product.save()
+        self.products[0].delete()
+        adjusted = self.stats()
+        refresh_category_stats()
+        self.assertEqual(adjusted, self.stats())
+        self.assertEqual(
+            CategoryStats.objects.filter(category=self.appliances).values_list(
+                'product_count', 'available_count', 'min_price', 'max_price'
+            ).get(),
+            (2, 1, 1001, 1002)
+        )
+
+    def test_stale_instances_keep_stats_consistent(self):
+        pk = self.products[1].pk
+        for available in (False, True):
+            # оба экземпляра загружены до первого сохранения
+            first, second = Product.objects.get(pk=pk), Product.objects.get(pk=pk)
+            first.available = second.available = available
+            first.save()
+            second.save()
+            adjusted = self.stats()
+            refresh_category_stats()
+            self.assertEqual(adjusted, self.stats())
+        self.assertEqual(
+            CategoryStats.objects.filter(category=self.category).values_list('available_count', flat=True).get(),
+            3
+        )
+
+    def test_rebuild_closure(self):
+        CategoryClosure.objects.all().delete()
+        call_command('rebuild_category_stats', '--closure', stdout=io.StringIO())
+        self.assertEqual(Product.objects.in_category(self.kitchen).count(), 3)
+        self.assertEqual(self.category.descendants().count(), 2)
+
+
+class CartTest(ShopTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        cart_service.store.clear()
+        self.products = self.create_products(2)
+
+    def add(self, product, quantity=1, cart_id=None):
+        headers = {'HTTP_X_CART_ID': cart_id} if cart_id else {}
+        return self.client.post('/shop/cart/', {'product': product.pk, 'quantity': quantity}, **headers)
+
+    def test_anonymous_cart_operations(self):
+        response = self.add(self.products[0], 2)
+        self.assertEqual(response.status_code, 201)
+        cart_id = response['X-Cart-Id']
+        self.add(self.products[0], 20, cart_id)
+        self.add(self.products[1], 1, cart_id)
+
+        with self.assertNumQueries(0):
+            cart = self.client.get('/shop/cart/', HTTP_X_CART_ID=cart_id).data
+        self.assertEqual([item['quantity'] for item in cart['items']], [10, 1])
+        self.assertEqual(cart['total_quantity'], 11)
+        self.assertEqual(cart['total_price'], '11001.00')
+
+        cart = self.client.patch(
+            f'/shop/cart/{self.products[0].pk}/', {'quantity': 3}, HTTP_X_CART_ID=cart_id
+        ).data
+        self.assertEqual(cart['items'][0]['quantity'], 3)
+        cart = self.client.delete(f'/shop/cart/{self.products[1].pk}/', HTTP_X_CART_ID=cart_id).data
+        self.assertEqual(cart['total_price'], '3000.00')
+
+    def test_snapshots_follow_product_changes(self):
+        cart_id = self.add(self.products[0], 5)['X-Cart-Id']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].price = 10
+            self.products[0].stock = 4
+            self.products[0].save()
+        cart = self.client.get('/shop/cart/', HTTP_X_CART_ID=cart_id).data
+        self.assertEqual(cart['total_price'], '50.00')
+        self.assertFalse(cart['items'][0]['in_stock'])
+
+        Product.objects.filter(pk=self.products[1].pk).update(available=False)
+        self.assertEqual(self.add(self.products[1], 1, cart_id).status_code, 400)
+
+    def test_anonymous_cart_merges_into_user_cart_and_persists(self):
+        self.client.force_authenticate(self.buyer)
+        self.add(self.products[0], 1)
+        self.client.force_authenticate(None)
+        cart_id = self.add(self.products[0], 2)['X-Cart-Id']
+        self.add(self.products[1], 1, cart_id)
+
+        self.client.force_authenticate(self.buyer)
+        cart = self.client.get('/shop/cart/', HTTP_X_CART_ID=cart_id).data
+        self.assertEqual([item['quantity'] for item in cart['items']], [3, 1])
+        self.assertNotIn('cart_id', cart)
+        self.assertEqual(cart_service.items(cart_service.anonymous_owner(cart_id)), {})
+
+        persist_carts()
+        self.assertEqual(
+            sorted(CartItem.objects.filter(cart__user=self.buyer).values_list('product_id', 'quantity')),
+            [(self.products[0].pk, 3), (self.products[1].pk, 1)]
+        )
+        # после потери данных в хранилище корзина поднимается из базы
+        cart_service.store.clear()
+        cart = self.client.get('/shop/cart/').data
+        self.assertEqual(cart['total_quantity'], 4)
+
+
+class CheckoutTest(ShopTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        cart_service.store.clear()
+        self.products = self.create_products(2)
+        self.client.force_authenticate(self.buyer)
+
+    def checkout(self, items=None):
+        data = {} if items is None else {'items': [
+            {'product': product.pk, 'quantity': quantity} for product, quantity in items
+        ]}
+        return self.client.post('/shop/order/', data, format='json')
+
+    def test_checkout_reserves_stock_in_one_update(self):
+        self.client.post('/shop/cart/', {'product': self.products[0].pk, 'quantity': 10})
+        self.client.post('/shop/cart/', {'product': self.products[1].pk, 'quantity': 2})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.checkout()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['total'], '12002.00')
+        self.assertEqual(cart_service.view(cart_service.user_owner(self.buyer))['items'], [])
+
+        first, second = Product.objects.order_by('pk')
+        self.assertEqual((first.stock, first.available), (0, False))
+        self.assertEqual((second.stock, second.available), (8, True))
+        self.assertEqual(cart_service.snapshots([first.pk])[first.pk]['stock'], 0)
+
+    def test_checkout_empties_persisted_cart(self):
+        self.client.post('/shop/cart/', {'product': self.products[1].pk, 'quantity': 2})
+        persist_carts()
+        self.assertEqual(self.checkout().status_code, 201)
+        self.assertEqual(self.client.get('/shop/cart/').data['items'], [])
+        # повторное оформление не должно поднять корзину из базы
+        self.assertEqual(self.checkout().status_code, 400)
+        persist_carts()
+        self.assertFalse(CartItem.objects.filter(cart__user=self.buyer).exists())
+        self.assertEqual(Product.objects.get(pk=self.products[1].pk).stock, 8)
+
+    def test_cart_is_taken_before_order_and_restored_on_conflict(self):
+        owner = cart_service.user_owner(self.buyer)
+        self.client.post('/shop/cart/', {'product': self.products[0].pk, 'quantity': 3})
+        calls = []
+
+        def concurrent_requests(user, quantities):
+            if not calls:
+                calls.append(quantities)
+                # пока создается заказ: повторный POST и добавление в корзину
+                self.assertEqual(self.checkout().status_code, 400)
+                cart_service.add(owner, self.products[1].pk, 2)
+            return create_order(user, quantities)
+
+        with mock.patch('shop.views.create_order', side_effect=concurrent_requests):
+            self.assertEqual(self.checkout().status_code, 201)
+        self.assertEqual(calls, [{self.products[0].pk: 3}])
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(cart_service.items(owner), {self.products[1].pk: 2})
+
+        Product.objects.filter(pk=self.products[1].pk).update(stock=1)
+        self.assertEqual(self.checkout().status_code, 409)
+        self.assertEqual(cart_service.items(owner), {self.products[1].pk: 2})
+
+    def test_out_of_stock_changes_nothing(self):
+        response = self.checkout([(self.products[1], 1), (self.products[0], 11)])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['products'], [self.products[0].pk])
+        self.assertEqual(list(Product.objects.values_list('stock', flat=True)), [10, 10])
+        self.assertFalse(Order.objects.exists())
+
+    def test_seller_edit_keeps_concurrent_reservation(self):
+        product = self.products[0]
+        get_object = ProductViewSet.get_object
+
+        def load_then_reserve(view):
+            instance = get_object(view)
+            # заказ и комментарий успевают между загрузкой товара и его сохранением
+            create_order(self.buyer, {product.pk: 10})
+            Comment.objects.create(product=product, user=self.buyer, text='Успел')
+            return instance
+
+        self.client.force_authenticate(self.seller)
+        with mock.patch.object(ProductViewSet, 'get_object', load_then_reserve):
+            response = self.client.patch(f'/shop/product/{product.pk}/', {'price': '900.00'})
+        self.assertEqual(response.status_code, 200)
+        product = Product.objects.get(pk=product.pk)
+        self.assertEqual((product.price, product.stock, product.available), (900, 0, False))
+        self.assertEqual(product.comment_count, 3)
+        self.assertEqual(response.data['version'], product.version)
+
+    def test_cancel_and_expiry_release_stock(self):
+        order_id = self.checkout([(self.products[0], 10)]).data['id']
+        self.assertEqual(self.client.post(f'/shop/order/{order_id}/cancel/').status_code, 200)
+        self.assertEqual(self.client.post(f'/shop/order/{order_id}/pay/').status_code, 409)
+        product = Product.objects.get(pk=self.products[0].pk)
+        self.assertEqual((product.stock, product.available), (10, True))
+
+        with self.settings(ORDER_RESERVATION_TTL=-1):
+            expired = create_order(self.buyer, {product.pk: 4})
+        paid_id = self.checkout([(self.products[0], 1)]).data['id']
+        self.assertEqual(self.client.post(f'/shop/order/{paid_id}/pay/').data['status'], Order.PAID)
+        self.assertEqual(release_expired_orders(), 1)
+        expired.refresh_from_db()
+        self.assertEqual(expired.status, Order.EXPIRED)
+        self.assertEqual(Product.objects.get(pk=product.pk).stock, 9)
+        with self.assertRaises(OutOfStock):
+            create_order(self.buyer, {product.pk: 10})
+
+
+class CheckoutConcurrencyTest(TransactionTestCase):
+    def test_benchmark_has_no_oversell(self):
+        out = io.StringIO()
+        call_command('benchmark_checkout', threads=8, orders=60, stock=25, stdout=out)
+        self.assertIn('Продано 25 из 25', out.getvalue())
+        self.assertFalse(Product.objects.exists())
+
+
+class MetricsTest(ShopTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        registry.reset()
+        response_cache.clear()
+
+    def test_metrics_per_route_and_action(self):
+        self.create_products(2)
+        self.client.get('/shop/product/')
+        self.client.get('/shop/product/missing/')
+        body = self.client.get('/metrics').content.decode()
+
+        labels = 'route="product-list",action="list",method="GET"'
+        self.assertIn(f'myshop_http_request_duration_seconds_count{{{labels}}} 1', body)
+        self.assertIn(f'myshop_http_requests_total{{{labels},status="200"}} 1', body)
+        self.assertIn(f'myshop_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 1', body)
+        self.assertIn('route="product-detail",action="retrieve",method="GET",status="404"', body)
+        values = {
+            line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+            for line in body.splitlines() if line and not line.startswith('#')
+        }
+        self.assertGreater(values[f'myshop_db_queries_total{{{labels}}}'], 0)
+        self.assertGreater(values[f'myshop_serializer_duration_seconds_total{{{labels}}}'], 0)
+        self.assertGreater(values[f'myshop_http_response_bytes_total{{{labels}}}'], 0)
+        self.assertIn('myshop_product_cache_misses ', body)
+        self.assertIn('myshop_auth_user_cache_hit_ratio ', body)
+
+    @override_settings(METRICS_SLOW_REQUEST_MS=0.001, METRICS_SLOW_QUERIES=2)
+    def test_slow_request_logs_worst_queries(self):
+        self.create_products(2)
+        with self.assertLogs('myshop.metrics', 'WARNING') as logs:
+            self.client.get('/shop/product/')
+        self.assertIn('GET /shop/product/ (product-list.list)', logs.output[0])
+        self.assertEqual(logs.output[0].count(' мс: SELECT'), 2)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+
+class ReplicaRouterTest(SimpleTestCase):
+    def setUp(self):
+        lag_monitor.clear()
+        self.addCleanup(lag_monitor.clear)
+        self.router = ReplicaRouter()
+
+    @override_settings(DATABASE_REPLICAS=['replica'], REPLICA_MAX_LAG=5)
+    @mock.patch('myshop.routers.mirrors_primary', return_value=False)
+    def test_reads_follow_state_and_lag(self, mirror):
+        self.assertIsNone(self.router.db_for_read(Product))
+        with mock.patch('myshop.routers.replica_lag', return_value=1) as lag:
+            with replica_reads():
+                self.assertEqual(self.router.db_for_read(Product), 'replica')
+                self.assertEqual(self.router.db_for_write(Product), 'default')
+                # свои записи читаем с основной базы
+                self.assertIsNone(self.router.db_for_read(Product))
+            with replica_reads():
+                self.router.db_for_read(Product)
+        self.assertEqual(lag.call_count, 1)
+
+        lag_monitor.clear()
+        with mock.patch('myshop.routers.replica_lag', return_value=60), replica_reads():
+            self.assertIsNone(self.router.db_for_read(Product))
+        lag_monitor.clear()
+        with mock.patch('myshop.routers.replica_lag', side_effect=OperationalError), replica_reads():
+            self.assertIsNone(self.router.db_for_read(Product))
+
+
+@skipUnless('replica' in settings.DATABASES, 'нужна реплика: DB_REPLICA_NAME')
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaReadsTest(TransactionTestCase):
+    # в тестах реплика — зеркало основной базы (TEST MIRROR); без реплики тест пропускается
+    databases = set(settings.DATABASES)
+    client_class = APIClient
+
+    def setUp(self):
+        cache.clear()
+        lag_monitor.clear()
+        Tag.objects.create(name='beko')
+        self.writer, self.reader = [
+            User.objects.create_user(username=name, email=f'{name}@example.com', password='pass12345')
+            for name in ('writer', 'reader')
+        ]
+
+    def replica_queries(self, user=None):
+        """Число запросов списка тегов, ушедших на реплику"""
+        self.client.force_authenticate(user)
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = self.client.get('/shop/tag/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('beko', [tag['name'] for tag in response.data['results']])
+        return len(queries)
+
+    def test_mirror_is_read_through_primary_connection(self):
+        self.assertTrue(mirrors_primary('replica'))
+        self.assertEqual(self.replica_queries(), 0)
+
+    @mock.patch('myshop.routers.mirrors_primary', return_value=False)
+    def test_catalog_reads_use_replica_until_user_writes(self, mirror):
+        self.assertGreater(self.replica_queries(), 0)
+        self.assertGreater(self.replica_queries(self.writer), 0)
+
+        self.client.force_authenticate(self.writer)
+        self.assertEqual(self.client.post('/shop/tag/', {'name': 'new'}).status_code, 201)
+        # закрепление в подписанной куке, а не в кэше процесса
+        cache.clear()
+        self.assertEqual(self.replica_queries(self.writer), 0)
+        self.assertGreater(self.replica_queries(self.reader), 0)
+
+        with mock.patch('myshop.routers.replica_lag', return_value=3600):
+            lag_monitor.clear()
+            self.assertEqual(self.replica_queries(), 0)
+
+    @mock.patch('myshop.routers.mirrors_primary', return_value=False)
+    def test_cached_responses_are_filled_from_primary(self, mirror):
+        response_cache.clear()
+        category = Category.objects.create(name='Холодильники', slug='fridges')
+        Product.objects.create(
+            user=self.writer, category=category, name='Холодильник', slug='fridge', price=1000, stock=1
+        )
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = self.client.get('/shop/product/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 0)
+
+        self.client.force_authenticate(self.reader)
+        with CaptureQueriesContext(connections['replica']) as queries:
+            self.assertEqual(self.client.get('/shop/product/').status_code, 200)
+        self.assertGreater(len(queries), 0)
+
+        # поток выгрузки читается после ответа view, но все равно с реплики
+        response = self.client.get('/shop/product/export/')
+        with CaptureQueriesContext(connections['replica']) as queries:
+            self.assertIn(b'fridge', b''.join(response.streaming_content))
+        self.assertGreater(len(queries), 0)
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    def pool(self, **kwargs):
+        pool = ConnectionPool(lambda: sqlite3.connect(':memory:', check_same_thread=False), **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_connections_are_reused_up_to_max_size(self):
+        pool = self.pool(max_size=1, timeout=0.05)
+        connection = pool.checkout()
+        with self.assertRaises(PoolTimeout):
+            pool.checkout()
+        # ожидающий поток получает соединение, как только его вернут
+        threading.Timer(0.01, pool.checkin, [connection]).start()
+        pool.timeout = 5
+        self.assertIs(pool.checkout(), connection)
+        stats = pool.stats()
+        self.assertEqual((stats['size'], stats['in_use'], stats['checkouts'], stats['timeouts']), (1, 1, 2, 1))
+        self.assertGreater(stats['wait_seconds'], 0)
+
+    def test_broken_and_stale_connections_are_replaced(self):
+        pool = self.pool(check_interval=0, check=lambda connection: False)
+        first = pool.checkout()
+        pool.checkin(first)
+        second = pool.checkout()
+        self.assertIsNot(second, first)
+        self.assertEqual(pool.stats()['reconnects'], 1)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            first.execute('SELECT 1')
+
+        pool.reset = lambda connection: False
+        pool.checkin(second)
+        self.assertEqual(pool.stats()['size'], 0)
+
+        pool = self.pool(max_lifetime=0)
+        first = pool.checkout()
+        pool.checkin(first)
+        self.assertIsNot(pool.checkout(), first)
+
+    def test_idle_connections_above_min_size_are_closed(self):
+        pool = self.pool(min_size=1, max_idle=0)
+        pool.fill()
+        self.assertEqual(pool.stats()['idle'], 1)
+        connections = [pool.checkout(), pool.checkout()]
+        for connection in connections:
+            pool.checkin(connection)
+        self.assertEqual((pool.stats()['size'], pool.stats()['idle']), (1, 1))
+
+    def test_pool_forgets_connections_after_fork(self):
+        pool = self.pool()
+        inherited = pool.checkout()
+        pool.pid = -1
+        connection = pool.checkout()
+        self.assertIsNot(connection, inherited)
+        self.assertEqual(pool.stats()['size'], 1)
+        pool.checkin(inherited)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_pool_metrics(self):
+        pool = self.pool(max_size=3)
+        pool.checkout()
+        with mock.patch.dict(_pools, {'test': pool}):
+            content = registry.render()
+        self.assertIn('myshop_db_pool_test_in_use 1.0', content)
+        self.assertIn('myshop_db_pool_test_max_size 3.0', content)
+
+
+class SchemaTest(APITestCase):
+    def setUp(self):
+        schema_artifact.clear()
+        self.addCleanup(schema_artifact.clear)
+
+    def test_schema_is_built_once_and_served_with_etag(self):
+        with mock.patch('myshop.schema.generate_schema', wraps=generate_schema) as generate:
+            response = self.client.get('/openapi.json')
+            self.assertEqual(self.client.get('/openapi.json')['ETag'], response['ETag'])
+        self.assertEqual(generate.call_count, 1)
+        self.assertIn('/shop/product/', json.loads(response.content)['paths'])
+        response = self.client.get('/openapi.json', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        self.assertEqual(self.client.get('/health/').json()['status'], 'ok')
+
+    def test_pages_do_not_build_schema(self):
+        with mock.patch('drf_yasg.generators.OpenAPISchemaGenerator.get_schema') as get_schema:
+            for _ in range(3):
+                self.assertEqual(self.client.get('/').json()['status'], 'ok')
+                page = self.client.get('/swagger/')
+                self.assertContains(page, '/openapi.json')
+                self.assertContains(page, 'swagger-ui')
+        get_schema.assert_not_called()
+
+    def test_schema_from_generated_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'openapi.json')
+        call_command('generate_swagger', path, '--overwrite', stdout=mock.Mock())
+        with override_settings(OPENAPI_SCHEMA_PATH=path), \
+                mock.patch('myshop.schema.generate_schema') as generate:
+            response = self.client.get('/openapi.json')
+            with open(path, 'rb') as file:
+                self.assertEqual(response.content, file.read())
+            with open(path, 'w') as file:
+                file.write('{}')
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(self.client.get('/openapi.json').content, b'{}')
+        generate.assert_not_called()
+
+
+class RatingAggregatesTest(ShopTestMixin, APITestCase):
+    def rate(self, user, product, rating, method='post'):
+        self.client.force_authenticate(user)
+        return getattr(self.client, method)(
+            f'/shop/product/{product.pk}/set-rating/', {'rating': rating}
+        )
+
+    def test_set_rating_keeps_aggregates_in_sync(self):
+        product, other = self.create_products(2)
+        self.rate(self.seller, product, 5)
+        self.rate(self.buyer, product, 2)
+        self.rate(self.buyer, product, 4, method='patch')
+        product.refresh_from_db()
+        self.assertEqual((product.rating_sum, product.rating_count), (9, 2))
+        self.assertEqual(product.rating_avg, 4.5)
+        self.assertEqual(product.rating_histogram, {1: 0, 2: 0, 3: 0, 4: 1, 5: 1})
+
+        Rating.objects.filter(user=self.seller).delete()
+        product.refresh_from_db()
+        self.assertEqual((product.rating_sum, product.rating_count), (4, 1))
+        self.assertEqual(product.rating_avg, 4.0)
+
+        self.client.force_authenticate(None)
+        response = self.client.get('/shop/product/', {'ordering': '-rating_avg'})
+        self.assertEqual(response.data['results'][0]['id'], product.pk)
+        self.assertEqual(response.data['results'][0]['rating'], 4.0)
+
+    def test_rebuild_ratings_repairs_drift(self):
+        product, = self.create_products(1)
+        self.rate(self.buyer, product, 3)
+        Product.objects.filter(pk=product.pk).update(rating_sum=100, rating_3=7)
+        call_command('rebuild_ratings', stdout=mock.Mock())
+        product.refresh_from_db()
+        self.assertEqual((product.rating_sum, product.rating_count), (3, 1))
+        self.assertEqual(product.rating_histogram[3], 1)
+
+
+class ProductSearchTest(ShopTestMixin, APITestCase):
+    def search(self, query):
+        response = self.client.get('/shop/product/', {'q': query, 'page_size': 50})
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.data['results']]
+
+    def test_stemming(self):
+        self.assertEqual(tokenize('Холодильники холодильника'), ['холодильник'] * 2)
+        self.assertEqual(tokenize('Washing machines'), tokenize('washed machine'))
+
+    def test_ranking_and_typos(self):
+        index = SearchIndex()
+        index.add(1, {'name': 'Стиральная машина Beko', 'description': 'тихая'})
+        index.add(2, {'name': 'Холодильник', 'description': 'машина для льда'})
+        index.add(3, {'name': 'Телевизор LG'})
+        self.assertEqual([doc for doc, _ in index.search('стиральные машины')], [1, 2])
+        self.assertEqual([doc for doc, _ in index.search('холодилник')], [2])
+        index.remove(2)
+        self.assertEqual(index.search('холодильник'), [])
+
+    def test_search_param_filters_and_ranks(self):
+        fridge, other = self.create_products(2)
+        Product.objects.filter(pk=other.pk).update(name='Телевизор', description='холодильник в подарок')
+        self.assertEqual(self.search('холодильники'), [fridge.pk, other.pk])
+        self.assertEqual(self.search('телевизоры'), [other.pk])
+        self.assertEqual(self.search('пылесос'), [])
+
+    def test_index_follows_signals(self):
+        product, = self.create_products(1)
+        self.assertEqual(self.search('lg'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            product.tag.add(Tag.objects.create(name='LG'))
+        self.assertEqual(self.search('lg'), [product.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            product.delete()
+        self.assertEqual(self.search('холодильник'), [])
+
+    def test_other_processes_sync_through_shared_cache_only(self):
+        product, tv = self.create_products(2)
+        # второй экземпляр — индекс другого процесса, сигналы уведомляют только product_search
+        other = ProductSearch()
+        self.assertEqual(other.search('lg'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            product.tag.add(Tag.objects.create(name='LG'))
+        self.assertEqual(self.search('lg'), [product.pk])
+        # журнал в LocMemCache другому процессу не виден, выручает периодическая перестройка
+        self.assertEqual(other.search('lg'), [])
+        with override_settings(SEARCH_REBUILD_INTERVAL=0):
+            self.assertEqual([pk for pk, _ in other.search('lg')], [product.pk])
+
+        with mock.patch.object(ProductSearch, 'shared', new_callable=mock.PropertyMock, return_value=True):
+            with self.captureOnCommitCallbacks(execute=True):
+                tv.tag.add(Tag.objects.get(name='LG'))
+            self.assertEqual({pk for pk, _ in other.search('lg')}, {product.pk, tv.pk})
+
+
+class ResponseCacheTest(ShopTestMixin, APITestCase):
+    def test_anonymous_retrieve_is_cached_until_product_changes(self):
+        product, = self.create_products(1)
+        url = f'/shop/product/{product.pk}/'
+        self.assertEqual(self.client.get(url)['X-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'HIT')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(product=product, user=self.buyer, text='Новый')
+        response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.data['comments']), 3)
+
+    def test_list_keys_cover_query_params(self):
+        self.create_products(3)
+        self.client.get('/shop/product/', {'page_size': 1})
+        self.assertEqual(self.client.get('/shop/product/', {'page_size': 2})['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/shop/product/', {'page_size': 1})['X-Cache'], 'HIT')
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.get(name='beko').delete()
+        self.assertEqual(self.client.get('/shop/product/', {'page_size': 1})['X-Cache'], 'MISS')
+
+    def test_authenticated_requests_bypass_cache(self):
+        product, = self.create_products(1)
+        self.client.force_authenticate(self.buyer)
+        self.client.get(f'/shop/product/{product.pk}/')
+        self.assertNotIn('X-Cache', self.client.get(f'/shop/product/{product.pk}/'))
+
+    def test_single_flight_coalesces_concurrent_misses(self):
+        calls, results = [], []
+        group = SingleFlight()
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'value'
+
+        threads = [
+            threading.Thread(target=lambda: results.append(group.do('key', compute)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(coalesced for _, coalesced in results), [False] + [True] * 4)
+
+    def test_local_backend_warns_without_eager_celery(self):
+        local = ResponseCache(LocMemBackend(), timeout=60)
+        with self.settings(CELERY_TASK_ALWAYS_EAGER=False), self.assertLogs('shop.response_cache', 'WARNING'):
+            self.assertTrue(local.warn_if_local())
+        with self.settings(CELERY_TASK_ALWAYS_EAGER=True):
+            self.assertFalse(local.warn_if_local())
+        local.backend.shared = True
+        with self.settings(CELERY_TASK_ALWAYS_EAGER=False):
+            self.assertFalse(local.warn_if_local())
+
+
+class ImportProductsTest(ShopTestMixin, APITestCase):
+    def run_import(self, content, *args):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'catalog.csv')
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        call_command('import_products', path, '--seller', 'seller', *args, stdout=mock.Mock())
+        with open(f'{path}.errors.jsonl', encoding='utf-8') as file:
+            return path, [json.loads(line) for line in file]
+
+    def test_imports_batches_and_reports_errors(self):
+        path, errors = self.run_import(
+            'name,category,price,stock,tags\n'
+            'Телевизор LG,Телевизоры,49990.00,5,lg;oled\n'
+            'Холодильник,Холодильники,1000,1,beko\n'
+            'Сломанный,Телевизоры,дорого,1,\n',
+            '--batch-size', '2'
+        )
+        self.assertEqual([error['line'] for error in errors], [3])
+        tv = Product.objects.get(name='Телевизор LG')
+        self.assertEqual(tv.slug, 'televizor-lg')
+        self.assertEqual(sorted(tv.tag.values_list('name', flat=True)), ['lg', 'oled'])
+        self.assertTrue(Category.objects.filter(name='Телевизоры', slug='televizory').exists())
+
+        # повторный запуск видит отметку о завершении и ничего не дублирует
+        out = io.StringIO()
+        call_command('import_products', path, '--seller', 'seller', stdout=out)
+        self.assertIn('Импорт уже завершен: импортировано 2, ошибок 1', out.getvalue())
+        self.assertEqual(Product.objects.count(), 2)
+
+    def test_clean_import_removes_checkpoint(self):
+        path, errors = self.run_import(
+            'name,category,price,stock\n'
+            'Телевизор LG,Телевизоры,49990.00,5\n',
+            '--batch-size', '1'
+        )
+        self.assertEqual(errors, [])
+        self.assertFalse(os.path.exists(f'{path}.checkpoint'))
+        # тот же путь с новым файлом загружается заново, а не пропускается
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write('name,category,price,stock\nХолодильник,Холодильники,1000,1\n')
+        call_command('import_products', path, '--seller', 'seller', stdout=mock.Mock())
+        self.assertEqual(Product.objects.count(), 2)
+
+    def test_slugs_fit_the_field(self):
+        name = 'Щ' * 150
+        path, errors = self.run_import(
+            'name,slug,category,price,stock\n'
+            f'{name},,Товары,100,1\n'
+            'Плохой slug,не slug!,Товары,100,1\n'
+            f'Длинный slug,{"a" * 201},Товары,100,1\n'
+        )
+        self.assertEqual([error['line'] for error in errors], [2, 3])
+        slug = Product.objects.get(name=name).slug
+        self.assertEqual(len(slug), 200)
+        self.assertTrue(slug.startswith('shch'))
+
+
+class ExportProductsTest(ShopTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.products = self.create_products(5)
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_streams_jsonl_with_prefetch_per_chunk(self):
+        response = self.client.get('/shop/product/export/')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        # товары + по запросу тегов и картинок на каждую из трех пачек
+        with self.assertNumQueries(7):
+            body = b''.join(response.streaming_content).decode()
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([row['id'] for row in rows], [product.pk for product in self.products])
+        self.assertEqual(sorted(rows[0]['tags']), ['beko', 'no-frost'])
+        self.assertEqual(len(rows[0]['images']), 2)
+        self.assertTrue(rows[0]['images'][0].startswith('http://testserver/'))
+        self.assertEqual(rows[0]['comment_count'], 2)
+
+    def test_gzip_csv_since(self):
+        Product.objects.filter(pk=self.products[0].pk).update(updated='2000-01-01T00:00:00Z')
+        response = self.client.get(
+            '/shop/product/export/', {'type': 'csv', 'since': '2001-01-01'},
+            HTTP_ACCEPT_ENCODING='gzip, deflate'
+        )
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        body = gzip.decompress(b''.join(response.streaming_content)).decode()
+        rows = list(csv.DictReader(io.StringIO(body)))
+        self.assertEqual([int(row['id']) for row in rows], [product.pk for product in self.products[1:]])
+        self.assertEqual(rows[0]['category'], 'Холодильники')
+        self.assertEqual(self.client.get('/shop/product/export/', {'type': 'xml'}).status_code, 400)
+        self.assertEqual(self.client.get('/shop/product/export/', {'since': 'вчера'}).status_code, 400)
+
+    def test_command_output_imports_back(self):
+        path = os.path.join(tempfile.mkdtemp(), 'catalog.csv.gz')
+        call_command('export_products', path, stdout=mock.Mock())
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            content = file.read()
+        Product.objects.all().delete()
+        with open(path[:-3], 'w', encoding='utf-8') as file:
+            file.write(content)
+        call_command('import_products', path[:-3], stdout=mock.Mock())
+        self.assertEqual(
+            sorted(Product.objects.values_list('slug', flat=True)),
+            [product.slug for product in self.products]
+        )
+        self.assertEqual(sorted(Product.objects.first().tag.values_list('name', flat=True)), ['beko', 'no-frost'])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMAGE_VARIANT_WIDTHS=(100, 400))
+class ImageVariantsTest(ShopTestMixin, APITestCase):
+    def upload(self, name, size):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, 'red').save(buffer, 'PNG')
+        return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+    def test_carousel_uploaded_through_api_is_processed(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (200, 100), 'red').save(buffer, 'PNG')
+        files = [
+            SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+            for name in ('first.png', 'second.png')
+        ]
+        self.client.force_authenticate(self.seller)
+        with mock.patch('shop.signals.process_product_images.delay') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/shop/product/', {
+                'category': self.category.pk,
+                'name': 'Холодильник с каруселью',
+                'slug': 'carousel-fridge',
+                'price': '1000.00',
+                'stock': 5,
+                'tag': [self.tags[0].pk],
+                'carousel_img': files,
+            }, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        product = Product.objects.get(slug='carousel-fridge')
+        self.assertEqual(product.product_images.count(), 2)
+        delay.assert_called_with(product.pk)
+
+    def test_variants_are_generated_and_exposed(self):
+        product, = self.create_products(1)
+        Product.objects.filter(pk=product.pk).update(image=self.upload('products/big.png', (800, 600)))
+        ProductImage.objects.filter(product=product).update(
+            image=self.upload('product_images/carousel/small.png', (200, 100))
+        )
+        for workers in (0, 1):
+            with self.settings(IMAGE_PROCESS_WORKERS=workers):
+                ProductImage.objects.update(variants={})
+                process_product_images(product.pk)
+
+        response = self.client.get(f'/shop/product/{product.pk}/')
+        image = response.data['image_variants']
+        self.assertEqual((image['width'], image['height']), (800, 600))
+        self.assertEqual(
+            [(item['width'], item['height'], item['format']) for item in image['items']],
+            [(100, 75, 'webp'), (100, 75, 'jpeg'), (400, 300, 'webp'), (400, 300, 'jpeg')]
+        )
+        self.assertIn('400w', image['srcset']['webp'])
+        carousel = response.data['carousel'][0]['variants']
+        # картинки меньше заданной ширины не увеличиваются
+        self.assertEqual(sorted({item['width'] for item in carousel['items']}), [100, 200])
+        for item in image['items']:
+            self.assertTrue(default_storage.exists(item['url'].split('/products/', 1)[1]))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), MEDIA_BLOB_GRACE=0, IMAGE_PROCESS_WORKERS=0)
+class MediaStorageTest(ShopTestMixin, APITestCase):
+    def photo(self, name, color='red'):
+        buffer = io.BytesIO()
+        Image.new('RGB', (200, 100), color).save(buffer, 'PNG')
+        return ContentFile(buffer.getvalue(), name=name)
+
+    def test_same_upload_is_stored_once_until_last_reference(self):
+        first, second = self.create_products(2)
+        images = [
+            ProductImage.objects.create(product=product, image=self.photo(name))
+            for product, name in ((first, 'IMG_1.PNG'), (second, 'copy.png'))
+        ]
+        name = images[0].image.name
+        self.assertEqual(images[1].image.name, name)
+        self.assertRegex(name, r'^product_images/carousel/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
+
+        process_product_images(first.pk)
+        # у второго товара тот же файл: варианты не считаются заново
+        with mock.patch('shop.tasks.render_variants') as render:
+            process_product_images(second.pk)
+        render.assert_not_called()
+        variants = ProductImage.objects.get(pk=images[1].pk).variants
+        self.assertEqual(variants['source'], name)
+        storage = ProductImage._meta.get_field('image').storage
+        variant_names = [item['name'] for item in variants['items']]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(storage.exists(name))
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductImage.objects.filter(pk=images[1].pk).delete()
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(any(storage.exists(variant) for variant in variant_names))
+
+    def test_release_within_grace_is_retried_later(self):
+        product, = self.create_products(1)
+        image = ProductImage.objects.create(product=product, image=self.photo('a.png'))
+        process_product_images(product.pk)
+        image.refresh_from_db()
+        storage = ProductImage._meta.get_field('image').storage
+        names = [image.image.name] + [item['name'] for item in image.variants['items']]
+
+        with self.settings(MEDIA_BLOB_GRACE=3600), \
+                mock.patch('shop.tasks.release_carousel_image.apply_async') as retry, \
+                self.captureOnCommitCallbacks(execute=True):
+            image.delete()
+        self.assertTrue(all(storage.exists(name) for name in names))
+        (args,), kwargs = retry.call_args
+        self.assertEqual(kwargs, {'countdown': 3600})
+
+        # срок истек: повторная задача удаляет файл и варианты
+        release_carousel_image(*args)
+        self.assertFalse(any(storage.exists(name) for name in names))
+
+    def test_media_is_served_with_immutable_cache_headers(self):
+        product, = self.create_products(1)
+        name = ProductImage.objects.create(product=product, image=self.photo('a.png')).image.name
+
+        response = self.client.get(f'/products/{name}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(b''.join(response.streaming_content)[:4], b'\x89PNG')
+        response.close()
+        response = self.client.get(f'/products/{name}', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        with self.settings(MEDIA_SERVE='x-accel'):
+            response = self.client.get(f'/products/{name}')
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{name}')
+        self.assertEqual(response.content, b'')
+        for path in ('../manage.py', '.incoming/tmp', 'missing.png'):
+            self.assertEqual(self.client.get(f'/products/{path}').status_code, 404)
+
+
+class RecommendationsTest(ShopTestMixin, APITestCase):
+    def similar(self, product):
+        response = self.client.get(f'/shop/product/{product.pk}/similar/')
+        self.assertEqual(response.status_code, 200)
+        return [(item['id'], item['similarity']) for item in response.data]
+
+    def test_matrix_combines_tags_ratings_and_category(self):
+        matrix = SimilarityMatrix(
+            products=[(1, 'a', True, 0), (2, 'a', True, 0), (3, 'b', True, 0), (4, 'a', True, 5), (5, 'a', False, 0)],
+            tags=[(1, 'x'), (1, 'y'), (2, 'x'), (3, 'x'), (3, 'y'), (5, 'x')],
+            likes=[('u', 1), ('u', 3), ('v', 3)],
+            weights={'tags': 0.5, 'ratings': 0.3, 'category': 0.2},
+        )
+        scores = matrix.scores(1)
+        self.assertAlmostEqual(scores[2], 0.5 * 1 / 2 + 0.2)
+        self.assertAlmostEqual(scores[3], 0.5 + 0.3 / 2 ** 0.5)
+        # товары не в наличии не рекомендуются
+        self.assertNotIn(5, scores)
+        # без общих тегов и покупателей — лучшие товары той же категории
+        self.assertEqual([pk for pk, score in matrix.top(1, 3)], [3, 2, 4])
+        # при равном сходстве выше товар с меньшим id
+        self.assertEqual(matrix.top(4, 2), [(1, 0.2), (2, 0.2)])
+
+    @override_settings(RECOMMENDATIONS_TOP_K=1, RECOMMENDATION_MAX_TAG_PRODUCTS=2)
+    def test_incremental_load_reads_only_neighbourhood_without_popular_tags(self):
+        first, second, third, fourth = self.create_products(4)
+        beko, no_frost = self.tags
+        first.tag.set([beko, no_frost])
+        second.tag.set([beko])
+        third.tag.set([beko])
+        fourth.tag.set([no_frost])
+        matrix = SimilarityMatrix.load([first.pk])
+        # сосед по тегу no-frost и лучшие в категории; beko стоит у трех товаров и отброшен
+        self.assertEqual(set(matrix.categories), {first.pk, second.pk, fourth.pk})
+        self.assertEqual(matrix.tags[first.pk], {no_frost.pk})
+        self.assertEqual(set(matrix.scores(first.pk)), {fourth.pk})
+        self.assertEqual(set(SimilarityMatrix.load().categories), {first.pk, second.pk, third.pk, fourth.pk})
+
+    def test_similar_products_are_refreshed_incrementally(self):
+        first, second, third, fourth = self.create_products(4)
+        beko, no_frost = self.tags
+        first.tag.set([beko, no_frost])
+        second.tag.set([beko, no_frost])
+        third.tag.set([beko])
+        self.client.force_authenticate(self.buyer)
+        for product, rating in ((first, 5), (third, 4)):
+            self.client.post(f'/shop/product/{product.pk}/set-rating/', {'rating': rating})
+        self.client.force_authenticate(None)
+
+        self.assertEqual(refresh_recommendations(), 4)
+        self.assertFalse(SimilarProductQueue.objects.exists())
+        with self.assertNumQueries(1):
+            similar = self.similar(first)
+        self.assertEqual([pk for pk, score in similar], [third.pk, second.pk, fourth.pk])
+        self.assertEqual(similar[1], (second.pk, 0.7))
+        self.assertEqual(refresh_recommendations(), 0)
+
+        # новый тег меняет топ самого товара и тех, в чей топ он проходит
+        fourth.tag.set([no_frost])
+        self.assertEqual(refresh_recommendations(), 4)
+        self.assertEqual(self.similar(second)[:2], [(first.pk, 0.7), (third.pk, 0.45)])
+        self.assertEqual(self.similar(fourth)[:2], [(first.pk, 0.45), (second.pk, 0.45)])
+
+        Product.objects.filter(pk=third.pk).update(available=False)
+        self.assertNotIn(third.pk, [pk for pk, score in self.similar(first)])
+        self.assertEqual(self.client.get('/shop/product/0/similar/').status_code, 404)
+
+        third.delete()
+        self.assertLessEqual({first.pk, second.pk, fourth.pk}, set(SimilarProductQueue.objects.values_list('product_id', flat=True)))
+        refresh_recommendations()
+        self.assertFalse(SimilarProductQueue.objects.exists())
+        self.assertEqual(SimilarProduct.objects.filter(product=first).count(), 2)
+        call_command('rebuild_recommendations', stdout=io.StringIO())
+        self.assertEqual(SimilarProduct.objects.count(), 6)
+
+
+@override_settings(LEADERBOARD_PRIOR_COUNT=2)
+class LeaderboardTest(ShopTestMixin, APITestCase):
+    def rate(self, user, product, rating, method='post'):
+        self.client.force_authenticate(user)
+        getattr(self.client, method)(f'/shop/product/{product.pk}/set-rating/', {'rating': rating})
+        self.client.force_authenticate(None)
+
+    def top(self, slug, **params):
+        response = self.client.get(f'/shop/category/{slug}/top/', params)
+        self.assertEqual(response.status_code, 200)
+        return [(item['id'], item['score']) for item in response.data]
+
+    def test_bayesian_score(self):
+        # одна пятерка при средней 3 весит меньше, чем сто пятерок
+        self.assertEqual(bayesian_score(5, 1, 3, 2), 11 / 3)
+        self.assertGreater(bayesian_score(500, 100, 3, 2), bayesian_score(5, 1, 3, 2))
+        self.assertEqual(bayesian_score(0, 0, 3, 2), 3)
+
+    def test_top_products_per_category(self):
+        child = Category.objects.create(name='Двухкамерные', slug='two-door', parent=self.category)
+        single, popular, nested, unrated = self.create_products(4)
+        Product.objects.filter(pk=nested.pk).update(category=child)
+        users = [
+            User.objects.create_user(username=f'rater{i}', email=f'rater{i}@example.com', password='pass12345')
+            for i in range(4)
+        ]
+        self.rate(users[0], single, 5)
+        for user in users:
+            self.rate(user, popular, 5)
+        self.rate(users[1], nested, 3)
+        LeaderboardQueue.objects.filter(category_id=self.category.pk).delete()
+
+        # подкатегория пересчитывается вместе с предками
+        self.assertEqual(refresh_leaderboards(), 2)
+        with self.assertNumQueries(1):
+            top = self.top('fridges')
+        self.assertEqual(top, [(popular.pk, 4.8889), (single.pk, 4.7778), (nested.pk, 4.1111)])
+        self.assertEqual(self.top('two-door'), [(nested.pk, 4.1111)])
+        self.assertEqual(self.top('fridges', limit=1), [(popular.pk, 4.8889)])
+        self.assertEqual(self.client.get('/shop/category/fridges/top/', {'limit': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get('/shop/category/missing/top/').status_code, 404)
+
+        self.rate(users[1], nested, 5, method='patch')
+        self.assertEqual(list(LeaderboardQueue.objects.values_list('category_id', flat=True)), [child.pk])
+        self.assertEqual(refresh_leaderboards(), 2)
+        self.assertEqual(self.top('two-door'), [(nested.pk, 5.0)])
+
+        # полная перестройка по таблице Rating дает те же топы
+        incremental = list(CategoryLeaderboard.objects.values_list('category', 'product', 'rank', 'score'))
+        call_command('rebuild_leaderboards', stdout=io.StringIO())
+        self.assertEqual(list(CategoryLeaderboard.objects.values_list('category', 'product', 'rank', 'score')), incremental)
+
+        Product.objects.filter(pk=popular.pk).update(available=False)
+        self.assertEqual([pk for pk, score in self.top('fridges')], [single.pk, nested.pk])
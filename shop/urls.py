@@ -1,11 +1,14 @@
 from django.urls import path
 from rest_framework.routers import DefaultRouter
-from .views import ProductViewSet, TagViewSet, CommentCreateDeleteView
+from .views import CartViewSet, OrderViewSet, CategoryViewSet, ProductViewSet, TagViewSet, CommentCreateDeleteView
 
 
 router = DefaultRouter()
+router.register('category', CategoryViewSet, 'category')
 router.register('product', ProductViewSet, 'product')
 router.register('comment', CommentCreateDeleteView, 'comment')
 router.register('tag', TagViewSet, 'tag')
+router.register('cart', CartViewSet, 'cart')
+router.register('order', OrderViewSet, 'order')
 urlpatterns = []
 urlpatterns += router.urls
\ No newline at end of file
@@ -1,53 +1,79 @@
+import uuid
+
 from rest_framework import mixins, status, filters
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.response import Response
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import router
+from django.http import StreamingHttpResponse
 from django_filters import rest_framework as rest_filter
+from drf_yasg.utils import swagger_auto_schema
 
 from .models import (
     Category, 
     Product, 
     Comment,
     Tag,
-    Rating
+    Rating,
+    Order,
+    SimilarProduct,
+    CategoryLeaderboard
 )
 from .serializers import (
     CommentSerializer,
     ProductSerializer,
     CategoryListSerializer,
+    CategorySerializer,
     ProductCreateSerializer,
     TagSerializer,
-    RatingSerializer
+    RatingSerializer,
+    CartItemSerializer,
+    CartQuantitySerializer,
+    CheckoutSerializer,
+    OrderSerializer,
+    SimilarProductSerializer,
+    TopProductSerializer
 )
 
+from myshop.routers import ReplicaReadMixin, stream_replica_reads
+
+from .cart import CartError, cart_service
+from .categories import build_tree
+from .export import EXPORT_FORMATS, export_catalog, parse_since
+from .filters import FacetedListMixin, ProductFilter
+from .freshness import ConditionalResponseMixin
+from .orders import OutOfStock, cancel_order, create_order, pay_order
+from .pagination import CommentPagination, KeysetPagination, SwitchablePaginationMixin
 from .permissions import IsOwner
+from .response_cache import CachedResponseMixin
+from .search import ProductSearchFilter
 
 
-class CategoryViewSet(ModelViewSet):
-    queryset = Category.objects.all()
-    serializer_class = CategoryListSerializer
+class CategoryViewSet(ReplicaReadMixin, ModelViewSet):
+    queryset = Category.objects.select_related('stats', 'parent')
+    replica_actions = ('list', 'retrieve', 'products', 'tree', 'breadcrumbs', 'top')
+    serializer_class = CategorySerializer
+    lookup_field = 'slug'
     filter_backends = [
         filters.SearchFilter,
         rest_filter.DjangoFilterBackend,
         filters.OrderingFilter
     ]
     search_fields = ['name']
-    filterset_fields = ['slug']
-    ordering_fields = ['created']
-
-    def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+    filterset_fields = ['slug', 'parent__slug']
+    ordering_fields = ['name', 'stats__product_count', 'stats__min_price', 'stats__max_price']
 
     def get_serializer_class(self):
-        if self.action == 'list':
-            return ProductSerializer
-        elif self.action == 'create':
-            return ProductCreateSerializer
+        if self.action in ['create', 'update', 'partial_update']:
+            return CategoryListSerializer
         return super().get_serializer_class()
 
     def get_permissions(self):
-        if self.action in ['list', 'retrieve']:
+        if self.action in ['list', 'retrieve', 'products', 'tree', 'breadcrumbs', 'top']:
             self.permission_classes = [AllowAny]
         if self.action in ['create']:
             self.permission_classes = [IsAdminUser]
@@ -55,18 +81,92 @@ class CategoryViewSet(ModelViewSet):
             self.permission_classes = [IsAdminUser]
         return super().get_permissions()
 
+    @action(detail=True, methods=['GET'])
+    def products(self, request, slug=None):
+        """Товары категории и ее подкатегорий с теми же фильтрами, сортировкой и пагинацией, что и /shop/product/"""
+        category = self.get_object()
+        view = ProductViewSet.as_view({'get': 'list'}, category=category)
+        return view(request._request)
+
+    @action(detail=False, methods=['GET'])
+    def tree(self, request):
+        """Все дерево категорий или поддерево ?root=<slug> одним запросом"""
+        categories = Category.objects.only('name', 'slug', 'parent')
+        root = request.query_params.get('root')
+        if root:
+            categories = categories.filter(ancestor_links__ancestor__slug=root)
+        categories = list(categories)
+        if root and not categories:
+            raise NotFound()
+        return Response(build_tree(categories))
+
+    @action(detail=True, methods=['GET'])
+    def breadcrumbs(self, request, slug=None):
+        """Путь от корня до категории одним запросом по таблице замыканий"""
+        chain = Category.objects.filter(
+            descendant_links__descendant__slug=slug
+        ).order_by('-descendant_links__depth').values('name', 'slug')
+        chain = list(chain)
+        if not chain:
+            raise NotFound()
+        return Response(chain)
 
-class ProductViewSet(ModelViewSet):
+    @action(detail=True, methods=['GET'])
+    def top(self, request, slug=None):
+        """
+        Лучшие товары категории и подкатегорий по байесовской оценке,
+        ?limit=<не больше LEADERBOARD_SIZE>. Готовый топ shop.leaderboard, один запрос
+        """
+        limit = request.query_params.get('limit', settings.LEADERBOARD_SIZE)
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValidationError({'limit': 'Ожидается число'})
+        rows = list(CategoryLeaderboard.objects.filter(
+            category__slug=slug, product__available=True
+        ).select_related('product').only(
+            'score', 'product__name', 'product__slug', 'product__price', 'product__image',
+            'product__image_variants', 'product__rating_avg', 'product__rating_count'
+        ).order_by('rank')[:max(0, min(limit, settings.LEADERBOARD_SIZE))])
+        if not rows and not Category.objects.filter(slug=slug).exists():
+            raise NotFound()
+        products = []
+        for row in rows:
+            row.product.score = row.score
+            products.append(row.product)
+        return Response(TopProductSerializer(
+            products, many=True, context=self.get_serializer_context()
+        ).data)
+
+
+class ProductViewSet(
+    ReplicaReadMixin,
+    ConditionalResponseMixin,
+    CachedResponseMixin,
+    FacetedListMixin,
+    SwitchablePaginationMixin,
+    ModelViewSet):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+    pagination_class = KeysetPagination
     filter_backends = [
-        filters.SearchFilter,
+        ProductSearchFilter,
         rest_filter.DjangoFilterBackend,
         filters.OrderingFilter
     ]
-    search_fields = ['name', 'user__username']
-    filterset_fields = ['slug']
-    ordering_fields = ['created']
+    filterset_class = ProductFilter
+    ordering_fields = ['created', 'price', 'rating_avg', 'rating_count']
+    replica_actions = ('list', 'retrieve', 'comments', 'export', 'similar')
+    # задается из CategoryViewSet.products
+    category = None
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.category is not None:
+            queryset = queryset.in_category(self.category)
+        if self.action in ['list', 'retrieve']:
+            return queryset.for_serializer()
+        return queryset
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -79,7 +179,7 @@ class ProductViewSet(ModelViewSet):
         return super().get_serializer_class()
 
     def get_permissions(self):
-        if self.action in ['list', 'retrieve']:
+        if self.action in ['list', 'retrieve', 'comments', 'export', 'similar']:
             self.permission_classes = [AllowAny]
         if self.action == 'comment' and self.request.method == 'DELETE':
             self.permission_classes = [IsOwner]
@@ -99,6 +199,74 @@ class ProductViewSet(ModelViewSet):
                 serializer.data, status=status.HTTP_201_CREATED
                 )
 
+    @action(detail=False, methods=['GET'])
+    def export(self, request):
+        """
+        Весь каталог потоком: ?type=jsonl|csv, ?since=<дата> — измененные с этого момента.
+        Сжимается gzip, если клиент прислал Accept-Encoding: gzip
+        """
+        file_format = request.query_params.get('type', 'jsonl')
+        if file_format == 'ndjson':
+            file_format = 'jsonl'
+        if file_format not in EXPORT_FORMATS:
+            raise ValidationError({'type': f'Допустимые форматы: {", ".join(EXPORT_FORMATS)}'})
+        since = request.query_params.get('since')
+        if since:
+            try:
+                since = parse_since(since)
+            except ValueError as error:
+                raise ValidationError({'since': str(error)})
+        compress = 'gzip' in request.headers.get('Accept-Encoding', '')
+
+        def url(name):
+            return request.build_absolute_uri(default_storage.url(name))
+
+        # поток читается уже после выхода из view и сброса состояния запроса,
+        # поэтому базу выбираем сейчас, а разрешение на реплики переносим в поток
+        using = router.db_for_read(Product)
+        stream = export_catalog(file_format, since or None, compress, url=url, using=using)
+        if using is not None:
+            stream = stream_replica_reads(stream)
+        response = StreamingHttpResponse(
+            stream,
+            content_type=f'{EXPORT_FORMATS[file_format]}; charset=utf-8'
+        )
+        response['Content-Disposition'] = f'attachment; filename="catalog.{file_format}"'
+        response['Vary'] = 'Accept-Encoding'
+        if compress:
+            response['Content-Encoding'] = 'gzip'
+        return response
+
+    @action(detail=True, methods=['GET'], pagination_class=CommentPagination)
+    def comments(self, request, pk=None):
+        """Все комментарии товара, новые первыми, с курсорной пагинацией по (created_at, id)"""
+        product = self.get_object()
+        queryset = product.comments.for_serializer().order_by('-created_at', '-id')
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(CommentSerializer(page, many=True).data)
+
+    @action(detail=True, methods=['GET'])
+    def similar(self, request, pk=None):
+        """Похожие товары из готового топа shop.recommendations: один запрос по индексу"""
+        try:
+            rows = list(SimilarProduct.objects.filter(
+                product_id=pk, similar__available=True
+            ).select_related('similar').only(
+                'score', 'similar__name', 'similar__slug', 'similar__price',
+                'similar__image', 'similar__image_variants', 'similar__rating_avg'
+            ).order_by('rank'))
+        except (TypeError, ValueError):
+            raise NotFound
+        if not rows and not Product.objects.filter(pk=pk).exists():
+            raise NotFound
+        products = []
+        for row in rows:
+            row.similar.similarity = row.score
+            products.append(row.similar)
+        return Response(SimilarProductSerializer(
+            products, many=True, context=self.get_serializer_context()
+        ).data)
+
     @action(methods=['POST', 'PATCH'], detail=True, url_path='set-rating')
     def set_rating(self, request, pk=None):
         data = request.data.copy()
@@ -133,6 +301,7 @@ class CommentCreateDeleteView(
     
 
 class TagViewSet(
+    ReplicaReadMixin,
     mixins.ListModelMixin,
     mixins.RetrieveModelMixin,
     mixins.CreateModelMixin,
@@ -146,4 +315,132 @@ class TagViewSet(
             self.permission_classes = [IsAuthenticated]
         if self.action == 'destroy':
             self.permission_classes = [IsAdminUser]
-        return super().get_permissions()
\ No newline at end of file
+        return super().get_permissions()
+
+
+class CartViewSet(GenericViewSet):
+    """
+    Корзина авторизованного пользователя или анонимная по заголовку X-Cart-Id.
+    Анонимная корзина переносится в корзину пользователя при первом
+    запросе после входа, в котором передан ее X-Cart-Id
+    """
+    # id в URL — id товара в корзине
+    queryset = Product.objects.none()
+    permission_classes = [AllowAny]
+    serializer_class = CartItemSerializer
+    cart_header = 'X-Cart-Id'
+    lookup_value_regex = r'\d+'
+
+    def get_owner(self):
+        try:
+            cart_id = uuid.UUID(self.request.headers.get(self.cart_header, '')).hex
+        except ValueError:
+            cart_id = None
+        if self.request.user.is_authenticated:
+            owner = cart_service.user_owner(self.request.user)
+            if cart_id:
+                cart_service.merge(cart_service.anonymous_owner(cart_id), owner)
+            return owner, None
+        cart_id = cart_id or uuid.uuid4().hex
+        return cart_service.anonymous_owner(cart_id), cart_id
+
+    def cart_response(self, owner, cart_id, status_code=status.HTTP_200_OK):
+        data = cart_service.view(owner)
+        headers = {}
+        if cart_id:
+            data['cart_id'] = cart_id
+            headers[self.cart_header] = cart_id
+        return Response(data, status=status_code, headers=headers)
+
+    def list(self, request):
+        return self.cart_response(*self.get_owner())
+
+    def create(self, request):
+        serializer = CartItemSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        owner, cart_id = self.get_owner()
+        try:
+            cart_service.add(
+                owner, serializer.validated_data['product'], serializer.validated_data['quantity']
+            )
+        except CartError as error:
+            raise ValidationError({'product': str(error)})
+        return self.cart_response(owner, cart_id, status.HTTP_201_CREATED)
+
+    def partial_update(self, request, pk=None):
+        serializer = CartQuantitySerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        owner, cart_id = self.get_owner()
+        try:
+            cart_service.update(owner, pk, serializer.validated_data['quantity'])
+        except CartError as error:
+            raise ValidationError({'product': str(error)})
+        return self.cart_response(owner, cart_id)
+
+    def destroy(self, request, pk=None):
+        owner, cart_id = self.get_owner()
+        cart_service.remove(owner, pk)
+        return self.cart_response(owner, cart_id)
+
+
+
+class OrderViewSet(
+    mixins.ListModelMixin,
+    mixins.RetrieveModelMixin,
+    GenericViewSet):
+    queryset = Order.objects.prefetch_related('items')
+    serializer_class = OrderSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return super().get_queryset().filter(user=self.request.user)
+
+    @swagger_auto_schema(request_body=CheckoutSerializer)
+    def create(self, request):
+        """Резервирует товар из items или из корзины и создает заказ"""
+        serializer = CheckoutSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        owner = cart_service.user_owner(request.user)
+        items = serializer.validated_data.get('items')
+        if items is None:
+            quantities = cart_service.take(owner)
+        else:
+            quantities = {}
+            for item in items:
+                quantities[item['product']] = quantities.get(item['product'], 0) + item['quantity']
+        if not quantities:
+            raise ValidationError({'items': 'Заказ пуст'})
+        try:
+            order = create_order(request.user, quantities)
+        except OutOfStock as error:
+            if items is None:
+                cart_service.restore(owner, quantities)
+            return Response(
+                {'detail': 'Недостаточно товара на складе', 'products': error.product_ids},
+                status=status.HTTP_409_CONFLICT
+            )
+        except Exception:
+            if items is None:
+                cart_service.restore(owner, quantities)
+            raise
+        return Response(OrderSerializer(order).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['POST'])
+    def pay(self, request, pk=None):
+        order = self.get_object()
+        if not pay_order(order):
+            return Response(
+                {'detail': 'Заказ уже оплачен, отменен или резерв истек'},
+                status=status.HTTP_409_CONFLICT
+            )
+        return Response(OrderSerializer(order).data)
+
+    @action(detail=True, methods=['POST'])
+    def cancel(self, request, pk=None):
+        order = self.get_object()
+        if not cancel_order(order):
+            return Response(
+                {'detail': 'Отменить можно только зарезервированный заказ'},
+                status=status.HTTP_409_CONFLICT
+            )
+        return Response(OrderSerializer(order).data)